@@ -0,0 +1,286 @@
+"""
+数据加载器与run_row的性能测试。
+
+make_vcf生成可以复现的模拟VCF文件，可以指定行数、样本数，以及是否进行gzip/BGZF压缩。
+run_benchmark对n_jobs、chunk_size、order的组合，以及ChunkLoader的同步与异步加载方式进行测试，
+每个配置在独立的子进程中运行，以便分别统计峰值内存。结果包括行/秒、MB/秒、主进程与子进程的峰值RSS，
+以及主进程占全部CPU时间的比例。主进程占比越高，说明分发与收集结果的开销越接近瓶颈。
+某个配置运行出错、异常退出或超时时，记录为失败的配置(结果中包含error)，继续测试其余配置。
+
+命令行使用方法:
+    python Benchmark.py --rows 200000 --samples 100 --compress gzip --n-jobs 1,2,4 --chunk-size 100,1000
+    python Benchmark.py --json result.json
+
+"""
+
+from multiprocessing import Process, Queue
+import argparse
+import contextlib
+import gzip
+import io
+import itertools
+import json
+import os
+import queue
+import random
+import traceback
+import resource
+import shutil
+import tempfile
+import time
+import Bgzf
+from LinePrcessor import ChunkLoader, ParallelLine
+
+GENOTYPES = ['0/0', '0/1', '1/1', './.']
+BASES = 'ACGT'
+
+
+def iter_vcf_lines(n_rows=10000, n_samples=20, seed=0):
+    """
+    生成模拟VCF文件的各行，同样的参数总是得到同样的数据
+    :param n_rows: 数据行数，不包括文件头
+    :param n_samples: 样本数
+    :param seed: 随机数种子
+    :return: 行的生成器，不包括换行符
+    """
+    rand = random.Random(seed)
+    yield '##fileformat=VCFv4.2'
+    yield '##source=synthetic'
+    yield '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] +
+                    ['s{}'.format(i) for i in range(n_samples)])
+    for i in range(n_rows):
+        ref = rand.choice(BASES)
+        alt = rand.choice(BASES.replace(ref, ''))
+        samples = ['{}:12'.format(rand.choice(GENOTYPES)) for _ in range(n_samples)]
+        yield '\t'.join(['1', str(1000 + i), '.', ref, alt, '50', 'PASS', '.', 'GT:DP'] + samples)
+
+
+def make_vcf(fname, n_rows=10000, n_samples=20, compress=None, seed=0):
+    """
+    生成模拟VCF文件
+    :param fname: 输出文件名
+    :param n_rows: 数据行数，不包括文件头
+    :param n_samples: 样本数
+    :param compress: None代表不压缩，'gzip'为普通gzip压缩，'bgzf'为BGZF压缩
+    :param seed: 随机数种子
+    :return: fname
+    """
+    assert compress in (None, 'gzip', 'bgzf'), "不支持的压缩方式:{}".format(compress)
+    data = ''.join(line + '\n' for line in iter_vcf_lines(n_rows, n_samples, seed)).encode()
+    if compress == 'gzip':
+        data = gzip.compress(data)
+    elif compress == 'bgzf':
+        data = Bgzf.compress_bgzf(data) + Bgzf.BGZF_EOF
+
+    # 先写入临时文件再替换，并行运行的测试不会读到不完整的文件
+    tmp_name = '{}.tmp{}'.format(fname, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_name, fname)
+    return fname
+
+
+def bench_row(line):
+    """
+    测试使用的行处理方法：跳过文件头，统计每行中非参考基因型的数量
+    """
+    if line.startswith('#'):
+        return None
+    fields = line.split('\t')
+    n_alt = 0
+    for sample in fields[9:]:
+        if sample[0] == '1' or sample[2] == '1':
+            n_alt += 1
+    return '{}\t{}\t{}'.format(fields[0], fields[1], n_alt)
+
+
+def _run_config(config, input_file_name, output_file_name, result_queue):
+    """
+    在子进程中运行一个测试配置，并统计时间与资源占用
+    :param config: 测试配置dict，参见run_benchmark
+    :return: 结果通过result_queue传回
+    """
+    t0 = time.time()
+    cpu0 = os.times()
+    n_lines = 0
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if config['target'] == 'loader':
+                loader = ChunkLoader(input_file_name, chunk_size=config['chunk_size'], use_async=config['use_async'])
+                for data in loader:
+                    n_lines += len(data)
+            else:
+                line_processor = ParallelLine(n_jobs=config['n_jobs'], chunk_size=config['chunk_size'],
+                                              show_process_status=False)
+                line_processor.run_row(input_file_name, output_file_name, row_func=bench_row, order=config['order'],
+                                       read_mode=config['read_mode'], checkpoint=False)
+                n_lines = line_processor.metrics.lines
+    except Exception as e:
+        # 出错的配置把异常信息传回主进程，不让主进程一直等待
+        traceback.print_exc()
+        result_queue.put(_failed_result(config, '{}: {}'.format(type(e).__name__, e)))
+        return
+    elapsed = time.time() - t0
+    cpu1 = os.times()
+
+    # 子进程的CPU时间与峰值内存只统计已经结束的子进程，进程池与预加载进程在返回前均已结束
+    parent_cpu = (cpu1.user - cpu0.user) + (cpu1.system - cpu0.system)
+    children_cpu = (cpu1.children_user - cpu0.children_user) + (cpu1.children_system - cpu0.children_system)
+    result = dict(config)
+    result.update({
+        'lines': n_lines,
+        'seconds': elapsed,
+        'lines_per_sec': n_lines / elapsed,
+        'mb_per_sec': os.path.getsize(input_file_name) / 1e6 / elapsed,
+        'parent_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'parent_cpu_share': parent_cpu / max(parent_cpu + children_cpu, 1e-9),
+    })
+    result_queue.put(result)
+
+
+def _failed_result(config, error):
+    """
+    :return: 失败配置的结果dict，只包括配置与错误信息
+    """
+    result = dict(config)
+    result['error'] = error
+    return result
+
+
+def _wait_result(p, result_queue, config, timeout=None, poll_interval=1.0):
+    """
+    等待子进程传回测试结果。子进程异常退出或超时时，返回失败的结果
+    :param p: 运行测试配置的子进程
+    :param timeout: 最长等待的秒数，为None时不限制
+    :return: 结果dict
+    """
+    t0 = time.time()
+    while True:
+        try:
+            return result_queue.get(timeout=poll_interval)
+        except queue.Empty:
+            pass
+        if not p.is_alive():
+            # 子进程退出前传回的结果可能刚刚到达
+            try:
+                return result_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                return _failed_result(config, '子进程异常退出，exitcode={}'.format(p.exitcode))
+        if timeout is not None and time.time() - t0 > timeout:
+            p.terminate()
+            return _failed_result(config, '超过{}秒未完成'.format(timeout))
+
+
+def iter_configs(n_jobs=(1, 2, 4), chunk_size=(100, 1000), order=(True, False), read_mode=('loader',),
+                 loader_modes=(True, False)):
+    """
+    生成测试配置。ChunkLoader的同步与异步方式单独测试，只读取数据不做处理
+    :return: 配置dict的生成器
+    """
+    for use_async, size in itertools.product(loader_modes, chunk_size):
+        yield {'target': 'loader', 'use_async': use_async, 'n_jobs': 0, 'chunk_size': size, 'order': True,
+               'read_mode': 'loader'}
+    for jobs, size, ordered, mode in itertools.product(n_jobs, chunk_size, order, read_mode):
+        yield {'target': 'run_row', 'use_async': True, 'n_jobs': jobs, 'chunk_size': size, 'order': ordered,
+               'read_mode': mode}
+
+
+def run_benchmark(input_file_name, configs, repeat=1, timeout=None):
+    """
+    依次运行各个测试配置。每个配置在独立的子进程中运行repeat次，取用时最短的一次
+    :param input_file_name: 输入文件名
+    :param configs: 测试配置的迭代器，参见iter_configs
+    :param repeat: 每个配置的重复次数
+    :param timeout: 每次运行最长的秒数，超时的配置记录为失败。为None时不限制
+    :return: 结果dict的List。失败的配置只包括配置与error
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='benchmark_')
+    output_file_name = os.path.join(tmp_dir, 'out.txt')
+    results = []
+    try:
+        for config in configs:
+            best = None
+            for i in range(repeat):
+                result_queue = Queue()
+                p = Process(target=_run_config, args=(config, input_file_name, output_file_name, result_queue))
+                p.start()
+                result = _wait_result(p, result_queue, config, timeout)
+                p.join()
+                if 'error' in result:
+                    # 出错的配置不再重复
+                    best = result
+                    break
+                if best is None or result['seconds'] < best['seconds']:
+                    best = result
+            results.append(best)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def format_table(results):
+    """
+    将测试结果格式化为文本表格
+    :param results: run_benchmark的结果
+    :return: str
+    """
+    columns = [('target', '{}'), ('use_async', '{}'), ('n_jobs', '{}'), ('chunk_size', '{}'), ('order', '{}'),
+               ('read_mode', '{}'), ('lines_per_sec', '{:.0f}'), ('mb_per_sec', '{:.2f}'),
+               ('parent_peak_rss_mb', '{:.1f}'), ('children_peak_rss_mb', '{:.1f}'), ('parent_cpu_share', '{:.1%}')]
+    rows = [[name for name, _ in columns]]
+    for result in results:
+        rows.append([fmt.format(result[name]) if name in result else '-' for name, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    table = '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+    # 失败的配置在表格之后列出错误信息
+    errors = ['第{}项失败: {}'.format(i + 1, result['error']) for i, result in enumerate(results) if 'error' in result]
+    return '\n'.join([table] + errors)
+
+
+def main(argv=None):
+    def int_list(s):
+        return [int(v) for v in s.split(',')]
+
+    def bool_list(s):
+        return [v.strip().lower() in ('1', 'true', 'yes') for v in s.split(',')]
+
+    parser = argparse.ArgumentParser(description='ChunkLoader与run_row的性能测试')
+    parser.add_argument('--input', default=None, help='输入文件，默认生成模拟VCF文件')
+    parser.add_argument('--rows', type=int, default=100000, help='模拟VCF文件的行数')
+    parser.add_argument('--samples', type=int, default=100, help='模拟VCF文件的样本数')
+    parser.add_argument('--compress', choices=['none', 'gzip', 'bgzf'], default='none', help='模拟VCF文件的压缩方式')
+    parser.add_argument('--n-jobs', type=int_list, default=[1, 2, 4])
+    parser.add_argument('--chunk-size', type=int_list, default=[100, 1000])
+    parser.add_argument('--order', type=bool_list, default=[True, False])
+    parser.add_argument('--read-mode', default='loader', help="以逗号分隔，例如'loader,mmap,shard'")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=None, help='每次运行最长的秒数，超时的配置记录为失败')
+    parser.add_argument('--json', default=None, help='将结果以JSON格式写入文件')
+    args = parser.parse_args(argv)
+
+    tmp_dir = None
+    input_file_name = args.input
+    if input_file_name is None:
+        tmp_dir = tempfile.mkdtemp(prefix='benchmark_input_')
+        compress = None if args.compress == 'none' else args.compress
+        input_file_name = os.path.join(tmp_dir, 'bench.vcf' + ('.gz' if compress else ''))
+        make_vcf(input_file_name, args.rows, args.samples, compress)
+
+    try:
+        configs = iter_configs(args.n_jobs, args.chunk_size, args.order, args.read_mode.split(','))
+        results = run_benchmark(input_file_name, configs, args.repeat, args.timeout)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(format_table(results))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+BGZF(block gzip)文件的并行读取与压缩。
+
+BGZF是htslib使用的压缩格式，文件由许多独立的gzip块组成，每个块解压后不超过64K。块之间互不依赖，因此可以按块划分任务，
+交给多个进程同时解压。普通的gzip文件只能单线程顺序解压，这里只对BGZF文件生效。
+
+块的边界优先从.gzi索引文件中获得，没有索引时，通过逐个读取块头部的BSIZE字段得到。
+
+压缩时，每段数据独立压缩为若干个完整的BGZF块，因此各个进程压缩得到的数据可以直接按顺序拼接，拼接结果仍然是合法的BGZF文件，
+可以被tabix建立索引。文件的末尾需要写入BGZF_EOF作为结束标志。
+
+"""
+
+from collections import deque
+from multiprocessing import Pool
+import io
+import os
+import struct
+import zlib
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'  # gzip头部，并带有FEXTRA标志
+BGZF_HEADER_SIZE = 18  # 标准BGZF块头部的长度
+BGZF_BLOCK_DATA_SIZE = 0xff00  # 每个块压缩前数据的最大长度，与htslib保持一致
+# BGZF文件结束标志，是一个不含数据的空块
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def _read_block_size(header):
+    """
+    从块头部中解析出整个块的长度
+    :param header: 块开头的字节数据，至少包含完整的gzip头部与extra字段
+    :return: 块的总长度，如果不是BGZF块则返回None
+    """
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        return None
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+
+    # 在extra字段中查找'BC'子字段
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = extra[pos], extra[pos + 1], struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return struct.unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        pos += 4 + slen
+    return None
+
+
+def is_bgzf(fname):
+    """
+    判断文件是否为BGZF格式
+    :param fname: 文件名
+    :return: True代表是BGZF文件
+    """
+    with open(fname, 'rb') as f:
+        header = f.read(BGZF_HEADER_SIZE + 64)
+    return _read_block_size(header) is not None
+
+
+def read_gzi(gzi_file_name):
+    """
+    读取htslib生成的.gzi索引文件
+    :param gzi_file_name: 索引文件名
+    :return: 各块的压缩数据起始位置List，不包括位置为0的第一个块
+    """
+    with open(gzi_file_name, 'rb') as f:
+        n = struct.unpack('<Q', f.read(8))[0]
+        data = f.read(16 * n)
+    return [struct.unpack_from('<Q', data, 16 * i)[0] for i in range(n)]
+
+
+def bgzf_block_offsets(fname):
+    """
+    得到BGZF文件中各个块的起始位置。如果存在fname+'.gzi'索引文件，则直接读取索引，否则逐个读取块的头部
+    :param fname: BGZF文件名
+    :return: 各块起始位置的List，最后附加文件大小作为结束位置
+    """
+    file_size = os.path.getsize(fname)
+    gzi_file_name = fname + '.gzi'
+    if os.path.exists(gzi_file_name) and os.path.getmtime(gzi_file_name) >= os.path.getmtime(fname):
+        offsets = [0] + read_gzi(gzi_file_name)
+        offsets.append(file_size)
+        return offsets
+
+    offsets = []
+    pos = 0
+    with open(fname, 'rb') as f:
+        while pos < file_size:
+            f.seek(pos)
+            block_size = _read_block_size(f.read(BGZF_HEADER_SIZE + 64))
+            assert block_size is not None, "文件:{}在位置{}处不是BGZF块".format(fname, pos)
+            offsets.append(pos)
+            pos += block_size
+    offsets.append(file_size)
+    return offsets
+
+
+def inflate_range(args):
+    """
+    解压文件中一段连续的BGZF块，供进程池调用
+    :param args: (fname, start, end)，字节范围必须对齐到块的边界
+    :return: 解压后的数据
+    """
+    fname, start, end = args
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+
+    ret = []
+    while len(buf) > 0:
+        d = zlib.decompressobj(31)
+        ret.append(d.decompress(buf))
+        buf = d.unused_data
+    return b''.join(ret)
+
+
+def compress_block(data, level=6):
+    """
+    将数据压缩为一个BGZF块
+    :param data: 待压缩的数据，长度不能超过BGZF_BLOCK_DATA_SIZE
+    :param level: 压缩等级
+    :return: 压缩得到的块
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    # 头部18字节 + 压缩数据 + CRC32与原始长度共8字节，BSIZE记录的是块长度减1
+    header = BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', len(cdata) + 25)
+    return header + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def compress_bgzf(data, level=6):
+    """
+    将一段数据压缩为若干个BGZF块。结果不包含BGZF_EOF，可以与其他压缩结果直接拼接
+    :param data: 待压缩的数据
+    :param level: 压缩等级
+    :return: 压缩得到的数据，data为空时返回b''
+    """
+    ret = []
+    for i in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+        ret.append(compress_block(data[i:i + BGZF_BLOCK_DATA_SIZE], level))
+    return b''.join(ret)
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    BGZF文件的并行解压读取器。按顺序返回解压后的字节流，因此跨块的行会自然地拼接在一起。
+    可以通过io.BufferedReader、io.TextIOWrapper包装后按行读取
+
+    进程池在第一次读取时才创建，因此可以在主进程中构造本对象后，交给其他进程读取。
+    已经读取过的对象被fork到子进程后，子进程会创建自己的进程池，并重新提交在途的解压任务
+    """
+
+    def __init__(self, fname, n_jobs=4, blocks_per_task=64) -> None:
+        """
+        :param fname: BGZF文件名
+        :param n_jobs: 解压使用的进程数
+        :param blocks_per_task: 每个解压任务包含的块数。BGZF块解压后不超过64K，默认一个任务约4M
+        """
+        super().__init__()
+        self.fname = fname
+        self.n_jobs = n_jobs
+        self.blocks_per_task = blocks_per_task
+
+        self.__tasks = None  # 解压任务的迭代器
+        self.__pool = None
+        self.__pool_pid = None  # 创建进程池的进程号
+        self.__inflight = deque()  # 在途的解压任务(task, AsyncResult)，按照块的顺序排列
+        self.__buf = b''  # 当前已经解压，等待读取的数据
+        self.__buf_pos = 0
+        self.__compressed_pos = 0  # 已经取出的压缩数据的结束位置
+
+    def __iter_tasks(self):
+        offsets = bgzf_block_offsets(self.fname)
+        for i in range(0, len(offsets) - 1, self.blocks_per_task):
+            end = min(i + self.blocks_per_task, len(offsets) - 1)
+            yield self.fname, offsets[i], offsets[end]
+
+    def __fill(self):
+        """
+        补充解压任务，并取出下一段解压好的数据
+        :return: False代表数据已经全部读完
+        """
+        if self.__tasks is None:
+            self.__tasks = self.__iter_tasks()
+            self.__pool = Pool(self.n_jobs)
+            self.__pool_pid = os.getpid()
+        elif self.__pool_pid != os.getpid():
+            # 进程池属于父进程，在子进程中无法取回结果，重新创建进程池并提交在途的任务
+            self.__pool = Pool(self.n_jobs)
+            self.__pool_pid = os.getpid()
+            self.__inflight = deque((task, self.__pool.apply_async(inflate_range, (task,)))
+                                    for task, _ in self.__inflight)
+
+        # 在途任务保持在2*n_jobs个，避免解压速度超过读取速度时占用过多内存
+        while len(self.__inflight) < 2 * self.n_jobs:
+            task = next(self.__tasks, None)
+            if task is None:
+                break
+            self.__inflight.append((task, self.__pool.apply_async(inflate_range, (task,))))
+
+        if len(self.__inflight) == 0:
+            return False
+        task, res = self.__inflight.popleft()
+        self.__buf = res.get()
+        self.__compressed_pos = task[2]
+        self.__buf_pos = 0
+        return True
+
+    def compressed_tell(self):
+        """
+        :return: 已经读取到的压缩文件位置，用于按照磁盘上的字节数展示进度
+        """
+        return self.__compressed_pos
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.__buf_pos >= len(self.__buf):
+            if not self.__fill():
+                return 0
+
+        n = min(len(b), len(self.__buf) - self.__buf_pos)
+        b[:n] = self.__buf[self.__buf_pos:self.__buf_pos + n]
+        self.__buf_pos += n
+        return n
+
+    def close(self):
+        if self.__pool is not None:
+            # 从父进程继承的进程池由父进程关闭
+            if self.__pool_pid == os.getpid():
+                self.__pool.terminate()
+                self.__pool.join()
+            self.__pool = None
+        super().close()
+
+
+def open_bgzf(fname, mode='rt', n_jobs=4):
+    """
+    以并行解压的方式打开BGZF文件
+    :param fname: BGZF文件名
+    :param mode: 'rt'返回文本文件对象，'rb'返回二进制文件对象
+    :param n_jobs: 解压使用的进程数
+    :return: 文件对象
+    """
+    assert mode in ('rt', 'rb'), "不支持的打开方式:{}".format(mode)
+    f = io.BufferedReader(BgzfReader(fname, n_jobs=n_jobs), buffer_size=1024 * 1024)
+    if mode == 'rb':
+        return f
+    return io.TextIOWrapper(f)
@@ -5,15 +5,67 @@
 
 同时通过工作线程预加载的方式，在顺序读写情况下，提升数据的访问效率。
 
-todo 提升随即访问的效率
+PList通过偏移量索引和LRU页缓存，支持对磁盘中数据的随机访问。
 
 """
 
-from multiprocessing import Queue
+from array import array
+from collections import deque, OrderedDict
+from itertools import accumulate, islice
+import pickle
+import struct
+import sys
+import threading
 import time
 import os
 
 
+def _item_size(data):
+    """
+    估计数据占用的内存大小，str与bytes按照长度计算
+    :param data: 数据
+    :return: 字节数
+    """
+    if isinstance(data, (str, bytes, bytearray)):
+        return len(data)
+    return sys.getsizeof(data)
+
+
+def _write_segment(fname, items):
+    """
+    将数据写入磁盘分段文件。每条数据的结构为[长度(u32)][pickle数据]
+    :param fname: 分段文件名
+    :param items: 数据的迭代器
+    :return:
+    """
+    with open(fname, 'wb', buffering=1024 * 1024) as f:
+        for item in items:
+            buf = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(struct.pack('<I', len(buf)))
+            f.write(buf)
+
+
+def _read_segment(fname):
+    """
+    读取磁盘分段文件中的全部数据，读取完毕后删除该文件
+    :param fname: 分段文件名
+    :return: (数据的deque, 数据占用的内存大小)
+    """
+    ret = deque()
+    mem = 0
+    with open(fname, 'rb') as f:
+        buf = f.read()
+    pos = 0
+    while pos < len(buf):
+        n = struct.unpack_from('<I', buf, pos)[0]
+        item = pickle.loads(buf[pos + 4:pos + 4 + n])
+        ret.append(item)
+        mem += _item_size(item)
+        pos += 4 + n
+    os.remove(fname)
+    return ret, mem
+
+
 class PQueue:
     """
     PQueue的作用是面对特大数据时，能够在固定内存使用上限的情况下实现对数据的顺序访问。
@@ -21,6 +73,10 @@ class PQueue:
     建议使用的类型为：str、int、float这种
 
     不建议在Queue中嵌入不同类型的数据，同时用list、dict,tuple包装的数据也不能放入本队列
+
+    内存中的数据分为两部分：写缓冲存放最新压入的数据，读缓冲存放即将取出的数据，两者各占mem_limit的一半。
+    写缓冲满时，其中较早的一半数据会写入磁盘分段文件；读缓冲取空时，从最早的分段文件中重新加载数据。
+    开启预加载时，后台线程会在读缓冲被取空之前把下一个分段读入内存。数据始终按照压入的顺序取出
     """
 
     def __init__(self, mem_limit=10 * 1024 * 1024, cache_dir='tmp', sync=True) -> None:
@@ -28,51 +84,114 @@ class PQueue:
         超大List的预加载和处理
         :param mem_limit: 该List占用mem的上限，单位为bytes
         :param cache_dir: 缓存文件存放的位置，是目录。一旦数据量超过mem_limit的时候，则会创建文件清空内存
-        :param sync: 这个是磁盘加载的同步版本，会启动另一个进程处理该任务。如果内存中的数据已经被用尽了，则会重新到磁盘中加载数据
+        :param sync: 是否启动后台线程，预先把下一个磁盘分段加载到内存中。为False时，读缓冲取空后才同步地从磁盘加载数据
         """
         super().__init__()
-        self.mem_limit_b = mem_limit * 1024 * 1024  # 这里转化为字节单位
+        self.mem_limit_b = mem_limit  # 内存上限，单位为bytes
         self.mem_used = 0  # 已经使用过的内存大小
+        self.sync = sync
 
         # 私有变量
-        self.__c_index = 0  # 当前读取的元素位置
-        self.__queue = Queue()  # 这个队列不限容量，需要其他程序配合处理
-        self.__queue_mem_used = 0  # 队列使用的容量
+        self.__head = deque()  # 读缓冲，存放最早的数据
+        self.__head_mem_used = 0
+        self.__tail = deque()  # 写缓冲，存放最新压入的数据
+        self.__tail_mem_used = 0
+        self.__segments = deque()  # 磁盘分段文件，按照数据的先后排列
+        self.__segment_num = 0
+        self.__co_worker = None  # 协助任务处理对象，用完即销毁。结构为(线程, 存放加载结果的List)
+        self.__mem_lock = threading.Lock()  # 后台线程与主线程都会修改mem_used
+        self.__length = 0
+        self.__done = False
         self.use_disk_cache = False  # 是否使用了文件缓存数据
-        self.__disk_cache = None  # 本对象使用的磁盘cache对象
-        self.__co_worker = None  # 协助任务处理对象，用完即销毁
         self.cache_dir = cache_dir  # 缓存目录
-        self.cache_file_name = cache_dir + '/' + 'plist_' + str(time.time())  # 缓存文件路径
+        self.cache_file_name = os.path.join(cache_dir, 'pqueue_{}_{}'.format(os.getpid(), time.time()))  # 缓存文件路径前缀
 
     def __del__(self):
         """
         析构函数，这里处理一下缓存文件的问题
         :return:
         """
+        if self.__co_worker is not None:
+            self.__co_worker[0].join()
+            self.__co_worker = None
+
         # 删除缓存文件
-        os.remove(self.cache_file_name)
+        for fname in self.__segments:
+            if os.path.exists(fname):
+                os.remove(fname)
+        self.__segments.clear()
 
         # 尝试删除缓存目录
-        if len(os.listdir(self.cache_dir)) is 0:
+        if self.use_disk_cache and os.path.exists(self.cache_dir) and len(os.listdir(self.cache_dir)) == 0:
             try:
-                os.removedirs(self.cache_dir)
-            except:
+                os.rmdir(self.cache_dir)
+            except OSError:
                 return
 
+    def __len__(self):
+        return self.__length
+
     def __load_buffer(self):
         """
-        用于加载RAM缓冲区
+        用于加载RAM缓冲区。优先使用后台线程已经加载好的分段，随后启动后台线程预加载下一个分段
         :return:
         """
+        if self.__co_worker is not None:
+            thread, result = self.__co_worker
+            thread.join()
+            self.__co_worker = None
+            # 预加载的分段在加载时已经计入mem_used，这里只是转为读缓冲
+            self.__head, self.__head_mem_used = result[0]
+        else:
+            self.__head, self.__head_mem_used = _read_segment(self.__segments.popleft())
+            self.__add_mem(self.__head_mem_used)
 
-    def ___unload_buffer(self):
+        if self.sync and len(self.__segments) > 0:
+            self.__cowork_disk2ram()
+
+    def __add_mem(self, size):
+        with self.__mem_lock:
+            self.mem_used += size
+
+    def ___unload_buffer(self, n):
         """
-        用于卸载缓冲区，减少内存的占用
+        用于卸载缓冲区，减少内存的占用。将写缓冲中最早的n条数据写入一个新的磁盘分段
+        :param n: 写入磁盘的数据条数
         :return:
         """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.use_disk_cache = True
+
+        items = []
+        for i in range(n):
+            item = self.__tail.popleft()
+            size = _item_size(item)
+            self.__tail_mem_used -= size
+            self.__add_mem(-size)
+            items.append(item)
+
+        fname = '{}_{}'.format(self.cache_file_name, self.__segment_num)
+        self.__segment_num += 1
+        _write_segment(fname, items)
+        self.__segments.append(fname)
 
     def __cowork_disk2ram(self):
+        """
+        启动后台线程，把最早的磁盘分段读入内存。预加载的数据计入内存使用量
+        :return:
+        """
+        fname = self.__segments.popleft()
+        result = []
 
+        def load():
+            segment = _read_segment(fname)
+            self.__add_mem(segment[1])
+            result.append(segment)
+
+        thread = threading.Thread(target=load, name='co_thread@pqueue', daemon=True)
+        thread.start()
+        self.__co_worker = (thread, result)
         return self
 
     def put(self, data):
@@ -81,60 +200,50 @@ class PQueue:
         :param data:
         :return:
         """
+        size = _item_size(data)
 
-        # 检测内存数据是否存放满了
-        if self.mem_used + len(data) > self.mem_limit_b:
-            print("内存已经占满，准备迁移数据")
-            if not os.path.exists(self.cache_file_name):
-                if not os.path.exists(self.cache_dir):
-                    os.mkdir(self.cache_dir)
-                self.cache_file = open(self.cache_file_name, 'w')
-
-            # 将queue中一半的数据写入磁盘
-            for i in range(int(self.__queue.qsize() / 2)):
-                item = self.__queue.get()
-                self.mem_used -= len(item)
-                self.cache_file.write('{}/n'.format(item))
+        # 检测写缓冲是否存放满了，将写缓冲中较早的一半数据写入磁盘。预加载的分段占用内存时，写缓冲相应地提前写入磁盘
+        if (self.__tail_mem_used + size > self.mem_limit_b // 2 or self.mem_used + size > self.mem_limit_b) and \
+                len(self.__tail) > 0:
+            self.___unload_buffer(max(len(self.__tail) // 2, 1))
 
         # 压入数据，并更新内存使用量
-        self.__queue.put(data)
-        self.mem_used += len(data)
+        self.__tail.append(data)
+        self.__tail_mem_used += size
+        self.__add_mem(size)
+        self.__length += 1
 
     def put_done(self):
         """
         是一个信号，代表数据已经全部压入，下一步是将RAM中的数据全部清空，写入到磁盘中。
         :return:
         """
-        self.__queue.put(None)  # 这里代表数据压入结束
-        self.mem_used = 0
-
-        while True:
-            item = self.__queue.get()
-            if item is None:
-                break
-            self.cache_file.write('{}/n'.format(item))
-        self.cache_file.close()
+        self.__done = True
+        if self.use_disk_cache and len(self.__tail) > 0:
+            self.___unload_buffer(len(self.__tail))
 
     def get(self):
         """
         获取队头的数据
-        :return:
+        :return: 队头的数据。如果队列为空，返回None
         """
-        ret = None  # 要返回的数据
-
-        if self.use_disk_cache:
-            # 使用了磁盘缓存
-            print("从磁盘中重新加载数据")
-
-            if self.cache_file.closed:
-                self.cache_file = open(self.cache_file_name, 'r')
-
-
-
-
-        else:
-            ret = self.__queue.get()
-
+        if len(self.__head) == 0:
+            if self.__co_worker is not None or len(self.__segments) > 0:
+                # 使用了磁盘缓存
+                self.__load_buffer()
+            else:
+                # 磁盘中没有数据，读缓冲与写缓冲相接
+                self.__head, self.__tail = self.__tail, self.__head
+                self.__head_mem_used, self.__tail_mem_used = self.__tail_mem_used, self.__head_mem_used
+
+        if len(self.__head) == 0:
+            return None
+
+        ret = self.__head.popleft()
+        size = _item_size(ret)
+        self.__head_mem_used -= size
+        self.__add_mem(-size)
+        self.__length -= 1
         return ret
 
     def __iter__(self):
@@ -142,30 +251,264 @@ class PQueue:
         先设置一些初始化参数，然后返回迭代器对象，也就是拥有__next__方法的自己
         :return:
         """
-        self.__c_index = 0
-        if self.use_disk_cache:
-            print("从新把磁盘中的数据加载到ram，然后开始迭代")
-
         return self
 
     def __next__(self):
         """
-        迭代器部分，用于遍历全部的数据
+        迭代器部分，按顺序取出全部的数据
         :return:
         """
+        if self.__length == 0:
+            raise StopIteration
         return self.get()
 
 
+def _encode_record(item):
+    """
+    将一条数据编码为字节。str与bytes只附加1字节的类型标记，其他类型使用pickle
+    :param item: 数据
+    :return: 编码后的字节
+    """
+    if isinstance(item, str):
+        return b'S' + item.encode()
+    if isinstance(item, bytes):
+        return b'B' + item
+    return b'P' + pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _decode_record(buf):
+    """
+    _encode_record的逆过程
+    :param buf: 编码后的字节
+    :return: 数据
+    """
+    tag = buf[:1]
+    if tag == b'S':
+        return bytes(buf[1:]).decode()
+    if tag == b'B':
+        return bytes(buf[1:])
+    return pickle.loads(buf[1:])
+
+
+def encode_records(items):
+    """
+    将多条数据编码为一段连续的字节数据，可以在工作进程中完成，结果通过PList.extend_encoded一次追加
+    :param items: 数据的迭代器
+    :return: (编码后的字节数据, 各条记录的长度array('Q'))
+    """
+    records = [_encode_record(item) for item in items]
+    return b''.join(records), array('Q', map(len, records))
+
+
 class PList:
     """
     容纳超过100G数据的List
+
+    数据以追加的方式写入，所有记录依次排列在一段逻辑上连续的字节流中，通过array('Q')记录每条记录的起始位置，
+    因此每条记录只额外占用8字节的索引。字节流的末尾部分保存在内存的写缓冲中，写缓冲超过mem_limit时写入磁盘分段文件，
+    每个分段文件保存字节流中固定长度的一段。
+
+    随机访问时按页读取磁盘数据，读取过的页放入LRU页缓存，缓存的总大小不超过cache_size。
+    通过下标访问第i条记录只需要查询索引并读取对应的页，与记录的数量无关
     """
 
-    def __init__(self) -> None:
+    def __init__(self, mem_limit=16 * 1024 * 1024, cache_dir='tmp', cache_size=64 * 1024 * 1024,
+                 page_size=64 * 1024, segment_size=256 * 1024 * 1024) -> None:
+        """
+        :param mem_limit: 写缓冲的上限，单位为bytes。数据总量不超过该值时，全部数据都保存在内存中
+        :param cache_dir: 磁盘分段文件存放的目录
+        :param cache_size: 页缓存的上限，单位为bytes
+        :param page_size: 页的大小，单位为bytes
+        :param segment_size: 每个磁盘分段文件的大小，必须是page_size的整数倍
+        """
         super().__init__()
+        assert segment_size % page_size == 0, "segment_size必须是page_size的整数倍"
+        self.mem_limit_b = mem_limit
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self.segment_size = segment_size
+        self.cache_file_name = os.path.join(cache_dir, 'plist_{}_{}'.format(os.getpid(), time.time()))
+        self.use_disk_cache = False
+
+        self.__offsets = array('Q', [0])  # 各条记录的起始位置，最后一项为字节流的总长度
+        self.__buf = bytearray()  # 写缓冲，保存字节流中[__flushed, 总长度)的部分
+        self.__flushed = 0  # 已经写入磁盘的字节数
+        self.__segment_files = {}  # 分段编号对应的文件对象
+        self.__pages = OrderedDict()  # LRU页缓存，页号对应页数据
+        self.__pages_size = 0
 
-    def __iter__(self):
-        return self
+    def __del__(self):
+        self.close()
 
-    def __next__(self):
-        return
+    def close(self):
+        """
+        关闭并删除磁盘分段文件
+        :return:
+        """
+        for f in self.__segment_files.values():
+            f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+        self.__segment_files = {}
+        self.__pages.clear()
+        self.__pages_size = 0
+
+        # 尝试删除缓存目录，上级目录保持不变
+        if self.use_disk_cache and os.path.exists(self.cache_dir) and len(os.listdir(self.cache_dir)) == 0:
+            try:
+                os.rmdir(self.cache_dir)
+            except OSError:
+                return
+
+    def __segment_file(self, seg):
+        f = self.__segment_files.get(seg)
+        if f is None:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.use_disk_cache = True
+            f = open('{}_{}'.format(self.cache_file_name, seg), 'w+b')
+            self.__segment_files[seg] = f
+        return f
+
+    def flush(self):
+        """
+        将写缓冲中的数据写入磁盘分段文件
+        :return:
+        """
+        pos = self.__flushed
+        view = memoryview(self.__buf)
+        while len(view) > 0:
+            seg, seg_pos = divmod(pos, self.segment_size)
+            n = min(len(view), self.segment_size - seg_pos)
+            f = self.__segment_file(seg)
+            f.seek(seg_pos)
+            f.write(view[:n])
+            f.flush()
+            view = view[n:]
+            pos += n
+        view.release()
+
+        # 原先最后一页只写入了一部分，缓存中的该页已经过期
+        last_page = self.__flushed // self.page_size
+        if last_page in self.__pages:
+            self.__pages_size -= len(self.__pages.pop(last_page))
+
+        self.__flushed = pos
+        self.__buf = bytearray()
+
+    def __read_page(self, page):
+        """
+        通过LRU页缓存读取一页已经写入磁盘的数据
+        :param page: 页号
+        :return: 页数据
+        """
+        data = self.__pages.get(page)
+        if data is not None:
+            self.__pages.move_to_end(page)
+            return data
+
+        pos = page * self.page_size
+        seg, seg_pos = divmod(pos, self.segment_size)
+        f = self.__segment_files[seg]
+        f.seek(seg_pos)
+        data = f.read(min(self.page_size, self.__flushed - pos))
+
+        self.__pages[page] = data
+        self.__pages_size += len(data)
+        while self.__pages_size > self.cache_size and len(self.__pages) > 1:
+            self.__pages_size -= len(self.__pages.popitem(last=False)[1])
+        return data
+
+    def __read_bytes(self, start, end):
+        """
+        读取字节流中[start, end)范围内的数据
+        :return: bytes
+        """
+        ret = []
+        if start < self.__flushed:
+            disk_end = min(end, self.__flushed)
+            for page in range(start // self.page_size, (disk_end - 1) // self.page_size + 1):
+                page_pos = page * self.page_size
+                data = self.__read_page(page)
+                ret.append(data[max(start - page_pos, 0):disk_end - page_pos])
+            start = disk_end
+        if start < end:
+            ret.append(bytes(self.__buf[start - self.__flushed:end - self.__flushed]))
+        if len(ret) == 1:
+            return ret[0]
+        return b''.join(ret)
+
+    def append(self, item):
+        """
+        在末尾追加一条记录
+        :param item: 记录，可以是str、bytes或其他可以pickle的数据
+        :return:
+        """
+        self.__buf += _encode_record(item)
+        self.__offsets.append(self.__flushed + len(self.__buf))
+        if len(self.__buf) > self.mem_limit_b:
+            self.flush()
+
+    def extend(self, items):
+        """
+        在末尾依次追加多条记录
+        :param items: 记录的迭代器
+        :return:
+        """
+        for item in items:
+            self.append(item)
+
+    def extend_encoded(self, buf, lengths):
+        """
+        在末尾追加一批已经编码的记录，只需要一次拷贝，不需要逐条编码
+        :param buf: encode_records得到的字节数据
+        :param lengths: 各条记录的长度
+        :return:
+        """
+        self.__offsets.extend(islice(accumulate(lengths, initial=self.__flushed + len(self.__buf)), 1, None))
+        self.__buf += buf
+        if len(self.__buf) > self.mem_limit_b:
+            self.flush()
+
+    def nbytes(self):
+        """
+        :return: 全部记录编码后的总字节数
+        """
+        return self.__offsets[-1]
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if start >= stop:
+                return []
+
+            # 连续的记录一次读出，再按照索引切分
+            base = self.__offsets[start]
+            buf = memoryview(self.__read_bytes(base, self.__offsets[stop]))
+            return [_decode_record(buf[self.__offsets[i] - base:self.__offsets[i + 1] - base])
+                    for i in range(start, stop)]
+
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError("PList的下标越界")
+        return _decode_record(self.__read_bytes(self.__offsets[item], self.__offsets[item + 1]))
+
+    def __eq__(self, other):
+        # 与List一样按元素比较
+        if not isinstance(other, (PList, list, tuple)) or len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __iter__(self):
+        # 按批读取，顺序遍历时每一页只需要读取一次
+        batch = 1024
+        for i in range(0, len(self), batch):
+            for item in self[i:i + batch]:
+                yield item
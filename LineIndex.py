@@ -0,0 +1,357 @@
+"""
+文本文件的行索引。
+
+统计大文件的行数时，把文件按字节范围切分，由多个进程通过mmap映射文件，用bytes.count并行统计换行符。
+统计的同时，每隔step行记录一次该行在文件中的字节位置，得到稀疏的行偏移索引，索引保存在与数据文件同目录的'.lidx'文件中。
+
+索引文件中记录了数据文件的大小和修改时间，数据文件没有变化时直接读取索引，不需要再次扫描文件。
+通过索引可以：
+    1. 直接得到文件的总行数，用于准确地展示处理进度；
+    2. 从最近的索引点开始读取，快速定位到第N行；
+    3. 按照行数把文件均匀地切分为多个分片。
+
+gzip文件无法随机访问，只记录总行数。BGZF文件按块并行解压统计行数。
+
+"""
+
+from array import array
+from bisect import bisect_right
+from multiprocessing import Pool
+import gzip
+import mmap
+import os
+import struct
+import Bgzf
+
+LINE_INDEX_MAGIC = b'LIDX'
+LINE_INDEX_VERSION = 1
+# 索引文件头部：magic, version, 数据文件大小, 修改时间(ns), step, 总行数, 索引点数量
+_HEADER = struct.Struct('<4sIQQQQQ')
+
+
+def index_file_name(fname):
+    """
+    :param fname: 数据文件名
+    :return: 对应的索引文件名
+    """
+    return fname + '.lidx'
+
+
+def _file_key(fname):
+    """
+    数据文件的标识，文件大小或修改时间变化时，索引失效
+    :return: (文件大小, 修改时间ns)
+    """
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime_ns
+
+
+def _aligned_ranges(fname, range_size):
+    """
+    将未压缩的文件按字节范围切分，每个范围的起始位置都对齐到行首
+    :param fname: 文件名
+    :param range_size: 每个范围的近似字节数
+    :return: [(start, end), ...]
+    """
+    file_size = os.path.getsize(fname)
+    if file_size == 0:
+        return []
+
+    ranges = []
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    start = 0
+    while start < file_size:
+        end = start + range_size
+        if end >= file_size:
+            end = file_size
+        else:
+            end = mm.find(b'\n', end - 1) + 1
+            if end == 0:
+                end = file_size
+        ranges.append((start, end))
+        start = end
+    mm.close()
+    return ranges
+
+
+_SUB_BLOCK = 64 * 1024  # 定位索引点时统计换行符的小块大小
+
+
+def _skip_lines(buf, lo, hi, n):
+    """
+    从lo开始跳过n个换行符。换行符较多时通过bytes.count二分查找，不逐行查找
+    :param buf: 字节数据
+    :param lo: 起始位置
+    :param hi: 结束位置，buf[lo:hi]中至少有n个换行符
+    :param n: 需要跳过的换行符数量，大于0
+    :return: 第n个换行符之后的位置
+    """
+    while n > 16 and hi - lo > 1024:
+        mid = (lo + hi) // 2
+        count = buf.count(b'\n', lo, mid)
+        if count >= n:
+            hi = mid
+        else:
+            n -= count
+            lo = mid
+    for i in range(n):
+        lo = buf.find(b'\n', lo) + 1
+    return lo
+
+
+def _index_range(args):
+    """
+    统计文件某个字节范围内的行数，并记录范围内第0, step, 2*step, ...行的起始位置，供进程池调用
+    :param args: (fname, start, end, step)，start必须对齐到行首
+    :return: (行数, [(范围内的行号, 字节位置), ...])
+    """
+    fname, start, end, step = args
+    block_size = 4 * 1024 * 1024
+    points = [(0, start)]
+    n_lines = 0
+    target = step  # 下一个需要记录的行号
+
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    pos = start
+    while pos < end:
+        block_end = min(pos + block_size, end)
+        buf = mm[pos:block_end]
+
+        # 按小块统计换行符，只在包含索引点的小块中查找对应的换行符
+        for sub_start in range(0, len(buf), _SUB_BLOCK):
+            sub_end = min(sub_start + _SUB_BLOCK, len(buf))
+            count = buf.count(b'\n', sub_start, sub_end)
+            find_pos = sub_start
+            while n_lines + count >= target:
+                find_pos = _skip_lines(buf, find_pos, sub_end, target - n_lines)
+                count -= target - n_lines
+                n_lines = target
+                if pos + find_pos < end:
+                    points.append((n_lines, pos + find_pos))
+                target += step
+            n_lines += count
+        pos = block_end
+
+    # 最后一行可能没有换行符
+    if end > start and mm[end - 1:end] != b'\n':
+        n_lines += 1
+    mm.close()
+    return n_lines, points
+
+
+def _count_bgzf_range(args):
+    """
+    统计BGZF文件中一段连续块解压后的换行符数量，供进程池调用
+    :param args: (fname, start, end)
+    :return: (换行符数量, 最后一个字节)
+    """
+    data = Bgzf.inflate_range(args)
+    return data.count(b'\n'), data[-1:]
+
+
+class LineIndex:
+    """
+    文件的稀疏行偏移索引。lines[i]行从文件的offsets[i]字节处开始，lines[0]总是0
+    """
+
+    def __init__(self, fname, n_lines, lines, offsets, step, file_key=None) -> None:
+        """
+        :param fname: 数据文件名
+        :param n_lines: 文件的总行数
+        :param lines: 索引点的行号，array('Q')
+        :param offsets: 索引点的字节位置，array('Q')。gzip文件为空
+        :param step: 索引点的间隔行数
+        :param file_key: 数据文件的(大小, 修改时间ns)
+        """
+        self.fname = fname
+        self.n_lines = n_lines
+        self.lines = lines
+        self.offsets = offsets
+        self.step = step
+        self.file_key = file_key if file_key is not None else _file_key(fname)
+
+    @classmethod
+    def build(cls, fname, step=10000, n_jobs=4, range_size=64 * 1024 * 1024):
+        """
+        扫描文件并建立索引
+        :param fname: 数据文件名
+        :param step: 每隔多少行记录一个索引点
+        :param n_jobs: 并行统计的进程数，为1时在当前进程中统计
+        :param range_size: 每个统计任务的字节数
+        :return: LineIndex
+        """
+        file_key = _file_key(fname)
+        lines = array('Q')
+        offsets = array('Q')
+
+        if fname.endswith('.gz'):
+            return cls(fname, cls.__count_gzip(fname, n_jobs), lines, offsets, step, file_key)
+
+        tasks = [(fname, start, end, step) for (start, end) in _aligned_ranges(fname, range_size)]
+        if n_jobs > 1 and len(tasks) > 1:
+            with Pool(min(n_jobs, len(tasks))) as pool:
+                results = pool.map(_index_range, tasks)
+        else:
+            results = [_index_range(task) for task in tasks]
+
+        # 各范围内的行号加上范围起始行号，得到全局的索引点
+        n_lines = 0
+        for count, points in results:
+            for line, offset in points:
+                lines.append(n_lines + line)
+                offsets.append(offset)
+            n_lines += count
+        if len(lines) == 0:
+            lines.append(0)
+            offsets.append(0)
+        return cls(fname, n_lines, lines, offsets, step, file_key)
+
+    @staticmethod
+    def __count_gzip(fname, n_jobs):
+        """
+        统计gzip文件的行数。BGZF文件按块并行解压，普通gzip文件只能顺序解压
+        :return: 行数
+        """
+        if n_jobs > 1 and Bgzf.is_bgzf(fname):
+            blocks = Bgzf.bgzf_block_offsets(fname)
+            tasks = [(fname, blocks[i], blocks[min(i + 64, len(blocks) - 1)]) for i in range(0, len(blocks) - 1, 64)]
+            with Pool(n_jobs) as pool:
+                results = pool.map(_count_bgzf_range, tasks)
+            n_lines = sum(count for count, _ in results)
+            last = b''.join(tail for _, tail in results)[-1:]
+        else:
+            n_lines = 0
+            last = b''
+            with gzip.open(fname, 'rb') as f:
+                while True:
+                    buf = f.read(4 * 1024 * 1024)
+                    if len(buf) == 0:
+                        break
+                    n_lines += buf.count(b'\n')
+                    last = buf[-1:]
+        if last not in (b'', b'\n'):
+            n_lines += 1
+        return n_lines
+
+    @classmethod
+    def load(cls, fname):
+        """
+        读取数据文件对应的索引文件
+        :param fname: 数据文件名
+        :return: LineIndex。索引文件不存在、格式不对或者数据文件已经变化时返回None
+        """
+        idx_name = index_file_name(fname)
+        if not os.path.exists(idx_name) or not os.path.exists(fname):
+            return None
+
+        with open(idx_name, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return None
+            magic, version, size, mtime, step, n_lines, n_points = _HEADER.unpack(header)
+            if magic != LINE_INDEX_MAGIC or version != LINE_INDEX_VERSION or (size, mtime) != _file_key(fname):
+                return None
+
+            lines = array('Q')
+            offsets = array('Q')
+            try:
+                lines.fromfile(f, n_points)
+                offsets.fromfile(f, n_points if not fname.endswith('.gz') else 0)
+            except EOFError:
+                return None
+        return cls(fname, n_lines, lines, offsets, step, (size, mtime))
+
+    def save(self):
+        """
+        将索引写入数据文件同目录下的'.lidx'文件。先写入临时文件再替换，避免留下不完整的索引
+        :return: True代表写入成功。目录不可写时返回False
+        """
+        idx_name = index_file_name(self.fname)
+        tmp_name = idx_name + '.tmp{}'.format(os.getpid())
+        try:
+            with open(tmp_name, 'wb') as f:
+                f.write(_HEADER.pack(LINE_INDEX_MAGIC, LINE_INDEX_VERSION, self.file_key[0], self.file_key[1],
+                                     self.step, self.n_lines, len(self.lines)))
+                self.lines.tofile(f)
+                self.offsets.tofile(f)
+            os.replace(tmp_name, idx_name)
+        except OSError:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            return False
+        return True
+
+    def seek(self, line):
+        """
+        查找不超过line的最近索引点
+        :param line: 行号，从0开始
+        :return: (索引点的行号, 字节位置)。gzip文件总是返回(0, 0)
+        """
+        if len(self.offsets) == 0:
+            return 0, 0
+        i = bisect_right(self.lines, line) - 1
+        return self.lines[i], self.offsets[i]
+
+    def line_offset(self, line):
+        """
+        得到第line行的起始字节位置。从最近的索引点开始，向后查找换行符
+        :param line: 行号，从0开始。大于等于总行数时返回文件大小
+        :return: 字节位置
+        """
+        assert len(self.offsets) > 0, "gzip文件的索引不支持定位"
+        file_size = self.file_key[0]
+        if line >= self.n_lines:
+            return file_size
+
+        point_line, pos = self.seek(line)
+        if point_line == line:
+            return pos
+        with open(self.fname, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for i in range(line - point_line):
+            pos = mm.find(b'\n', pos) + 1
+        mm.close()
+        return pos
+
+    def split(self, n_parts, start_line=0):
+        """
+        按照行数将文件从start_line开始均匀地切分为不超过n_parts个分片，除第一个分片的起始位置外，分片边界取自索引点
+        :param n_parts: 分片数量
+        :param start_line: 起始行号
+        :return: [(start, end, first_line), ...]，其中start包含，end不包含，first_line为分片第一行的行号
+        """
+        if start_line >= self.n_lines:
+            return []
+
+        bounds = [(self.line_offset(start_line), start_line)]
+        remain = self.n_lines - start_line
+        for k in range(1, n_parts):
+            i = bisect_right(self.lines, start_line + remain * k // n_parts) - 1
+            if self.lines[i] > bounds[-1][1]:
+                bounds.append((self.offsets[i], self.lines[i]))
+        bounds.append((self.file_key[0], self.n_lines))
+
+        return [(bounds[k][0], bounds[k + 1][0], bounds[k][1]) for k in range(len(bounds) - 1)]
+
+
+def get_line_index(fname, step=10000, n_jobs=4, rebuild=False):
+    """
+    获取文件的行索引。索引文件有效时直接读取，否则扫描文件建立索引并保存
+    :param fname: 数据文件名
+    :param step: 建立索引时，每隔多少行记录一个索引点
+    :param n_jobs: 建立索引时的并行进程数
+    :param rebuild: 是否忽略已有的索引文件，强制重新建立
+    :return: LineIndex
+    """
+    index = None
+    if not rebuild:
+        index = LineIndex.load(fname)
+    if index is None:
+        index = LineIndex.build(fname, step=step, n_jobs=n_jobs)
+        index.save()
+    return index
@@ -1,9 +1,32 @@
-from multiprocessing import Process, Pool, Queue
+from multiprocessing import Process, Pool, Queue, Value
+from multiprocessing.pool import RemoteTraceback
+from array import array
+from collections import deque
+from itertools import accumulate
+import glob
+import queue
+import mmap
 import os
+import pickle
 import time
 import progressbar as pb
 import re
 import gzip
+import json
+import shutil
+import struct
+import tempfile
+import traceback
+import Bgzf
+import Container
+import LineIndex
+import Metrics
+import SharedRing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 def assume_gzip_origin_size(filename, test_bytes=20 * 1024 * 1024):
@@ -34,40 +57,206 @@ def assume_gzip_origin_size(filename, test_bytes=20 * 1024 * 1024):
     return gz_file_size * s1 / s2
 
 
+def _sample_line_bytes(filename, sample_bytes=64 * 1024):
+    """
+    通过文件开头的数据估计平均每行的字节数，压缩文件按解压后的数据计算
+    :param filename: 文件名
+    :param sample_bytes: 读取的字节数
+    :return: 平均每行的字节数，包括换行符
+    """
+    open_func = gzip.open if filename.endswith('.gz') else open
+    with open_func(filename, 'rb') as f:
+        buf = f.read(sample_bytes)
+    return len(buf) / max(buf.count(b'\n'), 1)
+
+
+class LineFilter:
+    """
+    数据加载器中的行过滤条件。被过滤掉的行不会传出加载器，也不会交给进程池，但仍然计入行号
+    """
+
+    def __init__(self, prefilter=None, skip_prefix=None, binary=False) -> None:
+        """
+        :param prefilter: 保留行的条件。可以是编译好的正则表达式，保留search能够匹配的行；
+                          也可以是方法，定义为 def func(line): -> bool，保留返回True的行
+        :param skip_prefix: 需要跳过的行的前缀，可以是str、bytes或者它们的tuple，例如'##'
+        :param binary: 行是否为bytes。为True时，str形式的前缀会被编码为bytes
+        """
+        if isinstance(skip_prefix, (str, bytes)):
+            skip_prefix = (skip_prefix,)
+        if skip_prefix is not None:
+            skip_prefix = tuple(p.encode() if binary and isinstance(p, str) else p for p in skip_prefix)
+        self.skip_prefix = skip_prefix
+        # 正则表达式的类型与行的类型不一致时，转换为对应的类型
+        if isinstance(prefilter, re.Pattern):
+            if binary and isinstance(prefilter.pattern, str):
+                prefilter = re.compile(prefilter.pattern.encode(), prefilter.flags & ~re.UNICODE)
+            elif not binary and isinstance(prefilter.pattern, bytes):
+                prefilter = re.compile(prefilter.pattern.decode(), prefilter.flags)
+        self.match = prefilter.search if isinstance(prefilter, re.Pattern) else prefilter
+
+    def __call__(self, line):
+        if self.skip_prefix is not None and line.startswith(self.skip_prefix):
+            return False
+        return self.match is None or bool(self.match(line))
+
+
+class _LoaderFailure:
+    """
+    预加载进程中出现的异常，经过队列传给主进程后重新抛出
+    """
+
+    def __init__(self, exc) -> None:
+        try:
+            pickle.dumps(exc)
+        except Exception:
+            # 无法序列化的异常转换为RuntimeError，保留异常信息
+            exc = RuntimeError(repr(exc))
+        self.exc = exc
+        self.tb = traceback.format_exc()
+
+    def reraise(self):
+        raise self.exc from RemoteTraceback(self.tb)
+
+
 class ChunkLoader:
     """
     这个是数据预加载器。按照要求进行数据的加载
     这个程序会维持一个加载队列，当主进程处理其他数据时，会使用另外一个进行继续数据的加载
 
-    todo 1 是否可以增加一个迭代器方式的读取
+    也可以通过迭代器的方式读取，每次迭代得到一个chunk，例如 for data in ChunkLoader(...)
     """
 
-    def __init__(self, input_file_name, chunk_size=1000, use_async=True, with_line_num=False) -> None:
+    def __init__(self, input_file_name, chunk_size=1000, use_async=True, with_line_num=False,
+                 decompress_jobs=1, start_line=0, line_index=None, binary=False, prefilter=None,
+                 skip_prefix=None, prefetch=None, channel='queue', prefetch_mem=64 * 1024 * 1024) -> None:
         """
         数据加载器初始化
         :param input_file_name: 需要读取的文件名
         :param chunk_size: 一次加载的行数量
         :param use_async: 是否使用额外线程进行数据的异步加载
         :param with_line_num: 加载的数据List是否包括行号信息，如果True，则返回的List结构为 [(1,"xxx"),(2,"xxx"),(3,"xxx"),...]
+        :param decompress_jobs: 输入为BGZF文件时，用于并行解压的进程数。为1或输入为普通gzip文件时，采用单线程解压
+        :param start_line: 从第几行开始读取，行号从0开始。未压缩的文件会通过行索引直接定位到最近的索引点
+        :param line_index: 输入文件的LineIndex。为None时，尝试读取已有的索引文件
+        :param binary: 是否以二进制方式读取。为True时，行为去掉换行符的bytes，省去文本的解码，适用于ASCII数据
+        :param prefilter: 保留行的条件，在预加载进程中执行，参见LineFilter。不满足条件的行不会传出，行号仍然是行在文件中的行号
+        :param skip_prefix: 需要跳过的行的前缀，在预加载进程中执行，参见LineFilter
+        :param prefetch: 预加载进程最多可以领先的chunk数。为None时，'queue'方式为1，'shm'方式根据prefetch_mem估计
+        :param channel: 异步加载时chunk的传递方式。'queue'通过multiprocessing.Queue传递；
+                        'shm'通过共享内存环形缓冲区传递，省去chunk的序列化，参见SharedRing
+        :param prefetch_mem: 'shm'方式的共享内存大小(字节)，平均分配给各个槽位
         """
+        assert channel in ('queue', 'shm'), "不支持的channel:{}".format(channel)
+        assert prefetch is None or prefetch >= 1, "prefetch必须大于0，收到:{}".format(prefetch)
 
         # assert (infile.readable(), "文件无法读取")
+        mode = 'rb' if binary else 'rt'
         if input_file_name.endswith('.vcf'):
-            self.infile = open(input_file_name, 'r')
+            self.infile = open(input_file_name, mode)
         elif input_file_name.endswith('.gz'):
-            self.infile = gzip.open(input_file_name, 'rt')
+            if decompress_jobs > 1 and Bgzf.is_bgzf(input_file_name):
+                self.infile = Bgzf.open_bgzf(input_file_name, mode, n_jobs=decompress_jobs)
+            else:
+                self.infile = gzip.open(input_file_name, mode)
         else:
-            self.infile = open(input_file_name, 'r')
+            self.infile = open(input_file_name, mode)
 
-        self.chunk_size = chunk_size
+        self.file_size = os.path.getsize(input_file_name)  # 输入文件在磁盘上的大小
+        self.file_pos = 0  # 已经传出数据在磁盘文件中的位置，压缩文件为压缩数据的位置
+        self.__chunk_size = Value('i', chunk_size, lock=False)  # 与预加载进程共享，可以在读取过程中调整
         self.use_async = use_async
         self.EOF = False  # 代表文件已经读取完毕。该项由读取函数处理，从读取完毕得到[]作为标志触发
         self.with_line_num = with_line_num
+        self.binary = binary
+        self.line_filter = None
+        if prefilter is not None or skip_prefix is not None:
+            self.line_filter = LineFilter(prefilter, skip_prefix, binary)
+        self.line_nums = None  # 使用过滤时，最近一个chunk中各行的行号
 
         # 用于进程间数据共享
-        self.ram_cache = Queue(maxsize=1)  # 最大容量为1的队列
+        self.channel = channel if use_async else 'queue'
+        if self.channel == 'shm':
+            depth, slot_size = self.__ring_shape(input_file_name, prefetch, prefetch_mem)
+            self.ram_cache = SharedRing.ShmRing(depth, slot_size)
+        else:
+            self.ram_cache = Queue(maxsize=prefetch or 1)  # 默认为最大容量为1的队列
+        # 预加载进程因队列已满而等待的次数，以及主进程因队列为空而等待的次数
+        self.__producer_blocks = Value('Q', 0, lock=False)
+        self.__consumer_blocks = Value('Q', 0, lock=False)
         self.LineNum = 0  # 记录已经传出数据的行号
 
+        if start_line > 0:
+            self.__skip_lines(input_file_name, start_line, line_index)
+        self.__read_num = self.LineNum  # 已经读取的行数，包括被过滤掉的行
+        self.__chunk_nums = None  # 最近读取的chunk中各行的行号
+
+    def __skip_lines(self, input_file_name, start_line, line_index):
+        """
+        跳过文件开头的start_line行。有行索引时，先定位到最近的索引点，再逐行跳过剩余的行
+        :return:
+        """
+        if line_index is None:
+            line_index = LineIndex.LineIndex.load(input_file_name)
+        if line_index is not None and not input_file_name.endswith('.gz'):
+            point_line, offset = line_index.seek(start_line)
+            self.infile.seek(offset)
+            self.LineNum = point_line
+
+        while self.LineNum < start_line:
+            if len(self.infile.readline()) == 0:
+                break
+            self.LineNum += 1
+        self.file_pos = self.__raw_tell()
+
+    def __ring_shape(self, input_file_name, prefetch, prefetch_mem):
+        """
+        确定共享内存环形缓冲区的槽位数与槽位大小。未指定prefetch时，按文件开头的平均行长度估计一个chunk的大小，
+        在prefetch_mem内放置尽量多的槽位(2~64个)，并为chunk大小的波动留出一半的余量
+        :return: (槽位数, 槽位大小)
+        """
+        if prefetch is None:
+            line_bytes = _sample_line_bytes(input_file_name)
+            if self.line_filter is not None:
+                line_bytes += 8  # 各行的行号
+            chunk_bytes = line_bytes * self.chunk_size * 1.5
+            prefetch = int(min(max(prefetch_mem // max(chunk_bytes, 1), 2), 64))
+        return prefetch, prefetch_mem // prefetch
+
+    @property
+    def producer_blocks(self):
+        """
+        :return: 预加载进程因队列已满而等待的次数。次数多说明处理速度是瓶颈
+        """
+        return self.__producer_blocks.value
+
+    @property
+    def consumer_blocks(self):
+        """
+        :return: 主进程因队列为空而等待的次数。次数多说明读取速度是瓶颈
+        """
+        return self.__consumer_blocks.value
+
+    @property
+    def ring_overflows(self):
+        """
+        :return: 'shm'方式中超过槽位大小、退回通过队列传递的chunk数
+        """
+        if self.channel == 'shm':
+            return self.ram_cache.overflows.value
+        return 0
+
+    @property
+    def chunk_size(self):
+        return self.__chunk_size.value
+
+    @chunk_size.setter
+    def chunk_size(self, chunk_size):
+        """
+        调整一次加载的行数，对预加载进程之后读取的chunk生效
+        """
+        self.__chunk_size.value = max(int(chunk_size), 1)
+
     def __read_a_chunk(self):
         """
         读取一个chunk行的文本。如果已经读取到文件的末尾，那么再次调用本方法将会返回[]
@@ -76,6 +265,17 @@ class ChunkLoader:
         :return: 注意，这里的数据不能进行二级包装。这是由于Queue数据的引用方式造成的
         """
         line_datas = []
+        if self.line_filter is not None:
+            return self.__read_filtered_chunk()
+        if self.binary:
+            readline = self.infile.readline
+            for i in range(self.chunk_size):
+                line = readline()
+                if len(line) == 0:
+                    break
+                line_datas.append(line.rstrip(b'\r\n'))
+            return line_datas
+
         # 对行数据进一步处理
         for i in range(self.chunk_size):
             line = self.infile.readline()
@@ -88,6 +288,45 @@ class ChunkLoader:
 
         return line_datas
 
+    def __read_filtered_chunk(self):
+        """
+        读取一个chunk，只保留满足过滤条件的行，直到保留的行数达到chunk_size或者文件结束，同时记录保留的各行的行号
+        :return: 保留的行的List
+        """
+        line_datas = []
+        line_nums = []
+        line_filter = self.line_filter
+        readline = self.infile.readline
+        binary = self.binary
+        num = self.__read_num
+        chunk_size = self.chunk_size
+        while len(line_datas) < chunk_size:
+            line = readline()
+            if len(line) == 0:
+                break
+            # 与不过滤时的读取方式保持一致
+            line = line.rstrip(b'\r\n') if binary else line.strip('\r\n')
+            if line_filter(line):
+                line_datas.append(line)
+                line_nums.append(num)
+            num += 1
+
+        self.__read_num = num
+        self.__chunk_nums = line_nums
+        return line_datas
+
+    def __raw_tell(self):
+        """
+        得到磁盘文件的读取位置。文本层会预读一部分数据，因此这里的位置略微超前，只用于展示进度
+        :return: 字节位置，压缩文件为压缩数据的位置
+        """
+        buf = getattr(self.infile, 'buffer', self.infile)
+        if isinstance(buf, gzip.GzipFile):
+            return buf.fileobj.tell()
+        if isinstance(getattr(buf, 'raw', None), Bgzf.BgzfReader):
+            return buf.raw.compressed_tell()
+        return buf.tell()
+
     def __read_async(self):
         """
         异步读取的附加线程主循环
@@ -95,14 +334,56 @@ class ChunkLoader:
         """
         while True:
             # 开始进行缓存，如果文件已经到了EOF，那么之后的读取都会是tmp=[]
-            tmp = self.__read_a_chunk()
-            self.ram_cache.put(tmp, block=True)  # 阻塞式的数据入队
+            try:
+                tmp = self.__read_a_chunk()
+            except Exception as e:
+                # 读取或过滤出错时，把异常传给主进程，由get重新抛出，主进程不会一直等待
+                self.__put((_LoaderFailure(e), self.__raw_tell(), None, self.__read_num))
+                break
+            # 阻塞式的数据入队，同时传出文件的读取位置。使用过滤时，还需要传出各行的行号与已经读取的行数
+            self.__put((tmp, self.__raw_tell(), self.__chunk_nums, self.__read_num))
 
             # 文件是否读取完毕，当读取完毕后，最后一批数据(包括[]值)发送完毕，这里获取EOF状态，并结束进程的运行
             # 这里不能以EOF状态为结束标志，存在情况，最后一次数据没有读满，但EOF=true，这会造成主进程不清楚辅助进程已经结束。因此，这里多读取一次，保证发送一个[]给队列读取者
             if len(tmp) == 0:
                 break
 
+        # 释放文件，BGZF文件的解压进程池也会随之关闭
+        self.infile.close()
+
+    def __put(self, item):
+        """
+        预加载进程中的数据入队，队列已满时记录一次等待
+        :return:
+        """
+        try:
+            self.ram_cache.put(item, block=False)
+        except queue.Full:
+            self.__producer_blocks.value += 1
+            self.ram_cache.put(item, block=True)
+
+    def __get(self, poll_interval=1.0):
+        """
+        主进程中的数据出队，队列为空时记录一次等待。预加载进程异常退出、不会再送出数据时抛出RuntimeError
+        :param poll_interval: 检查预加载进程是否存活的时间间隔，单位为秒
+        :return: (lines, raw_pos, line_nums, read_num)
+        """
+        try:
+            return self.ram_cache.get(block=False)
+        except queue.Empty:
+            self.__consumer_blocks.value += 1
+        while True:
+            try:
+                return self.ram_cache.get(block=True, timeout=poll_interval)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+            # 进程退出前送出的数据可能刚刚到达
+            try:
+                return self.ram_cache.get(block=True, timeout=poll_interval)
+            except queue.Empty:
+                raise RuntimeError("预加载进程异常退出，exitcode={}".format(self.process.exitcode))
+
     def read_async(self):
         """
         异步的数据读取方法。通过self.process执行
@@ -147,32 +428,321 @@ class ChunkLoader:
             if not hasattr(self, 'process'):
                 self.read_async()
 
-            ret = self.ram_cache.get(block=True)
+            ret, self.file_pos, line_nums, read_num = self.__get()
+            if isinstance(ret, _LoaderFailure):
+                self.EOF = True
+                ret.reraise()
         else:
             # print('read_sync')
             ret = self.read_sync()
+            self.file_pos = self.__raw_tell()
+            line_nums, read_num = self.__chunk_nums, self.__read_num
 
         # 判断文件是否读取结束
         if len(ret) == 0:
             self.EOF = True
 
-        # 包装行号
+        # 包装行号，结构为[(line_num, line), ...]。使用过滤时，行号由加载器记录，LineNum为已经读取的行数
+        self.line_nums = line_nums
         tmp = []
         if self.with_line_num:
-            tmp.append(range(self.LineNum, self.LineNum + len(ret)))
-            tmp.append(ret)
-            self.LineNum += len(ret)
+            if line_nums is not None:
+                tmp = list(zip(line_nums, ret))
+            else:
+                tmp = list(zip(range(self.LineNum, self.LineNum + len(ret)), ret))
         else:
             tmp = ret
+        self.LineNum = read_num if line_nums is not None else self.LineNum + len(ret)
 
         return tmp
 
+    def __iter__(self):
+        """
+        按chunk迭代数据，直到文件读取完毕。迭代完成后会自动调用close()
+        :return:
+        """
+        while True:
+            data = self.get()
+            if len(data) == 0:
+                break
+            yield data
+        self.close()
+
+    def queue_depth(self):
+        """
+        :return: 预加载队列中等待取出的chunk数量。平台不支持时返回0
+        """
+        try:
+            return self.ram_cache.qsize()
+        except NotImplementedError:
+            return 0
+
+    def terminate(self):
+        """
+        强制结束数据加载，用于处理过程出错的情况。与close不同，这里不会等待预加载进程把数据送出
+        :return:
+        """
+        self.infile.close()
+        if hasattr(self, 'process'):
+            self.process.terminate()
+            self.process.join()
+            self.process.close()
+            del self.process
+        self.__close_channel()
+
     def close(self):
         self.infile.close()
         if hasattr(self, 'process'):
             # 等待process的后续任务做完
             self.process.join()
             self.process.close()
+            del self.process
+        self.__close_channel()
+
+    def __close_channel(self):
+        """
+        释放共享内存环形缓冲区。需要在预加载进程结束之后调用
+        :return:
+        """
+        if self.channel == 'shm':
+            self.ram_cache.close()
+
+
+_worker_mmaps = {}  # 工作进程中打开的mmap对象，按文件名缓存，进程内复用。结构为 {fname: (文件标识, mmap)}
+_MAX_WORKER_MMAPS = 16  # 每个进程最多保留的映射数，常驻的工作进程不会为处理过的每个文件都保留映射
+
+
+def _open_mmap(fname):
+    """
+    在当前进程中以只读方式映射文件。同一个进程对同一个文件只映射一次。
+    文件以(inode, 大小, 修改时间)标识，同名文件被替换或改写后重新映射，不会读到旧的数据
+    :param fname: 文件名
+    :return: mmap对象
+    """
+    st = os.stat(fname)
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    cached = _worker_mmaps.pop(fname, None)
+    if cached is not None and cached[0] == key:
+        _worker_mmaps[fname] = cached  # 移到末尾，最近使用的映射最后被淘汰
+        return cached[1]
+    if cached is not None:
+        _close_mmap(cached[1])
+
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker_mmaps[fname] = (key, mm)
+    while len(_worker_mmaps) > _MAX_WORKER_MMAPS:
+        _close_mmap(_worker_mmaps.pop(next(iter(_worker_mmaps)))[1])
+    return mm
+
+
+def _close_mmap(mm):
+    """
+    关闭不再缓存的映射。仍有memoryview引用时无法关闭，由垃圾回收释放
+    :return:
+    """
+    try:
+        mm.close()
+    except BufferError:
+        pass
+
+
+class LineBlock:
+    """
+    文件中连续多行的视图，只记录文件名、字节范围和行号，本身不包含数据，因此可以低开销地传递给工作进程。
+    工作进程中通过mmap访问数据，只有在需要文本时才会进行解码
+
+    可以像List一样迭代和索引，得到的元素为行的文本；如果with_line_num=True，元素为(line_num, line)
+    """
+
+    def __init__(self, fname, start, end, first_line, n_lines, with_line_num=False, binary=False) -> None:
+        """
+        :param fname: 文件名
+        :param start: 起始字节位置，包含
+        :param end: 结束字节位置，不包含
+        :param first_line: 第一行的行号
+        :param n_lines: 行数
+        :param with_line_num: 迭代得到的元素是否包括行号
+        :param binary: 为True时，行为bytes，不进行解码
+        """
+        self.fname = fname
+        self.start = start
+        self.end = end
+        self.first_line = first_line
+        self.n_lines = n_lines
+        self.with_line_num = with_line_num
+        self.binary = binary
+        self.__lines = None  # 解码后的行，按需生成
+
+    def __getstate__(self):
+        # 解码后的行不需要跨进程传递
+        state = self.__dict__.copy()
+        state['_LineBlock__lines'] = None
+        return state
+
+    @property
+    def buffer(self):
+        """
+        块数据的零拷贝视图
+        :return: memoryview
+        """
+        return memoryview(_open_mmap(self.fname))[self.start:self.end]
+
+    def offsets(self):
+        """
+        块内各行的起始位置，相对于buffer。换行符的位置成批得到，不逐行查找
+        :return: 起始位置的List，长度为n_lines
+        """
+        if self.n_lines == 0:
+            return []
+        buf = self.buffer
+        if np is not None:
+            ends = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+            return [0] + (ends[:self.n_lines - 1] + 1).tolist()
+        parts = bytes(buf).split(b'\n', self.n_lines - 1)
+        return [0] + list(accumulate(len(part) + 1 for part in parts[:-1]))
+
+    def lines(self):
+        """
+        解码后的行，只会解码一次
+        :return: 行的List
+        """
+        if self.__lines is None:
+            self.__lines = _split_lines(self.buffer, self.binary)
+        return self.__lines
+
+    def __len__(self):
+        return self.n_lines
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(self.n_lines))]
+        if item < 0:
+            item += self.n_lines
+        if self.with_line_num:
+            return self.first_line + item, self.lines()[item]
+        return self.lines()[item]
+
+    def __iter__(self):
+        if self.with_line_num:
+            return zip(range(self.first_line, self.first_line + self.n_lines), self.lines())
+        return iter(self.lines())
+
+
+class MmapChunkLoader:
+    """
+    基于mmap的数据加载器。主进程只负责在映射的文件中定位行的边界，每次返回一个LineBlock，
+    不构造每一行的字符串，也不需要序列化行数据。数据由工作进程通过mmap直接访问，只支持未压缩的文件
+
+    为了减少主进程的开销，LineBlock按字节切分：根据平均行长度估计chunk_size行的字节数，从该位置向后找到下一个换行符作为边界，
+    再一次统计块内的换行符得到行数。因此每个LineBlock的行数与chunk_size接近，但不完全相等
+    """
+
+    def __init__(self, input_file_name, chunk_size=1000, with_line_num=False, start_line=0, line_index=None,
+                 binary=False) -> None:
+        """
+        :param input_file_name: 需要读取的文件名
+        :param chunk_size: 每个LineBlock包含的近似行数
+        :param with_line_num: 返回的LineBlock迭代时是否包括行号信息
+        :param binary: 返回的LineBlock中的行是否为bytes
+        :param start_line: 从第几行开始读取，行号从0开始
+        :param line_index: 输入文件的LineIndex，用于直接定位到start_line附近。为None时，尝试读取已有的索引文件
+        """
+        assert not input_file_name.endswith('.gz'), "mmap加载器只支持未压缩的文件，收到:{}".format(input_file_name)
+        self.input_file_name = input_file_name
+        self.chunk_size = chunk_size
+        self.with_line_num = with_line_num
+        self.binary = binary
+        self.file_size = os.path.getsize(input_file_name)
+        self.EOF = False
+        self.LineNum = 0  # 记录已经传出数据的行号
+        self.pos = 0  # 已经传出数据的字节位置
+        self.line_bytes = None  # 平均每行的字节数，用于估计每个LineBlock的字节数
+
+        self.mm = None
+        if self.file_size > 0:
+            with open(input_file_name, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(self.mm, 'madvise'):
+                self.mm.madvise(mmap.MADV_SEQUENTIAL)
+
+        if start_line > 0 and self.mm is not None:
+            if line_index is None:
+                line_index = LineIndex.LineIndex.load(input_file_name)
+            if line_index is not None:
+                self.LineNum, self.pos = line_index.seek(start_line)
+            while self.LineNum < start_line and self.pos < self.file_size:
+                self.pos = self.mm.find(b'\n', self.pos) + 1
+                if self.pos == 0:
+                    self.pos = self.file_size
+                self.LineNum += 1
+
+    def is_eof(self):
+        return self.EOF
+
+    @property
+    def file_pos(self):
+        """
+        :return: 已经传出数据在文件中的位置
+        """
+        return self.pos
+
+    def get(self):
+        """
+        返回下一个LineBlock
+        :return: LineBlock。如果长度为0，代表数据已经读取完毕
+        """
+        start = self.pos
+        n_lines = 0
+        if not self.EOF and start < self.file_size:
+            mm = self.mm
+            if self.line_bytes is None:
+                sample = mm[start:start + 64 * 1024]
+                self.line_bytes = len(sample) / max(sample.count(b'\n'), 1)
+
+            # 按估计的字节数向后跳，边界对齐到下一个换行符之后
+            end = start + max(int(self.chunk_size * self.line_bytes), 1)
+            if end >= self.file_size:
+                end = self.file_size
+            else:
+                end = mm.find(b'\n', end - 1) + 1
+                if end == 0:
+                    end = self.file_size
+            n_lines = mm[start:end].count(b'\n')
+            if mm[end - 1:end] != b'\n':
+                # 最后一行没有换行符
+                n_lines += 1
+            self.pos = end
+            # 平均行长度取滑动平均，适应行长度的变化
+            self.line_bytes += 0.5 * ((end - start) / n_lines - self.line_bytes)
+
+        if n_lines == 0:
+            self.EOF = True
+
+        ret = LineBlock(self.input_file_name, start, self.pos, self.LineNum, n_lines, self.with_line_num,
+                        self.binary)
+        self.LineNum += n_lines
+        return ret
+
+    def __iter__(self):
+        """
+        按LineBlock迭代数据，直到文件读取完毕。迭代完成后会自动调用close()
+        :return:
+        """
+        while True:
+            data = self.get()
+            if len(data) == 0:
+                break
+            yield data
+        self.close()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def terminate(self):
+        self.close()
 
 
 def line_proc(data):
@@ -219,14 +789,203 @@ def chunk2col(data):
     # 将行数据存放给列来使用。
     for j in range(max_col):
         for row in row_list:
-            if len(row) < j:
+            if len(row) <= j:
                 # 空值处理方法
                 col_list[j].append('')
+                continue
             col_list[j].append(row[j])
 
     return col_list
 
 
+def chunk2rows(data):
+    """
+    这是一个默认方法，用于将chunk块中多行数据切分为二维表格，行的顺序不变。分隔符与chunk2col相同。
+    列数不足的行会以空串补齐，使得每一行的长度相同
+
+    :param data: 行的List
+    :return: 行的List，每一行是切分得到的值的List
+    """
+    rows = [re.split('[:;, |\n]', line) for line in data]
+    max_col = max([len(row) for row in rows], default=0)
+    for row in rows:
+        if len(row) < max_col:
+            row += [''] * (max_col - len(row))
+    return rows
+
+
+def _parse_int_matrix(mat, lengths):
+    """
+    将字节矩阵形式的十进制整数一次性转换为int64，支持前导的'-'
+    :param mat: 形状为(n, width)的uint8矩阵，每一行是一个左对齐的数字字符串
+    :param lengths: 每一行字符串的长度
+    :return: int64数组，无法转换时返回None
+    """
+    n, width = mat.shape
+    if n == 0 or width > 18:
+        return None
+    pos = np.arange(width)
+    valid = pos < lengths[:, None]
+    neg = mat[:, 0] == 45
+    digit = mat - np.uint8(48)  # 非数字字符会得到大于9的值
+    is_digit = valid & (digit <= 9)
+    # 每一个有效字符都必须是数字，或者是首位的负号，且至少有一位数字
+    is_digit[:, 0] |= neg
+    if not (is_digit == valid).all() or (lengths <= neg).any():
+        return None
+    is_digit[:, 0] &= ~neg
+
+    # 每一位的权重为10的(长度-1-位置)次方，无效的位权重为0
+    pow10 = np.append(10 ** np.arange(width, dtype=np.int64), 0)
+    exponent = lengths[:, None] - 1 - pos
+    exponent[~is_digit] = width
+    # width很小而n很大，按位累加比沿短轴求和更快
+    ret = np.zeros(n, dtype=np.int64)
+    for j in range(width):
+        ret += digit[:, j] * pow10[exponent[:, j]]
+    return np.where(neg, -ret, ret)
+
+
+def _finish_array(mat, lengths, infer_dtype, as_str):
+    """
+    将字节矩阵转换为最终返回的数组
+    :param mat: 形状为(..., width)的uint8矩阵
+    :param lengths: 各元素的字符串长度，形状与mat去掉最后一维相同
+    :param infer_dtype: 是否推断数值类型
+    :param as_str: 是否返回str数组
+    :return: numpy数组
+    """
+    width = mat.shape[-1]
+    shape = mat.shape[:-1]
+    if infer_dtype:
+        num = _parse_int_matrix(mat.reshape(-1, width), lengths.reshape(-1))
+        if num is not None:
+            return num.reshape(shape)
+        try:
+            return np.ascontiguousarray(mat).view('S{}'.format(width)).reshape(shape).astype(np.float64)
+        except ValueError:
+            pass
+    if as_str and not (mat > 127).any():
+        # 纯ASCII时，直接扩展为UCS4，不需要逐个元素解码
+        return np.ascontiguousarray(mat.astype(np.uint32)).view('U{}'.format(width)).reshape(shape)
+    ret = np.ascontiguousarray(mat).view('S{}'.format(width)).reshape(shape)
+    if as_str:
+        return np.char.decode(ret, 'utf-8')
+    return ret
+
+
+def chunk2array(data, delimiters=':;, |', pad='', infer_dtype=False, as_columns=False):
+    """
+    chunk2col的向量化版本，需要numpy。将chunk块中多行数据按照分隔符切分为numpy二维数组，行列与输入的行列对应
+
+    切分过程不逐行调用正则表达式：所有行拼接为一个字节串，通过分隔符与换行符的位置一次性计算出每个值的起止位置和每行的列数，
+    再整体取出为定长的字节矩阵。数值类型的推断同样是对整个矩阵进行的
+
+    :param data: 行的List(str或bytes)，也可以是LineBlock，或者是一个以'\n'分行的bytes
+    :param delimiters: 分隔符集合，其中每一个字符都作为分隔符
+    :param pad: 各行列数不一致时，用于补齐的值。为None时，遇到列数不一致的行会抛出ValueError
+    :param infer_dtype: 是否推断数值类型。能转换为整数或浮点数时，返回数值数组
+    :param as_columns: 为True时返回列的List，每一列是一个一维数组，并且各列单独推断类型
+    :return: 形状为(行数, 最大列数)的数组；输入为str时数组的元素为str，否则为bytes
+    """
+    assert np is not None, "chunk2array需要安装numpy"
+
+    # 统一为一个字节串
+    as_str = False
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        buf = bytes(data)
+        if buf.endswith(b'\n'):
+            buf = buf[:-1]
+        buf = buf.replace(b'\r', b'')
+        if len(data) == 0:
+            buf = None
+    else:
+        if isinstance(data, LineBlock):
+            data = data.lines()
+        if len(data) > 0 and isinstance(data[0], str):
+            as_str = True
+            buf = '\n'.join(data).encode()
+        else:
+            buf = b'\n'.join(data)
+        if len(data) == 0:
+            buf = None
+
+    if buf is None:
+        ret = np.empty((0, 0), dtype='U' if as_str else 'S')
+        return [] if as_columns else ret
+
+    delimiters = delimiters.encode() if isinstance(delimiters, str) else delimiters
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    is_sep = raw == 10
+    for c in set(delimiters):
+        is_sep |= raw == c
+
+    # 每个值的起止位置
+    sep_pos = np.flatnonzero(is_sep)
+    starts = np.concatenate(([0], sep_pos + 1))
+    lengths = np.concatenate((sep_pos, [len(raw)])) - starts
+
+    # 每一行的列数：换行符在分隔符序列中的位置，就是各行最后一个值的编号
+    row_end = np.flatnonzero(raw[sep_pos] == 10)
+    n_cols = np.diff(np.concatenate(([-1], row_end, [len(sep_pos)])))
+
+    pad_bytes = b'' if pad is None else (pad.encode() if isinstance(pad, str) else pad)
+    width = max(int(lengths.max()), len(pad_bytes), 1)
+
+    if len(starts) * width > 4 * len(raw) + 1024 * 1024:
+        # 个别值特别长时，定长矩阵会占用过多内存，改为逐个切分
+        tokens = np.array(buf.translate(bytes.maketrans(delimiters, b'\n' * len(delimiters))).split(b'\n'),
+                          dtype='S{}'.format(width))
+        mat = tokens.view(np.uint8).reshape(len(tokens), width)
+    else:
+        # 末尾补齐width个字节，保证按定长取值不会越界
+        pos = np.arange(width)
+        mat = np.concatenate((raw, np.zeros(width, dtype=np.uint8)))[starts[:, None] + pos]
+        mat[pos >= lengths[:, None]] = 0
+
+    n_rows = len(n_cols)
+    max_col = int(n_cols.max())
+    if (n_cols == max_col).all():
+        mat = mat.reshape(n_rows, max_col, width)
+        lengths = lengths.reshape(n_rows, max_col)
+    else:
+        if pad is None:
+            raise ValueError("各行的列数不一致，最少{}列，最多{}列".format(int(n_cols.min()), max_col))
+        full = np.zeros((n_rows, max_col, width), dtype=np.uint8)
+        full[:, :, :len(pad_bytes)] = np.frombuffer(pad_bytes, dtype=np.uint8)
+        full_lengths = np.full((n_rows, max_col), len(pad_bytes))
+        mask = np.arange(max_col) < n_cols[:, None]
+        full[mask] = mat
+        full_lengths[mask] = lengths
+        mat, lengths = full, full_lengths
+
+    if as_columns:
+        return [_finish_array(mat[:, j], lengths[:, j], infer_dtype, as_str) for j in range(max_col)]
+    return _finish_array(mat, lengths, infer_dtype, as_str)
+
+
+def chunk_proc(data):
+    """
+    这是一个默认方法，作为ParallelLine的默认块处理方法
+    块处理方法一次接收一个数据块，也就是多行组成的List，并返回处理结果的List。返回结果中的None值不会被写出
+
+    :param data: 行的List。如果需要行号，List的结构为[(line_num, line), ...]
+    :return: 处理结果的List
+    """
+
+    return data
+
+
+def block_proc(block):
+    """
+    这是一个默认方法，作为ParallelLine的默认block处理方法
+    :param block: 结构为(row_nums, col_nums, data)，data为block中行的List，每一行只包含col_nums对应的值
+    :return: 处理后的二维数据，行数需要与block的行数相同
+    """
+    row_nums, col_nums, data = block
+    return data
+
+
 def col_proc(data):
     """
     这是一个默认方法，作为ParallelLine的默认列处理方法
@@ -238,23 +997,686 @@ def col_proc(data):
     return data
 
 
-def file_line_count(fname):
+def file_line_count(fname, n_jobs=4):
     '''
-    用于确认文件有多少行
-    :param f: 所打开的文件名
-    :return: 该文件存在的行数
+    用于确认文件有多少行。行数来自文件的行索引，第一次统计时按字节范围并行扫描，并把索引保存在fname+'.lidx'中，
+    文件没有变化时，再次统计不需要重新扫描。支持gzip文件
+    :param fname: 文件名
+    :param n_jobs: 并行统计的进程数
+    :return: 该文件存在的行数，最后一行没有换行符时也计入
     '''
+    return LineIndex.get_line_index(fname, n_jobs=n_jobs).n_lines
+
+
+def split_file_ranges(fname, shard_size=64 * 1024 * 1024):
+    """
+    将未压缩的文件按照字节范围切分为多个分片，每个分片的边界都对齐到行首，保证不会把一行数据拆到两个分片中
+    :param fname: 需要切分的文件名
+    :param shard_size: 每个分片的近似字节数
+    :return: 分片列表，结构为[(start, end), ...]，其中start包含，end不包含
+    """
+    file_size = os.path.getsize(fname)
+    ranges = []
+    start = 0
+    with open(fname, 'rb') as f:
+        while start < file_size:
+            end = start + shard_size
+            if end >= file_size:
+                end = file_size
+            else:
+                # 移动到下一行的行首
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _count_range_lines(args):
+    """
+    统计文件某个字节范围内的行数，供进程池调用
+    :param args: (fname, start, end)
+    :return: 该范围内的行数
+    """
+    fname, start, end = args
     line_num = 0
-    with open(fname, 'r') as f:
-        while (True):
-            buf = f.read(4 * 1024 * 1024)
-            if (buf == ''):
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        remain = end - start
+        while remain > 0:
+            buf = f.read(min(remain, 4 * 1024 * 1024))
+            if len(buf) == 0:
                 break
+            remain -= len(buf)
+            line_num += buf.count(b'\n')
+    # 最后一行可能没有换行符
+    if end > start:
+        with open(fname, 'rb') as f:
+            f.seek(end - 1)
+            if f.read(1) != b'\n':
+                line_num += 1
+    return line_num
 
-            line_num += buf.count('\n')
 
-        f.close()
-    return line_num
+def _split_lines(buf, binary=False):
+    """
+    将一段以行为边界的字节数据解码并切分为行，行尾的换行符会被清除
+    :param buf: bytes或memoryview
+    :param binary: 为True时不进行解码，返回bytes的List
+    :return: 行的List
+    """
+    if len(buf) == 0:
+        return []
+    if binary:
+        data = bytes(buf)
+        lines = data.split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        # 只有CRLF换行的数据才需要逐行清除'\r'
+        if b'\r' in data:
+            return [line.rstrip(b'\r') for line in lines]
+        return lines
+
+    lines = bytes(buf).decode().split('\n')
+    # 数据以换行符结尾时，split会多出一个空串
+    if lines[-1] == '' and buf[-1:] == b'\n':
+        lines.pop()
+    return [line.strip('\r\n') for line in lines]
+
+
+def _process_shard(args):
+    """
+    分片模式下的工作进程方法。工作进程自己打开文件，定位到分片的起始位置并读取分片，处理完毕后只把结果传回主进程
+    :param args: (fname, start, end, first_line, chunk_func, with_line_num, encoder, binary)
+    :return: 分片经过chunk_func处理后的结果，参见_process_chunk
+    """
+    fname, start, end, first_line, chunk_func, with_line_num, encoder, binary = args
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+
+    data = _split_lines(buf, binary)
+    if with_line_num:
+        data = list(zip(range(first_line, first_line + len(data)), data))
+
+    return _process_chunk((chunk_func, data, encoder))
+
+
+def _process_chunk(args):
+    """
+    块处理方式下的工作进程方法。一次处理一个数据块，并清除结果中的None值
+    :param args: (chunk_func, data, encoder)
+    :return: 经过chunk_func处理的结果List。如果encoder不为None，返回经过encoder编码的字节数据
+    """
+    chunk_func, data, encoder = args
+    ret = []
+    for res in chunk_func(data):
+        if res is None:
+            continue
+        ret.append(res)
+    if encoder is not None:
+        return encoder(ret)
+    return ret
+
+
+def _timed_call(func, task):
+    """
+    在工作进程中执行任务并计时
+    :return: (执行时间, 结果)
+    """
+    t = time.perf_counter()
+    ret = func(task)
+    return time.perf_counter() - t, ret
+
+
+def _process_to_part(args):
+    """
+    工作进程直接把编码后的结果写入part文件，只把part文件的编号与字节数传回主进程
+    :param args: (index, func, task, part_file_name)，func返回编码后的字节数据
+    :return: (index, 字节数)
+    """
+    index, func, task, part_file_name = args
+    data = func(task)
+    with open(part_file_name, 'wb') as f:
+        f.write(data)
+    return index, len(data)
+
+
+def part_file_name(part_dir, index):
+    """
+    :return: 第index个part文件的文件名
+    """
+    return os.path.join(part_dir, 'part-{:09d}'.format(index))
+
+
+def _kernel_copy(copy, offset, size):
+    """
+    循环调用内核复制方法，直到复制完毕或者复制方法不可用
+    :param copy: 复制方法，定义为 def copy(offset, count): -> 复制的字节数
+    :param offset: 起始位置
+    :param size: 文件大小
+    :return: 复制结束的位置
+    """
+    try:
+        while offset < size:
+            n = copy(offset, size - offset)
+            if n == 0:
+                break
+            offset += n
+    except OSError:
+        pass
+    return offset
+
+
+def append_file(output_file, input_file_name):
+    """
+    将文件的内容追加到output_file的末尾。优先使用os.copy_file_range，其次是os.sendfile，数据在内核中复制，不经过用户空间；
+    两者都不可用时按块复制
+    :param output_file: 以二进制方式打开的输出文件
+    :param input_file_name: 需要追加的文件名
+    :return: 追加的字节数
+    """
+    output_file.flush()
+    out_fd = output_file.fileno()
+    with open(input_file_name, 'rb') as f:
+        in_fd = f.fileno()
+        size = os.fstat(in_fd).st_size
+        offset = 0
+        if hasattr(os, 'copy_file_range'):
+            offset = _kernel_copy(lambda pos, n: os.copy_file_range(in_fd, out_fd, n, pos), offset, size)
+        if offset < size and hasattr(os, 'sendfile'):
+            offset = _kernel_copy(lambda pos, n: os.sendfile(out_fd, in_fd, pos, n), offset, size)
+
+        # 不支持内核复制的平台或文件系统
+        if offset < size:
+            f.seek(offset)
+            os.lseek(out_fd, 0, os.SEEK_END)
+            shutil.copyfileobj(f, output_file, 1024 * 1024)
+            output_file.flush()
+
+    # 文件描述符的位置在Python的缓冲层之外移动，需要重新同步
+    output_file.seek(0, os.SEEK_END)
+    return size
+
+
+def pipelined_imap(pool, func, tasks, order=True, max_inflight=8, metrics=None):
+    """
+    流水线方式的任务分发。始终保持最多max_inflight个任务在进程池中运行，完成一个任务就补充一个任务，
+    这样主进程在写出结果、等待数据加载时，工作进程不会空闲。同时，在途任务的数量有上限，内存占用也是有界的
+
+    :param pool: 进程池
+    :param func: 工作进程执行的方法
+    :param tasks: 任务的迭代器，可以是生成器，只有在需要补充任务时才会取下一个任务
+    :param order: True时按照任务的顺序返回结果，False时按照任务完成的顺序返回结果
+    :param max_inflight: 同时在途的任务数量上限
+    :param metrics: Metrics对象。不为None时，记录任务的提交、计算与结果取回时间，以及在途任务数
+    :return: 结果的生成器
+    """
+    max_inflight = max(max_inflight, 1)
+    tasks = iter(tasks)
+    inflight = deque()  # 顺序模式下，按照提交顺序存放AsyncResult
+    done = queue.Queue()  # 乱序模式下，存放已经完成的结果
+    n_inflight = 0
+    exhausted = False
+
+    # 记录指标时，工作进程同时返回任务的执行时间
+    call = func if metrics is None else _timed_call
+
+    while True:
+        # 补充任务，直到在途任务达到上限
+        while not exhausted and n_inflight < max_inflight:
+            try:
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            call_args = (task,) if metrics is None else (func, task)
+            t = time.perf_counter()
+            if order:
+                inflight.append(pool.apply_async(call, call_args))
+            else:
+                pool.apply_async(call, call_args, callback=done.put, error_callback=done.put)
+            n_inflight += 1
+            if metrics is not None:
+                metrics.add_time('dispatch', time.perf_counter() - t)
+
+        if n_inflight == 0:
+            break
+        if metrics is not None:
+            metrics.set_depth('inflight', n_inflight)
+
+        # 取出一个结果
+        t = time.perf_counter()
+        if order:
+            res = inflight.popleft().get()
+        else:
+            res = done.get()
+            if isinstance(res, BaseException):
+                raise res
+        n_inflight -= 1
+        if metrics is not None:
+            metrics.add_time('collect', time.perf_counter() - t)
+            metrics.add_time('compute', res[0])
+            metrics.tasks += 1
+            res = res[1]
+        yield res
+
+
+class OutputEncoder:
+    """
+    在工作进程中将处理结果格式化为待写出的字节数据，并按需进行压缩。主进程只需要按顺序写出字节数据
+
+    BGZF与gzip的压缩结果都是完整的块或成员，因此各个任务的结果可以直接按顺序拼接
+    """
+
+    def __init__(self, line_breaker='\n', compress=None, compress_level=6, binary=False) -> None:
+        """
+        :param line_breaker: 换行符
+        :param compress: 压缩方式。None代表不压缩，'bgzf'为BGZF压缩，可以被tabix建立索引，'gzip'为普通gzip压缩
+        :param compress_level: 压缩等级
+        :param binary: 为True时，处理结果为bytes或其他bytes-like对象，直接拼接，不进行格式化与编码
+        """
+        assert compress in (None, 'bgzf', 'gzip'), "不支持的压缩方式:{}".format(compress)
+        self.line_breaker = line_breaker
+        self.compress = compress
+        self.compress_level = compress_level
+        self.binary = binary
+
+    def __call__(self, results):
+        line_breaker = self.line_breaker
+        if self.binary:
+            buf = line_breaker.encode().join(results) + line_breaker.encode() if len(results) > 0 else b''
+        else:
+            buf = ''.join(['{}{}'.format(line, line_breaker) for line in results]).encode()
+        if self.compress == 'bgzf':
+            return Bgzf.compress_bgzf(buf, self.compress_level)
+        if self.compress == 'gzip' and len(buf) > 0:
+            return gzip.compress(buf, self.compress_level)
+        return buf
+
+
+def infer_compress(output_file_name, compress=None):
+    """
+    确定输出文件的压缩方式
+    :param output_file_name: 输出文件名
+    :param compress: 指定的压缩方式。None代表根据文件名推断，'.gz'与'.bgz'结尾的文件采用BGZF压缩；False代表不压缩
+    :return: None、'bgzf'或'gzip'
+    """
+    if compress is None:
+        if output_file_name is not None and output_file_name.endswith(('.gz', '.bgz')):
+            return 'bgzf'
+        return None
+    if compress is False:
+        return None
+    return compress
+
+
+class ChunkTuner:
+    """
+    自适应的任务粒度。在处理过程中测量三项开销：
+        每行的计算时间：工作进程执行任务的时间除以任务的行数
+        每行的进程间通信时间：在主进程中抽样序列化任务数据，序列化与反序列化按照两倍计算
+        每行的字节数：序列化后的数据大小除以行数
+    根据测量结果调整每个任务的行数，使一个任务的计算与通信时间接近target_task_time，这样任务的固定开销可以忽略，
+    同时任务又不会大到让工作进程之间负载不均。在途的数据(max_inflight个任务，以及加载队列中的chunk)不超过mem_limit
+
+    每次调整的幅度不超过step倍，避免测量的波动造成任务大小来回变化
+    """
+
+    def __init__(self, n_jobs, max_inflight, target_task_time=0.05, mem_limit=256 * 1024 * 1024, initial_lines=16,
+                 max_lines=1000000, step=4) -> None:
+        """
+        :param n_jobs: 工作进程数
+        :param max_inflight: 在途任务数量的上限
+        :param target_task_time: 每个任务的目标执行时间，单位为秒
+        :param mem_limit: 在途数据的内存上限，单位为bytes
+        :param initial_lines: 开始测量时每个任务的行数
+        :param max_lines: 每个任务行数的上限
+        :param step: 每次调整的最大倍数
+        """
+        self.n_jobs = n_jobs
+        self.max_inflight = max_inflight
+        self.target_task_time = target_task_time
+        self.mem_limit = mem_limit
+        self.max_lines = max_lines
+        self.step = step
+        self.task_lines = initial_lines
+
+        # 测量值，取指数滑动平均
+        self.line_cost = None
+        self.ipc_cost = None
+        self.line_bytes = None
+        self.n_samples = 0
+
+    @staticmethod
+    def __ema(old, new, alpha=0.3):
+        if old is None:
+            return new
+        return old + alpha * (new - old)
+
+    def loader_lines(self):
+        """
+        :return: 数据加载器一次加载的行数，每个chunk划分为n_jobs个任务
+        """
+        return self.task_lines * self.n_jobs
+
+    def need_sample(self):
+        """
+        前几个chunk每次都抽样，之后每隔32次抽样一次
+        :return: 当前chunk是否需要测量序列化开销
+        """
+        self.n_samples += 1
+        return self.n_samples <= 4 or self.n_samples % 32 == 0
+
+    def observe_payload(self, data):
+        """
+        序列化一个任务的数据，测量每行的通信时间与字节数
+        :param data: 任务的数据块
+        :return:
+        """
+        if len(data) == 0:
+            return
+        t = time.perf_counter()
+        n_bytes = len(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        self.ipc_cost = self.__ema(self.ipc_cost, 2 * (time.perf_counter() - t) / len(data))
+        self.line_bytes = self.__ema(self.line_bytes, n_bytes / len(data))
+
+    def observe_task(self, n_lines, compute_time):
+        """
+        记录一个任务在工作进程中的执行时间
+        :param n_lines: 任务的行数
+        :param compute_time: 执行时间，单位为秒
+        :return:
+        """
+        if n_lines > 0:
+            self.line_cost = self.__ema(self.line_cost, compute_time / n_lines)
+
+    def update(self):
+        """
+        根据测量结果重新计算每个任务的行数
+        :return: 每个任务的行数
+        """
+        # 还没有任务完成时保持不变，只凭通信开销会高估任务的行数
+        if self.line_cost is None:
+            return self.task_lines
+
+        cost = self.line_cost + (self.ipc_cost or 0.0)
+        lines = self.target_task_time / max(cost, 1e-9)
+        lines = min(max(lines, self.task_lines / self.step), self.task_lines * self.step)
+
+        # 内存上限不受调整幅度的限制。在途任务与加载队列中的两个chunk都需要占用内存
+        if self.line_bytes:
+            lines = min(lines, self.mem_limit / (self.line_bytes * (self.max_inflight + 2 * self.n_jobs)))
+
+        self.task_lines = int(min(max(lines, 1), self.max_lines))
+        return self.task_lines
+
+
+class Checkpoint:
+    """
+    运行检查点。记录已经完整写出的输入行数，以及对应的输出文件字节位置，保存为JSON文件。
+    任务中断后，可以把输出文件截断到检查点的位置，并从检查点记录的行继续处理
+
+    检查点按照时间间隔节流保存，每个结果写出后只需要比较一次时间，因此可以默认开启。
+    保存时先把输出文件同步到磁盘，再以临时文件替换的方式写入检查点，保证检查点记录的数据一定已经写出
+    """
+
+    def __init__(self, checkpoint_file_name, input_file_name, output_file_name, interval=60) -> None:
+        """
+        :param checkpoint_file_name: 检查点文件名
+        :param input_file_name: 输入文件名
+        :param output_file_name: 输出文件名
+        :param interval: 保存检查点的最小时间间隔，单位为秒
+        """
+        self.checkpoint_file_name = checkpoint_file_name
+        self.input_file_name = input_file_name
+        self.output_file_name = output_file_name
+        self.interval = interval
+        self.line = 0  # 已经完整写出的输入行数，为输入文件中的绝对行号
+        self.output_offset = 0  # 对应的输出文件字节位置
+        self.last_save_time = time.time()
+
+    def __input_key(self):
+        st = os.stat(self.input_file_name)
+        return [st.st_size, st.st_mtime_ns]
+
+    def load(self):
+        """
+        读取检查点文件
+        :return: True代表读取成功，检查点文件不存在时返回False
+        """
+        if not os.path.exists(self.checkpoint_file_name):
+            return False
+        with open(self.checkpoint_file_name, 'r') as f:
+            state = json.load(f)
+        assert state['input_key'] == self.__input_key(), "输入文件:{}在检查点保存后发生了变化".format(self.input_file_name)
+        assert os.path.getsize(self.output_file_name) >= state['output_offset'], \
+            "输出文件:{}比检查点记录的长度短".format(self.output_file_name)
+        self.line = state['line']
+        self.output_offset = state['output_offset']
+        return True
+
+    def update(self, line, output_file):
+        """
+        记录一个结果已经写出。距离上次保存超过interval秒时，保存检查点
+        :param line: 已经完整写出的输入行数
+        :param output_file: 以二进制方式打开的输出文件
+        :return:
+        """
+        self.line = line
+        self.output_offset = output_file.tell()
+        if time.time() - self.last_save_time >= self.interval:
+            self.save(output_file)
+
+    def save(self, output_file):
+        """
+        将输出文件同步到磁盘，然后保存检查点
+        :param output_file: 输出文件
+        :return:
+        """
+        output_file.flush()
+        os.fsync(output_file.fileno())
+
+        state = {'input_file': self.input_file_name, 'input_key': self.__input_key(),
+                 'output_file': self.output_file_name, 'line': self.line, 'output_offset': self.output_offset}
+        tmp_name = self.checkpoint_file_name + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_name, self.checkpoint_file_name)
+        self.last_save_time = time.time()
+
+    def remove(self):
+        if os.path.exists(self.checkpoint_file_name):
+            os.remove(self.checkpoint_file_name)
+
+
+class _FileJob:
+    """
+    run_many中一个文件的处理状态
+    """
+
+    def __init__(self, input_file_name, output_file_name, encoder) -> None:
+        self.input_file_name = input_file_name
+        self.output_file_name = output_file_name
+        self.encoder = encoder  # 输出到文件时使用，None代表结果保存在内存中
+        self.file_size = os.path.getsize(input_file_name)
+        self.loader = None
+        self.output_file = None
+        self.ret = []
+        self.pending = 0  # 已经提交但还没有写出的任务数
+        self.loaded = False  # 输入文件是否已经读取完毕
+        self.finished = False
+
+    def open(self, chunk_size, with_line_num, loader_options=None):
+        self.loader = ChunkLoader(self.input_file_name, chunk_size=chunk_size, use_async=True,
+                                  with_line_num=with_line_num, **(loader_options or {}))
+        if self.output_file_name is not None:
+            self.output_file = open(self.output_file_name, 'wb')
+
+    def finish(self):
+        """
+        全部数据读取完毕，并且所有任务的结果都已经写出时，结束输出文件
+        :return:
+        """
+        if self.finished:
+            return
+        self.finished = True
+        if self.output_file is not None:
+            if self.encoder.compress == 'bgzf':
+                self.output_file.write(Bgzf.BGZF_EOF)
+            self.output_file.close()
+
+    def terminate(self):
+        if self.loader is not None and not self.loaded:
+            self.loader.terminate()
+        if self.output_file is not None:
+            self.output_file.close()
+
+
+_worker_state = None  # 工作进程中由worker_init建立的状态
+
+
+def _init_worker(worker_init):
+    """
+    进程池的initializer。每个工作进程启动时调用一次，建立该进程的状态
+    :param worker_init: 用户的初始化方法，定义为 def worker_init(state): -> None，在state中放入需要的数据
+    :return:
+    """
+    global _worker_state
+    _worker_state = {}
+    if worker_init is not None:
+        worker_init(_worker_state)
+
+
+def worker_state():
+    """
+    :return: 当前工作进程的状态dict，由ParallelLine的worker_init建立。在run_col、run_block的处理方法中也可以通过本方法获取
+    """
+    return _worker_state
+
+
+class RowFunc:
+    """
+    将行处理方法包装成块处理方法，使得run_row可以按块分发任务，减少每一行单独分发造成的进程间通信开销
+    """
+
+    def __init__(self, row_func, with_state=False) -> None:
+        """
+        :param row_func: 行处理方法
+        :param with_state: 为True时，以 row_func(line, state) 的方式调用，state为工作进程的状态
+        """
+        self.row_func = row_func
+        self.with_state = with_state
+
+    def __call__(self, data):
+        row_func = self.row_func
+        if self.with_state:
+            state = _worker_state
+            return [row_func(line, state) for line in data]
+        return [row_func(line) for line in data]
+
+
+class StateFunc:
+    """
+    以 func(data, state) 的方式调用块处理方法，state为工作进程的状态
+    """
+
+    def __init__(self, func) -> None:
+        self.func = func
+
+    def __call__(self, data):
+        return self.func(data, _worker_state)
+
+
+def _process_col_chunk(args):
+    """
+    列处理方式下的工作进程方法。将一批行切分为列，逐列调用col_func，并按列组编码为缓存文件的记录
+
+    缓存记录的结构为[col_num(u32)][batch(u32)][nbytes(u32)][数据]，数据为该列在这一批行中的值，以sep连接
+
+    :param args: (chunk2col_func, col_func, with_column_num, data, batch, sep, cols_per_file)
+                 cols_per_file为None时，不进行编码，直接返回处理后的列
+    :return: (行数, {列组编号: 记录数据})；cols_per_file为None时返回(行数, [列, ...])
+    """
+    chunk2col_func, col_func, with_column_num, data, batch, sep, cols_per_file = args
+    cols = chunk2col_func(data)
+
+    ret_cols = []
+    for i, col in enumerate(cols):
+        if with_column_num:
+            col_num, col = col_func((i + 1, col))
+        else:
+            col = col_func(col)
+        ret_cols.append(col)
+
+    if cols_per_file is None:
+        return len(data), ret_cols
+
+    groups = {}
+    for i, col in enumerate(ret_cols):
+        buf = sep.join([str(v) for v in col]).encode()
+        groups.setdefault(i // cols_per_file, []).append(struct.pack('<III', i, batch, len(buf)) + buf)
+    return len(data), {g: b''.join(records) for g, records in groups.items()}
+
+
+def _process_blocks(args):
+    """
+    block处理方式下的工作进程方法。一个任务包含同一行带中相邻的若干个block，
+    行带的原始行在工作进程中切分为二维表格，再按列范围截取各个block
+    :param args: (tag, split_func, block_func, lines, first_line, col_ranges)，
+                 tag为(行带的行数, 是否为行带的最后一个任务)，原样返回给主进程用于拼接结果；
+                 lines为行带的原始行，first_line为其中第一行在文件中的行号；col_ranges为各block的列范围[(c0, c1), ...]，从0开始，不含c1
+    :return: (tag, 各block的处理结果List)
+    """
+    tag, split_func, block_func, lines, first_line, col_ranges = args
+    table = split_func(lines)
+    row_nums = range(first_line, first_line + len(lines))
+    return tag, [block_func((row_nums, range(c0 + 1, c1 + 1), [row[c0:c1] for row in table]))
+                 for c0, c1 in col_ranges]
+
+
+def _index_col_records(f):
+    """
+    扫描一遍列缓存文件，建立各列记录的位置表，只读取记录头
+    :param f: 以二进制方式打开的列缓存文件
+    :return: {col: array('Q', [batch, 数据位置, 字节数, ...])}
+    """
+    table = {}
+    pos = 0
+    while True:
+        f.seek(pos)
+        head = f.read(12)
+        if len(head) < 12:
+            break
+        col, batch, n = struct.unpack('<III', head)
+        records = table.get(col)
+        if records is None:
+            records = table[col] = array('Q')
+        records.extend((batch, pos + 12, n))
+        pos += 12 + n
+    return table
+
+
+def _read_col_records(f, table, col_begin, col_end):
+    """
+    按照位置表读取列缓存文件中指定列范围内的记录
+    :param f: 以二进制方式打开的列缓存文件
+    :param table: _index_col_records得到的位置表
+    :param col_begin: 起始列(从0开始)，包含
+    :param col_end: 结束列，不包含
+    :return: {col: {batch: bytes}}
+    """
+    ret = {}
+    for col in range(col_begin, col_end):
+        records = table.get(col)
+        if records is None:
+            continue
+        frags = ret[col] = {}
+        for i in range(0, len(records), 3):
+            f.seek(records[i + 1])
+            frags[records[i]] = f.read(records[i + 2])
+    return ret
 
 
 class ParallelLine:
@@ -267,23 +1689,127 @@ class ParallelLine:
 
     """
 
-    def __init__(self, n_jobs=4, chunk_size=100, show_process_status=True) -> None:
+    def __init__(self, n_jobs=4, chunk_size=100, show_process_status=True, max_inflight=None, reporters=None,
+                 report_interval=5.0, target_task_time=0.05, chunk_mem_limit=256 * 1024 * 1024,
+                 worker_init=None, prefetch=None, prefetch_channel='queue', prefetch_mem=64 * 1024 * 1024) -> None:
         """
         按照行的方式，并行化处理数据的类
 
         :param n_jobs: 并行数
-        :param chunk_size: 用于指定一次性处理的块大小。建议设置为n_jobs的整数倍
+        :param chunk_size: 用于指定一次性处理的块大小。建议设置为n_jobs的整数倍。
+                           为'auto'时，run_row、run_chunk与imap在处理过程中测量计算、通信开销与行的大小，
+                           自动调整加载的行数与每个任务的行数(参见ChunkTuner)
         :param show_process_status: 是否展示处理进度
+        :param max_inflight: 同时在进程池中处理的任务数量上限。默认为None，代表2*n_jobs。该值越大，工作进程越不容易空闲，但内存占用越高
+        :param reporters: 运行指标的reporter List，参见Metrics模块。可以是Metrics.ConsoleReporter、Metrics.JsonLinesReporter，
+                          也可以是任意接收指标快照dict的callable。每次运行的指标保存在self.metrics中
+        :param report_interval: 两次报告运行指标之间的最小时间间隔，单位为秒
+        :param target_task_time: chunk_size='auto'时，每个任务的目标执行时间，单位为秒
+        :param chunk_mem_limit: chunk_size='auto'时，在途数据的内存上限，单位为bytes
+        :param worker_init: 工作进程的初始化方法，定义为 def worker_init(state): -> None。每个工作进程启动时调用一次，
+                            在state(dict)中建立参考表等需要反复使用的数据。处理方法可以通过worker_state()获取state；
+                            run_row、run_chunk、imap与run_many指定with_state=True时，以 func(data, state) 的方式调用处理方法
+        :param prefetch: 数据加载器的预加载进程最多可以领先的chunk数，参见ChunkLoader。
+                         运行指标中loader_consumer_blocks较多时，说明读取跟不上处理，可以适当增大
+        :param prefetch_channel: 数据加载器传递chunk的方式，'queue'或'shm'(共享内存环形缓冲区)，参见ChunkLoader
+        :param prefetch_mem: prefetch_channel='shm'时共享内存的大小(字节)。未指定prefetch时，按该预算确定预加载的chunk数
         """
+        assert prefetch_channel in ('queue', 'shm'), "不支持的prefetch_channel:{}".format(prefetch_channel)
 
         self.n_jobs = n_jobs
+        self.max_inflight = max_inflight if max_inflight is not None else 2 * n_jobs
+        self.auto_chunk = chunk_size == 'auto'
+        self.target_task_time = target_task_time
+        self.chunk_mem_limit = chunk_mem_limit
+        self.chunk_tuner = None  # auto模式下，最近一次运行的ChunkTuner
+        if self.auto_chunk:
+            chunk_size = 16 * n_jobs  # 初始值，运行中调整
         self.chunk_size = chunk_size
-        self.__pool_chunk_size = chunk_size // n_jobs  # 将chunksize的数据均匀地划分给n_jobs个进程。
+        self.__pool_chunk_size = max(chunk_size // n_jobs, 1)  # 将chunksize的数据均匀地划分给n_jobs个进程。
         self.__show_process_status = show_process_status
         self.__file_cache = {}  # 文件缓存。每个线程都可以创建自己的文件缓存。字典类型。通过进程号对应
+        self.reporters = reporters
+        self.report_interval = report_interval
+        self.metrics = None  # 最近一次运行的指标
+        self.worker_init = worker_init
+        self.prefetch = prefetch
+        self.prefetch_channel = prefetch_channel
+        self.prefetch_mem = prefetch_mem
+        self.__persistent = False  # 是否在多次调用之间复用进程池，通过with语句开启
+        self.__pool = None
+
+    def __prefetch_desc(self):
+        """
+        :return: 预加载配置的描述，用于输出运行配置
+        """
+        prefetch = self.prefetch if self.prefetch is not None else ('auto' if self.prefetch_channel == 'shm' else 1)
+        if self.prefetch_channel == 'shm':
+            return "shm, {} chunk, {} bytes".format(prefetch, self.prefetch_mem)
+        return "queue, {} chunk".format(prefetch)
+
+    def __loader_options(self):
+        """
+        :return: 创建ChunkLoader时的预加载参数
+        """
+        return {'prefetch': self.prefetch, 'channel': self.prefetch_channel, 'prefetch_mem': self.prefetch_mem}
+
+    def __enter__(self):
+        """
+        在with语句中使用时，多次调用run_row等方法共用同一个进程池，工作进程的状态只建立一次。with语句结束时关闭进程池
+        """
+        self.__persistent = True
+        self.__pool = self.__new_pool()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        关闭持久的进程池
+        :return:
+        """
+        self.__persistent = False
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __new_pool(self):
+        return Pool(self.n_jobs, initializer=_init_worker, initargs=(self.worker_init,))
+
+    def __acquire_pool(self):
+        """
+        :return: 持久的进程池，不在with语句中时创建新的进程池
+        """
+        if not self.__persistent:
+            return self.__new_pool()
+        if self.__pool is None:
+            self.__pool = self.__new_pool()
+        return self.__pool
+
+    def __release_pool(self, pool, error=False):
+        """
+        一次调用结束后释放进程池。持久的进程池保持运行；出错时其中可能还有未完成的任务，因此终止该进程池，下次调用时重新创建
+        :param pool: 进程池
+        :param error: 是否因为出错而释放
+        :return:
+        """
+        if error:
+            pool.terminate()
+            if pool is self.__pool:
+                pool.join()
+                self.__pool = None
+            return
+        if pool is not self.__pool:
+            pool.close()
+            pool.join()
 
     def run_row(self, input_file_name, output_file_name=None, row_func=line_proc, with_line_num=False, order=True,
-                use_CRLF=False):
+                use_CRLF=False, read_mode='loader', shard_size=64 * 1024 * 1024, compress=None, compress_level=6,
+                use_index=False, start_line=0, checkpoint=True, resume=False, checkpoint_interval=60,
+                write_mode='parent', binary=False, result_mem_limit=None, prefilter=None, skip_prefix=None,
+                with_state=False):
         """
         对文件的行并行化处理，并最终返回
 
@@ -293,153 +1819,687 @@ class ParallelLine:
         :param with_line_num: 传递给line_func的数据是否包括行号。如果包括行号，那么传递给line_func的数据为 (line_num, line_data)
         :param order: 是否按照有序的方式处理数据。True保证处理的顺序，False允许乱序处理
         :param use_CRLF: 换行模式，由于默认在Linux上运行，换行模式LF为'\n'。在win上，所采用的换行模式CRLF为'\r\n'，即回车换行
+        :param read_mode: 数据的读取方式。'loader'为默认方式，由ChunkLoader读取数据后分发给进程池；
+                          'shard'为分片方式，文件按照字节范围切分，每个工作进程自行打开文件读取自己的分片，只有结果会传回主进程；
+                          'mmap'为内存映射方式，主进程通过MmapChunkLoader定位行边界，只把LineBlock视图分发给工作进程，数据在工作进程中按需解码。
+                          'shard'与'mmap'只支持未压缩的文件
+        :param shard_size: 分片方式下，每个分片的近似字节数
+        :param compress: 输出文件的压缩方式。None代表根据文件名推断，'.gz'与'.bgz'结尾时采用BGZF压缩；
+                         也可以指定为'bgzf'、'gzip'或False(不压缩)。压缩在工作进程中并行完成，BGZF输出可以被tabix建立索引
+        :param compress_level: 压缩等级
+        :param use_index: 是否使用行索引(参见LineIndex)。第一次使用时并行扫描文件建立索引，并保存在输入文件同目录的'.lidx'文件中，
+                          之后直接读取。使用索引时，'shard'方式按照行数均匀地切分分片
+        :param start_line: 从第几行开始处理，行号从0开始。有行索引时直接定位到最近的索引点，不需要读取前面的全部行。
+                           'shard'与'mmap'方式下，start_line>0时总是使用行索引
+        :param checkpoint: 检查点文件。True代表使用output_file_name+'.ckpt'，也可以指定文件名，False代表不使用检查点。
+                           检查点只在顺序处理并输出到文件时生效，处理完毕后会被删除。
+                           'shard'方式只在use_index=True、start_line>0或者已有行索引时使用检查点
+        :param resume: 是否从检查点继续处理。为True且检查点存在时，输出文件被截断到检查点记录的位置，并从检查点记录的行继续处理，
+                       此时start_line被忽略；检查点不存在时从头开始处理
+        :param checkpoint_interval: 保存检查点的最小时间间隔，单位为秒
+        :param write_mode: 结果的写出方式，只在输出到文件时生效。'parent'为默认方式，编码后的结果传回主进程，由主进程写出；
+                           'parts'方式下，工作进程把每个任务的结果直接写入输出文件同目录下的part文件，只把字节数传回主进程，
+                           主进程按照任务的顺序，通过os.copy_file_range/os.sendfile把part文件拼接到输出文件中，结果数据不经过主进程；
+                           'manifest'方式下，part文件保留在output_file_name+'.parts'目录中，输出文件只记录按顺序排列的part文件路径，
+                           每行一个，可以通过 cat $(cat output_file_name) 得到完整的结果，不支持检查点。
+                           后两种方式下，任务按照完成的顺序收集，结果总是按照输入的顺序拼接，不受order的影响
+        :param binary: 是否以二进制方式处理。为True时，文件以二进制方式读取，传递给row_func的行为去掉换行符的bytes，
+                       row_func也需要返回bytes，结果直接拼接写出。省去了文本的解码与编码，适用于ASCII数据
+        :param result_mem_limit: 只在结果输出到内存时生效。为None时结果以List返回；否则结果以PList返回，
+                                 工作进程把结果编码为一段连续的字节数据，主进程只保存字节数据与每条结果的偏移量，
+                                 不需要为每条结果创建一个对象。超过result_mem_limit字节的数据写入临时目录中的磁盘文件，
+                                 不需要写入磁盘时可以指定为float('inf')
+        :param prefilter: 保留行的条件，可以是编译好的正则表达式(binary=True时为bytes的正则表达式)，或者是 def func(line): -> bool。
+                          过滤在预加载进程中完成，不满足条件的行不会进入进程队列，也不会交给row_func，with_line_num得到的仍然是行在文件中的行号。
+                          只支持'loader'读取方式
+        :param skip_prefix: 需要跳过的行的前缀，可以是str、bytes或者它们的tuple，例如'##'。与prefilter相同，在预加载进程中完成
+        :param with_state: 为True时，以 row_func(data, state) 的方式调用，state为worker_init建立的工作进程状态
         :return: 返回经过处理的结果。如果outfile!=None，那么处理的结果将会直接写入到文件中; 如果outfile=None，这意味着会返回处理List，其中包括经过处理后的所有行
         """
+        return self.__run_lines('@run_row:\t', input_file_name, output_file_name,
+                                RowFunc(row_func, with_state), with_line_num,
+                                order, use_CRLF, read_mode, shard_size, compress, compress_level, use_index,
+                                start_line, checkpoint, resume, checkpoint_interval, write_mode, binary,
+                                result_mem_limit, prefilter, skip_prefix)
+
+    def run_chunk(self, input_file_name, output_file_name=None, chunk_func=chunk_proc, with_line_num=False,
+                  order=True, use_CRLF=False, read_mode='loader', shard_size=64 * 1024 * 1024, compress=None,
+                  compress_level=6, use_index=False, start_line=0, checkpoint=True, resume=False,
+                  checkpoint_interval=60, write_mode='parent', binary=False, result_mem_limit=None, prefilter=None,
+                  skip_prefix=None, with_state=False):
+        """
+        对文件按块并行化处理。与run_row不同，chunk_func一次接收一个数据块(多行组成的List)，并返回结果的List。
+        对于单行处理开销很小的方法，按块处理可以省去逐行分发带来的函数查找、序列化和结果传递的开销
+
+        'loader'方式下，ChunkLoader加载的每个chunk会均分为n_jobs份，每份作为一个数据块交给chunk_func；
+        'shard'方式下，每个分片作为一个数据块交给chunk_func；
+        'mmap'方式下，数据块是一个LineBlock，可以像List一样使用，也可以通过LineBlock.buffer和LineBlock.offsets()直接访问字节数据
+
+        :param input_file_name: 待处理的文件名
+        :param output_file_name: 处理完毕需要输出的文件。默认为None，代表结果将会以list的方式存放在内存中，并最后返回
+        :param chunk_func: 块处理方法。方法定义为 def func(data): -> [ProcessedLine, ...]。返回结果中的None值不会被写出
+        :param with_line_num: 传递给chunk_func的数据块是否包括行号。如果包括行号，数据块的结构为[(line_num, line_data), ...]
+        :param order: 是否按照有序的方式处理数据。True保证处理的顺序，False允许乱序处理
+        :param use_CRLF: 换行模式，True时采用'\r\n'进行换行
+        :param read_mode: 数据的读取方式，可以为'loader'、'shard'或'mmap'，含义同run_row
+        :param shard_size: 分片方式下，每个分片的近似字节数
+        :param compress: 输出文件的压缩方式，含义同run_row
+        :param compress_level: 压缩等级
+        :param use_index: 是否使用行索引，含义同run_row
+        :param start_line: 从第几行开始处理，含义同run_row
+        :param checkpoint: 检查点文件，含义同run_row
+        :param resume: 是否从检查点继续处理，含义同run_row
+        :param checkpoint_interval: 保存检查点的最小时间间隔，单位为秒
+        :param write_mode: 结果的写出方式，含义同run_row
+        :param binary: 是否以二进制方式处理，含义同run_row。数据块中的行为bytes，chunk_func返回bytes的List
+        :param result_mem_limit: 结果输出到内存时，以PList保存结果，含义同run_row
+        :param prefilter: 保留行的条件，含义同run_row。数据块中只包含满足条件的行
+        :param skip_prefix: 需要跳过的行的前缀，含义同run_row
+        :param with_state: 为True时，以 chunk_func(data, state) 的方式调用，state为worker_init建立的工作进程状态
+        :return: 如果output_file_name!=None，处理的结果将会直接写入到文件中; 否则返回处理结果的List或PList
+        """
+        if with_state:
+            chunk_func = StateFunc(chunk_func)
+        return self.__run_lines('@run_chunk:\t', input_file_name, output_file_name, chunk_func, with_line_num,
+                                order, use_CRLF, read_mode, shard_size, compress, compress_level, use_index,
+                                start_line, checkpoint, resume, checkpoint_interval, write_mode, binary,
+                                result_mem_limit, prefilter, skip_prefix)
+
+    def imap(self, input_file_name, row_func=line_proc, with_line_num=False, order=True, read_mode='loader',
+             shard_size=64 * 1024 * 1024, binary=False, prefilter=None, skip_prefix=None, with_state=False):
+        """
+        以迭代器的方式对文件的行并行化处理。处理结果按需产生，在途的任务数量受max_inflight限制，
+        因此可以把多个处理步骤串联起来，例如解析、过滤、汇总，而不需要生成中间文件或完整的List
+
+        迭代器没有遍历完就被丢弃或调用close()时，进程池与预加载进程会被终止
+
+        :param input_file_name: 待处理的文件名
+        :param row_func: 用于行处理的方法，返回None的行不会出现在结果中
+        :param with_line_num: 传递给row_func的数据是否包括行号，含义同run_row
+        :param order: 是否按照有序的方式返回结果
+        :param read_mode: 数据的读取方式，含义同run_row
+        :param shard_size: 分片方式下，每个分片的近似字节数
+        :param binary: 是否以二进制方式处理，含义同run_row
+        :param prefilter: 保留行的条件，含义同run_row
+        :param skip_prefix: 需要跳过的行的前缀，含义同run_row
+        :param with_state: 为True时，以 row_func(data, state) 的方式调用，含义同run_row
+        :return: 处理结果的生成器
+        """
+        pool = self.__acquire_pool()
+        self.progressbar = None
+        self.metrics = Metrics.Metrics(self.reporters, self.report_interval)
+        self.metrics.start(os.path.getsize(input_file_name))
+        results = self.__iter_results(pool, input_file_name, RowFunc(row_func, with_state),
+                                      with_line_num, order, read_mode, shard_size, None, None, 0, binary=binary,
+                                      prefilter=prefilter, skip_prefix=skip_prefix)
+        try:
+            for data in results:
+                for res in data:
+                    yield res
+        except BaseException:
+            self.__release_pool(pool, error=True)
+            raise
+        finally:
+            results.close()
+            self.metrics.finish()
+
+        self.__release_pool(pool)
+
+    def __run_lines(self, prefix, input_file_name, output_file_name, chunk_func, with_line_num, order, use_CRLF,
+                    read_mode, shard_size, compress, compress_level, use_index, start_line, checkpoint, resume,
+                    checkpoint_interval, write_mode, binary, result_mem_limit, prefilter, skip_prefix):
+        """
+        run_row与run_chunk的公共实现。数据以块为单位分发给进程池，由chunk_func完成处理
 
-        # 在文件内部打开
-        output_file = open(output_file_name, 'w')
+        :return: 参见run_chunk
+        """
+        assert write_mode in ('parent', 'parts', 'manifest'), "不支持的写出方式:{}".format(write_mode)
+        assert write_mode == 'parent' or output_file_name is not None, "{}方式必须指定输出文件".format(write_mode)
+        compress = infer_compress(output_file_name, compress)
 
         #### 公共展示信息补充 ####
         __cache_mode = 'File'
-        if output_file == None:
+        output_file = None
+        ckpt = None
+        if output_file_name == None:
             __cache_mode = 'Mem'  # 如果没有打开的输出文件，将使用内存作为缓存区
+        else:
+            # 检查点只对顺序写出的结果有效。'parts'方式总是按顺序拼接结果，'manifest'方式的part文件在重新运行时会被覆盖
+            # 'shard'方式需要通过行索引得到每个分片的行数。没有要求使用索引、也没有已有的索引时不使用检查点，
+            # 不为检查点额外扫描一遍文件
+            if read_mode == 'shard' and not use_index and start_line == 0 and \
+                    LineIndex.LineIndex.load(input_file_name) is None:
+                checkpoint = False
+            if checkpoint is not False and (order or write_mode == 'parts') and write_mode != 'manifest':
+                ckpt = Checkpoint(output_file_name + '.ckpt' if checkpoint is True else checkpoint, input_file_name,
+                                  output_file_name, checkpoint_interval)
+
+            # 在文件内部打开。结果在工作进程中编码为字节，因此以二进制方式写出
+            if resume and ckpt is not None and ckpt.load():
+                # 丢弃检查点之后写出的不完整结果，从检查点记录的行继续
+                output_file = open(output_file_name, 'r+b')
+                output_file.truncate(ckpt.output_offset)
+                output_file.seek(ckpt.output_offset)
+                start_line = ckpt.line
+            else:
+                output_file = open(output_file_name, 'wb')
 
-        # 获取输入文夹的大小。
-        __in_file_size = 0
-        if input_file_name.endswith('.vcf'):
-            __in_file_size = os.path.getsize(input_file_name)
-        elif input_file_name.endswith('.gz'):
-            __in_file_size = assume_gzip_origin_size(input_file_name)
+        # 获取输入文件在磁盘上的大小。处理进度由加载器的读取位置决定，压缩文件按照压缩数据的位置计算
+        __in_file_size = os.path.getsize(input_file_name)
+
+        # 行索引。'shard'方式下，检查点需要通过索引得到每个分片的行数；从检查点继续时，通过索引定位到检查点记录的行
+        line_index = None
+        if use_index or (ckpt is not None and read_mode == 'shard') or \
+                (start_line > 0 and (read_mode != 'loader' or (resume and not input_file_name.endswith('.gz')))):
+            line_index = LineIndex.get_line_index(input_file_name, n_jobs=self.n_jobs)
 
         # 初始化线程池，包括1个预加载器、n_jobs个数据处理器、主进程负责数据的分发、收集和写入
-        chunk_loader = ChunkLoader(input_file_name, chunk_size=self.chunk_size, use_async=True,
-                                   with_line_num=with_line_num)
-        pool = Pool(self.n_jobs)
+        pool = self.__acquire_pool()
 
         #### 参数初始化 ####
         line_breaker = '\n'
         if use_CRLF:
             line_breaker = '\r\n'
 
+        # 写出文件时，结果的格式化与压缩都在工作进程中完成
+        encoder = None
+        if __cache_mode == 'File':
+            encoder = OutputEncoder(line_breaker, compress, compress_level, binary)
+        elif result_mem_limit is not None:
+            # 结果在工作进程中编码为PList的记录格式
+            encoder = Container.encode_records
+
         # 列出运行配置
         print("ParallelLine使用配置:")
-        prefix = "@run_row:\t"
         print(prefix + "顺序处理={}".format(order))
         print(prefix + "n_jobs={}".format(self.n_jobs))
-        print(prefix + "pool_chunksize={}".format(self.__pool_chunk_size))
+        print(prefix + "pool_chunksize={}".format('auto' if self.auto_chunk else self.__pool_chunk_size))
+        print(prefix + "max_inflight={}".format(self.max_inflight))
+        print(prefix + "读取方式={}".format(read_mode))
         print(prefix + "缓存模式={}".format(__cache_mode))
+        print(prefix + "输出压缩={}".format(compress))
+        print(prefix + "写出方式={}".format(write_mode))
+        if __cache_mode == 'Mem' and result_mem_limit is not None:
+            print(prefix + "结果内存上限={} bytes".format(result_mem_limit))
+        print(prefix + "二进制模式={}".format(binary))
+        if prefilter is not None or skip_prefix is not None:
+            print(prefix + "预过滤={}".format(prefilter if skip_prefix is None else (prefilter, skip_prefix)))
+        if read_mode == 'loader':
+            print(prefix + "预加载={}".format(self.__prefetch_desc()))
         print(prefix + "展示处理进度={}".format(self.__show_process_status))
         print(prefix + "输入文件大小={} bytes".format(__in_file_size))
-
+        if line_index is not None:
+            print(prefix + "输入文件行数={}".format(line_index.n_lines))
+        if start_line > 0:
+            print(prefix + "起始行={}".format(start_line))
+        if ckpt is not None:
+            print(prefix + "检查点={}".format(ckpt.checkpoint_file_name))
+
+        self.progressbar = None
         if self.__show_process_status:
             self.progressbar = pb.ProgressBar(maxval=__in_file_size)
             self.progressbar.start()
-            self.load_file_size = 0
+        metrics = self.metrics = Metrics.Metrics(self.reporters, self.report_interval)
+        metrics.start(__in_file_size)
+
+        # part文件的目录。'parts'方式在输出文件同目录下创建临时目录，保证拼接时源文件与输出文件在同一个文件系统中
+        part_dir = None
+        if write_mode != 'parent':
+            output_dir = os.path.dirname(os.path.abspath(output_file_name))
+        if write_mode == 'parts':
+            part_dir = tempfile.mkdtemp(prefix='.parts_', dir=output_dir)
+        elif write_mode == 'manifest':
+            part_dir = output_file_name + '.parts'
+            shutil.rmtree(part_dir, ignore_errors=True)
+            os.makedirs(part_dir)
+        parts_done = {}  # 已经完成但还不能按顺序拼接的part文件，编号 -> 字节数
+        next_part = 0  # 下一个需要拼接的part文件编号
 
         # 用于缓存已经处理过的所有行
         ret = []
+        if encoder is Container.encode_records:
+            ret = Container.PList(mem_limit=result_mem_limit,
+                                  cache_dir=os.path.join(tempfile.gettempdir(), 'ParallelLine_{}'.format(os.getpid())))
+        # 各任务包含的输入行数，顺序处理时与结果一一对应，用于记录检查点
+        task_lines = deque() if ckpt is not None else None
+        done_line = start_line
+        try:
+            # part文件由主进程按编号重新排序，任务按照完成的顺序收集即可
+            for data in self.__iter_results(pool, input_file_name, chunk_func, with_line_num,
+                                            order and part_dir is None, read_mode, shard_size, encoder, line_index,
+                                            start_line, task_lines, part_dir, binary, prefilter, skip_prefix):
+                # 返回或写入
+                t = time.perf_counter()
+                if __cache_mode == 'Mem':
+                    if encoder is not None:
+                        ret.extend_encoded(*data)
+                    else:
+                        ret += data
+                elif part_dir is not None:
+                    index, n_bytes = data
+                    metrics.output_bytes += n_bytes
+                    parts_done[index] = n_bytes
+                    while next_part in parts_done:
+                        name = part_file_name(part_dir, next_part)
+                        if parts_done.pop(next_part) == 0:
+                            os.remove(name)
+                        elif write_mode == 'parts':
+                            append_file(output_file, name)
+                            os.remove(name)
+                        else:
+                            output_file.write((os.path.relpath(name, output_dir) + '\n').encode())
+                        next_part += 1
+                        if ckpt is not None:
+                            done_line += task_lines.popleft()
+                            ckpt.update(done_line, output_file)
+                else:
+                    output_file.write(data)
+                    metrics.output_bytes += len(data)
+                    if ckpt is not None:
+                        done_line += task_lines.popleft()
+                        ckpt.update(done_line, output_file)
+                metrics.add_time('write', time.perf_counter() - t)
+                metrics.tick()
+
+            if compress == 'bgzf':
+                if write_mode == 'manifest':
+                    name = os.path.join(part_dir, 'part-eof')
+                    with open(name, 'wb') as f:
+                        f.write(Bgzf.BGZF_EOF)
+                    output_file.write((os.path.relpath(name, output_dir) + '\n').encode())
+                else:
+                    output_file.write(Bgzf.BGZF_EOF)
+        except BaseException:
+            # 处理出错时，终止进程池，避免阻塞在未取走的数据上
+            self.__release_pool(pool, error=True)
+            if output_file is not None:
+                # 保存最后一个完整写出的结果作为检查点
+                if ckpt is not None:
+                    ckpt.save(output_file)
+                output_file.close()
+            if write_mode == 'parts':
+                shutil.rmtree(part_dir, ignore_errors=True)
+            metrics.finish()
+            raise
+
+        print("处理完毕")
+        if self.progressbar is not None:
+            self.progressbar.finish()
+        metrics.finish()
+
+        # 处理完毕，这里清除一下信息
+        self.__release_pool(pool)
+
+        # 关闭打开的文件
+        if output_file is not None:
+            output_file.close()
+        if write_mode == 'parts':
+            shutil.rmtree(part_dir, ignore_errors=True)
+        if ckpt is not None:
+            ckpt.remove()
+        if __cache_mode == 'Mem':
+            return ret
+
+    def __iter_results(self, pool, input_file_name, chunk_func, with_line_num, order, read_mode, shard_size, encoder,
+                       line_index, start_line, task_lines=None, part_dir=None, binary=False, prefilter=None,
+                       skip_prefix=None):
+        """
+        按照读取方式生成任务，并以流水线方式交给进程池处理
+        :param line_index: 输入文件的LineIndex，可以为None
+        :param start_line: 从第几行开始处理
+        :param task_lines: 不为None时，按照任务的顺序，在其中追加每个任务包含的输入行数
+        :param part_dir: 不为None时，工作进程把编码后的结果写入该目录下的part文件，参见_process_to_part
+        :param binary: 是否以二进制方式读取，行为bytes
+        :param prefilter: 保留行的条件，由ChunkLoader在预加载进程中执行
+        :param skip_prefix: 需要跳过的行的前缀，由ChunkLoader在预加载进程中执行
+
+        :return: 各任务结果的生成器，结果为List，或者是经过encoder编码的字节数据；part_dir不为None时为(任务编号, 字节数)
+        """
+        assert read_mode in ('loader', 'shard', 'mmap'), "不支持的读取方式:{}".format(read_mode)
+        if read_mode != 'loader':
+            assert not input_file_name.endswith('.gz'), "{}方式只支持未压缩的文件，收到:{}".format(read_mode,
+                                                                                          input_file_name)
+        if prefilter is not None or skip_prefix is not None:
+            assert read_mode == 'loader', "预过滤只支持'loader'读取方式，收到:{}".format(read_mode)
+        self.load_file_size = 0
+
+        # auto模式下，根据测量的开销调整任务大小。分片方式的任务大小由shard_size决定，不做调整
+        tuner = None
+        tuner_lines = None  # 各任务的行数，用于计算每行的计算时间
+        loader_chunk_size = self.chunk_size
+        task_chunk_size = self.__pool_chunk_size
+        if self.auto_chunk and read_mode != 'shard':
+            tuner = self.chunk_tuner = ChunkTuner(self.n_jobs, self.max_inflight, self.target_task_time,
+                                                  self.chunk_mem_limit)
+            tuner_lines = deque()
+            loader_chunk_size = tuner.loader_lines()
+            task_chunk_size = tuner.task_lines
+
+        chunk_loader = None
+        try:
+            if read_mode == 'shard':
+                func = _process_shard
+                tasks = self.__shard_tasks(pool, input_file_name, chunk_func, with_line_num, encoder, shard_size,
+                                           line_index, start_line, task_lines, binary)
+            else:
+                if read_mode == 'mmap':
+                    # 每个LineBlock直接作为一个任务
+                    chunk_loader = MmapChunkLoader(input_file_name, chunk_size=task_chunk_size,
+                                                   with_line_num=with_line_num, start_line=start_line,
+                                                   line_index=line_index, binary=binary)
+                else:
+                    chunk_loader = ChunkLoader(input_file_name, chunk_size=loader_chunk_size, use_async=True,
+                                               with_line_num=with_line_num, decompress_jobs=self.n_jobs,
+                                               start_line=start_line, line_index=line_index, binary=binary,
+                                               prefilter=prefilter, skip_prefix=skip_prefix,
+                                               **self.__loader_options())
+                func = _process_chunk
+                tasks = self.__loader_tasks(chunk_loader, chunk_func, encoder, task_lines, tuner, tuner_lines)
+
+            if part_dir is not None:
+                task_func = func
+                tasks = ((i, task_func, task, part_file_name(part_dir, i)) for i, task in enumerate(tasks))
+                func = _process_to_part
+
+            # 流水线处理，返回的结果中已经清除了None值
+            compute_time = 0.0
+            for data in pipelined_imap(pool, func, tasks, order, self.max_inflight, self.metrics):
+                if tuner is not None:
+                    # 乱序模式下结果与任务的顺序不一致，但各任务的行数接近，不影响平均值的测量
+                    tuner.observe_task(tuner_lines.popleft(), self.metrics.stage_time['compute'] - compute_time)
+                    compute_time = self.metrics.stage_time['compute']
+                yield data
+        except BaseException:
+            # 处理出错或迭代被提前终止时，终止预加载进程，避免阻塞在未取走的数据上
+            if chunk_loader is not None:
+                chunk_loader.terminate()
+            raise
+
+        if chunk_loader is not None:
+            chunk_loader.close()
+
+    def __loader_tasks(self, chunk_loader, chunk_func, encoder, task_lines=None, tuner=None, tuner_lines=None):
+        """
+        从ChunkLoader中按需获取数据，并将每个chunk均分为多个数据块，作为进程池的任务
+        处理进度与运行指标都以chunk为单位记录，进度取自加载器在磁盘文件中的读取位置
+        :param task_lines: 不为None时，在其中追加每个任务包含的行数
+        :param tuner: ChunkTuner。不为None时，每获取一个chunk，就根据测量结果调整任务的行数与加载器一次加载的行数
+        :param tuner_lines: tuner不为None时，在其中追加每个任务包含的行数
+        :return: 任务的生成器，任务结构为(chunk_func, data, encoder)
+        """
+        metrics = self.metrics
+        task_chunk_size = self.__pool_chunk_size
         while True:
 
             # 获取一份数据
+            t = time.perf_counter()
+            task_start = chunk_loader.LineNum
             data = chunk_loader.get()
+            metrics.add_time('load', time.perf_counter() - t)
+            metrics.lines += len(data)
+            metrics.input_pos = chunk_loader.file_pos
+            if isinstance(chunk_loader, ChunkLoader):
+                metrics.set_depth('loader_queue', chunk_loader.queue_depth())
+                metrics.set_count('loader_producer_blocks', chunk_loader.producer_blocks)
+                metrics.set_count('loader_consumer_blocks', chunk_loader.consumer_blocks)
+                if chunk_loader.channel == 'shm':
+                    metrics.set_count('ring_overflows', chunk_loader.ring_overflows)
 
             # 展示文件的处理进度
-            if self.__show_process_status:
-                for line in data:
-                    if with_line_num:
-                        self.load_file_size += len(line[1])
-                    else:
-                        self.load_file_size += len(line)
-                if self.__show_process_status:
-                    if self.load_file_size > __in_file_size:
-                        self.load_file_size = __in_file_size
-                    self.progressbar.update(self.load_file_size)
+            if self.progressbar is not None:
+                self.load_file_size = min(chunk_loader.file_pos, chunk_loader.file_size)
+                self.progressbar.update(self.load_file_size)
 
             # 加快获取文件末尾的效率
             if len(data) == 0:
-                print("处理完毕")
-                if self.__show_process_status:
-                    self.progressbar.finish()
                 break
 
-            # 处理
-            if order:
-                data1 = pool.imap(row_func, data, chunksize=self.n_jobs)
-            else:
-                data1 = pool.imap_unordered(row_func, data, chunksize=self.n_jobs)
-
-            # 数据重整，主要是清除返回的数据中存在的None值
-            data2 = []
-            for res in data1:
-                if res == None:
-                    continue
-                data2.append(res)
-
-            # 返回或写入
-            if __cache_mode == 'Mem':
-                ret += data2
-            else:
-                for line in data2:
-                    output_file.write('{}{}'.format(line, line_breaker))
-
-        # 处理完毕，这里清除一下信息
-        chunk_loader.close()
-        pool.close()
-        pool.join()
+            if tuner is not None:
+                if tuner.need_sample():
+                    tuner.observe_payload(data if isinstance(data, LineBlock) else data[:tuner.task_lines])
+                task_chunk_size = tuner.update()
+                # 对之后加载的chunk生效，mmap加载器的每个LineBlock就是一个任务
+                if isinstance(chunk_loader, MmapChunkLoader):
+                    chunk_loader.chunk_size = task_chunk_size
+                else:
+                    chunk_loader.chunk_size = tuner.loader_lines()
+
+            # LineBlock已经按照pool_chunksize划分，直接分发
+            if isinstance(data, LineBlock):
+                if task_lines is not None:
+                    task_lines.append(len(data))
+                if tuner_lines is not None:
+                    tuner_lines.append(len(data))
+                yield chunk_func, data, encoder
+                continue
+
+            # 将chunk均分为多个数据块，每个数据块作为一个任务分发
+            line_nums = chunk_loader.line_nums
+            for i in range(0, len(data), task_chunk_size):
+                piece = data[i:i + task_chunk_size]
+                if task_lines is not None:
+                    if line_nums is None:
+                        task_lines.append(len(piece))
+                    else:
+                        # 过滤后的行号不连续，任务的行数包括到下一个任务第一行之前被过滤掉的行
+                        end = chunk_loader.LineNum
+                        if i + task_chunk_size < len(data):
+                            end = line_nums[i + task_chunk_size]
+                        task_lines.append(end - task_start)
+                        task_start = end
+                if tuner_lines is not None:
+                    tuner_lines.append(len(piece))
+                yield chunk_func, piece, encoder
+
+    def __shard_tasks(self, pool, input_file_name, chunk_func, with_line_num, encoder, shard_size, line_index,
+                      start_line, task_lines=None, binary=False):
+        """
+        分片读取方式的任务。文件按照字节范围切分，由工作进程自行读取分片并处理，主进程只负责结果的收集和写入
+        有行索引时，分片按照行数均匀切分，各分片的起始行号直接由索引得到
+        task_lines不为None时，在其中追加每个分片包含的行数，此时必须提供行索引
+        :return: 任务的生成器，任务结构参见_process_shard
+        """
+        if line_index is not None:
+            start = line_index.line_offset(start_line)
+            n_shards = max(-(-(os.path.getsize(input_file_name) - start) // shard_size), 1)
+            shards = line_index.split(n_shards, start_line)
+            ranges = [(start, end) for (start, end, _) in shards]
+            first_lines = [first_line for (_, _, first_line) in shards]
+        else:
+            ranges = split_file_ranges(input_file_name, shard_size)
+
+            # 需要行号时，先并行统计各分片的行数，由此得到每个分片的起始行号
+            first_lines = [0] * len(ranges)
+            if with_line_num:
+                counts = pool.map(_count_range_lines, [(input_file_name, start, end) for (start, end) in ranges])
+                line_num = 0
+                for i, count in enumerate(counts):
+                    first_lines[i] = line_num
+                    line_num += count
+
+        for i, (start, end) in enumerate(ranges):
+            # 有行索引时，分片的行数可以直接得到
+            if line_index is not None:
+                next_line = first_lines[i + 1] if i + 1 < len(ranges) else line_index.n_lines
+                self.metrics.lines += next_line - first_lines[i]
+                if task_lines is not None:
+                    task_lines.append(next_line - first_lines[i])
+            self.metrics.input_pos = end
+            if self.progressbar is not None:
+                self.load_file_size = end
+                self.progressbar.update(self.load_file_size)
+            yield input_file_name, start, end, first_lines[i], chunk_func, with_line_num, encoder, binary
+
+    def run_many(self, jobs, row_func=line_proc, with_line_num=False, use_CRLF=False, compress=None, compress_level=6,
+                 output_suffix=None, max_open=4, with_state=False):
+        """
+        在同一个进程池中并行处理多个文件。文件按照大小从大到小排列，同时打开最多max_open个文件，
+        各文件的chunk交替提交给进程池，因此小文件不会让工作进程空闲，也只需要启动一次进程池。
+        每个输出文件中结果的顺序与输入文件一致，处理进度与运行指标是所有文件的合计
+
+        :param jobs: 待处理的文件。可以是[(input_file_name, output_file_name), ...]，output_file_name为None代表结果保存在内存中；
+                     也可以是输入文件名的List或者glob模式，此时输出文件名为输入文件名加上output_suffix
+        :param row_func: 用于行处理的方法，含义同run_row
+        :param with_line_num: 传递给row_func的数据是否包括行号，行号在每个文件中从0开始
+        :param use_CRLF: 换行模式，True时采用'\r\n'进行换行
+        :param compress: 输出文件的压缩方式，含义同run_row，按照每个输出文件的文件名分别推断
+        :param compress_level: 压缩等级
+        :param output_suffix: jobs为输入文件名时，输出文件名的后缀。为None代表结果保存在内存中
+        :param max_open: 同时读取的文件数量上限，每个打开的文件占用一个预加载进程
+        :param with_state: 为True时，以 row_func(data, state) 的方式调用，含义同run_row
+        :return: 有结果保存在内存中时，返回{input_file_name: 结果List}，否则返回None
+        """
+        if isinstance(jobs, str):
+            jobs = sorted(glob.glob(jobs))
+        pairs = []
+        for job in jobs:
+            if isinstance(job, str):
+                job = (job, None if output_suffix is None else job + output_suffix)
+            pairs.append(job)
+
+        line_breaker = '\r\n' if use_CRLF else '\n'
+        file_jobs = []
+        for input_file_name, output_file_name in pairs:
+            encoder = None
+            if output_file_name is not None:
+                encoder = OutputEncoder(line_breaker, infer_compress(output_file_name, compress), compress_level)
+            file_jobs.append(_FileJob(input_file_name, output_file_name, encoder))
+        # 大文件优先处理，避免最后只剩一个大文件在处理
+        file_jobs.sort(key=lambda job: job.file_size, reverse=True)
+        total_size = sum(job.file_size for job in file_jobs)
+
+        prefix = '@run_many:\t'
+        print("ParallelLine使用配置:")
+        print(prefix + "文件数量={}".format(len(file_jobs)))
+        print(prefix + "n_jobs={}".format(self.n_jobs))
+        print(prefix + "chunk_size={}".format(self.chunk_size))
+        print(prefix + "max_inflight={}".format(self.max_inflight))
+        print(prefix + "max_open={}".format(max_open))
+        print(prefix + "展示处理进度={}".format(self.__show_process_status))
+        print(prefix + "输入文件总大小={} bytes".format(total_size))
 
-        # 关闭打开的文件
-        output_file.close()
-        if __cache_mode == 'Mem':
+        self.progressbar = None
+        if self.__show_process_status:
+            self.progressbar = pb.ProgressBar(maxval=total_size)
+            self.progressbar.start()
+        metrics = self.metrics = Metrics.Metrics(self.reporters, self.report_interval)
+        metrics.start(total_size)
+
+        chunk_func = RowFunc(row_func, with_state)
+        task_jobs = deque()  # 各任务所属的文件，结果按照任务的顺序返回
+        pool = self.__acquire_pool()
+        try:
+            tasks = self.__many_tasks(file_jobs, chunk_func, with_line_num, max_open, task_jobs)
+            for data in pipelined_imap(pool, _process_chunk, tasks, True, self.max_inflight, metrics):
+                job = task_jobs.popleft()
+                t = time.perf_counter()
+                if job.output_file is None:
+                    job.ret += data
+                else:
+                    job.output_file.write(data)
+                    metrics.output_bytes += len(data)
+                job.pending -= 1
+                if job.loaded and job.pending == 0:
+                    job.finish()
+                metrics.add_time('write', time.perf_counter() - t)
+                metrics.tick()
+        except BaseException:
+            self.__release_pool(pool, error=True)
+            for job in file_jobs:
+                job.terminate()
+            metrics.finish()
+            raise
+
+        print("处理完毕")
+        if self.progressbar is not None:
+            self.progressbar.finish()
+        metrics.finish()
+        self.__release_pool(pool)
+
+        ret = {job.input_file_name: job.ret for job in file_jobs if job.output_file_name is None}
+        if len(ret) > 0:
             return ret
 
-    def __run_col(self, input_file_name, output_file_name=None, with_cache_file=True, chunk2col_func=chunk2col,
-                  col_func=col_proc,
-                  with_column_num=True, use_CRLF=False):
+    def __many_tasks(self, file_jobs, chunk_func, with_line_num, max_open, task_jobs):
         """
-        对文件的列进行处理。（有列意味着必须有列的分割符号，这里需要写一个行构成的块如何转化为列的处理方法)
+        轮流从打开的文件中获取chunk，每个chunk均分为多个任务。一个文件读取完毕后，打开下一个文件
+        :param task_jobs: 在其中按照任务的顺序追加任务所属的_FileJob
+        :return: 任务的生成器，任务结构为(chunk_func, data, encoder)
+        """
+        metrics = self.metrics
+        waiting = deque(file_jobs)
+        active = []
+        loaded_size = 0  # 已经读取完毕的文件大小之和
+        while len(active) > 0 or len(waiting) > 0:
+            while len(waiting) > 0 and len(active) < max(max_open, 1):
+                job = waiting.popleft()
+                job.open(self.chunk_size, with_line_num, self.__loader_options())
+                active.append(job)
+
+            for job in list(active):
+                t = time.perf_counter()
+                data = job.loader.get()
+                metrics.add_time('load', time.perf_counter() - t)
+                metrics.lines += len(data)
+
+                if len(data) == 0:
+                    job.loaded = True
+                    job.loader.close()
+                    active.remove(job)
+                    loaded_size += job.file_size
+                    if job.pending == 0:
+                        job.finish()
+                else:
+                    for i in range(0, len(data), self.__pool_chunk_size):
+                        job.pending += 1
+                        task_jobs.append(job)
+                        yield chunk_func, data[i:i + self.__pool_chunk_size], job.encoder
+
+                # 全局的处理进度
+                metrics.input_pos = loaded_size + sum(min(j.loader.file_pos, j.file_size) for j in active)
+                if self.progressbar is not None:
+                    self.load_file_size = metrics.input_pos
+                    self.progressbar.update(self.load_file_size)
 
-        数据按照块的方式进行加载。通过chunk2col进行行数据的切分，同时从行的存储模式转变为列的存储模式
-        col_func用于处理chunk2col方法得到的chunk块的列形式。
+    def run_col(self, input_file_name, output_file_name=None, chunk2col_func=chunk2col, col_func=col_proc,
+                with_column_num=True, use_CRLF=False, sep=',', cache_dir='tmp', cols_per_file=1024,
+                mem_limit=256 * 1024 * 1024):
+        """
+        对文件的列进行处理。（有列意味着必须有列的分割符号，这里需要写一个行构成的块如何转化为列的处理方法)
 
-        这个方法下，如果不设置输出文件
+        数据按照块的方式进行加载，每个chunk均分为多批行交给进程池。工作进程通过chunk2col_func将行数据切分为列，
+        逐列调用col_func处理，并把结果编码为列缓存文件的记录。主进程只负责把记录追加到对应的列缓存文件中。
+        列按照cols_per_file个一组存放在同一个缓存文件中，缓存文件在整个处理过程中保持打开，并带有写缓冲。
 
-        todo 该方法还未完善，不建议使用
-        todo 1 使用外部行拆分程序，进行行切割
-        todo 2 并行方式集中在多列的并行化处理方面，借助chunkloader多次加载文件，在一个文件读取周期内处理多行。将多行的处理结果批次写入系统
-        todo 3 存在模式2,一次读取文件，完成所有列的处理。可以参考各列写缓存的思路，最终将缓存合并，构成最终文件
-        todo 4 需要准备3个方法，行的分割方法，chunk行块的处理方法，chunk行块返回结果的合并方法。（预处理、处理、后处理）
+        全部数据处理完毕后，逐个读取列缓存文件，完成转置：输出文件的每一行对应输入的一列，值之间以sep分隔。
+        合并时一次读入内存的数据不超过mem_limit，一个列组的数据超过mem_limit时会分多次读取，因此内存占用是可预期的。
+        各批行的列数不一致时，缺少的值以空串补齐。
 
         :param input_file_name: 待处理的文件名
-        :param output_file_name: 处理完毕需要输出的文件名。默认为None，代表文件将会输出到内存中。如果为None，那么数据将会以list的方式，逐行存放，并最后返回
-        :param with_cache_file: 由于文件体积极大的时候，无法直接将列数据连续存放。因此需要考虑使用临时文件存放的方式
-        :param chunk2col_func: 将一个块中的行数据转换切分为列的方式存放
-        :param col_func: 用于列数据处理的方法。每次一个列给该方法，列带有对应的列号。得到的参数结构为(col_num, col_value)。返回数据时要求结构为(col_num,pd_col_value)
-        :param with_column_num: 传递给line_func的数据是否包括列的编号。如果True，那么传递给col_func的数据为 (col_num, col_data)。注意col_num从1开始
-        :param use_CRLF: 换行模式，由于默认在Linux上运行，换行模式LF为'\n'。在win上，所采用的换行模式CRLF为'\r\n'，即回车换行
-        :return: 返回经过处理的结果。如果outfile!=None，那么处理的结果将会直接写入到文件中; 如果outfile=None，这意味着会返回处理List，其中包括经过处理后的所有行
-        :return:
+        :param output_file_name: 处理完毕需要输出的文件名。默认为None，代表结果将会以列的List存放在内存中，并最后返回
+        :param chunk2col_func: 将一批行数据切分并转换为列的方法，返回列的List
+        :param col_func: 用于列数据处理的方法。如果with_column_num=True，得到的参数结构为(col_num, col_value)，返回数据时要求结构为(col_num, pd_col_value)
+        :param with_column_num: 传递给col_func的数据是否包括列的编号。如果True，那么传递给col_func的数据为 (col_num, col_data)。注意col_num从1开始
+        :param use_CRLF: 换行模式，True时采用'\r\n'进行换行
+        :param sep: 输出文件中，同一列的值之间的分隔符
+        :param cache_dir: 列缓存文件存放的目录
+        :param cols_per_file: 每个列缓存文件存放的列数，决定了同时打开的缓存文件数量
+        :param mem_limit: 合并列缓存文件时，一次读入内存的数据上限，单位为bytes
+        :return: 如果output_file_name!=None，处理的结果将会直接写入到文件中; 否则返回列的List，每一列是值的List
         """
-        input_file = open(input_file_name, 'r')
-        output_file = None
         #### 公共展示信息补充 ####
         __cache_mode = 'File'
         if output_file_name == None:
             __cache_mode = 'Mem'  # 如果没有打开的输出文件，将使用内存作为缓存区
-        else:
-            output_file = open(output_file_name, 'w')
-
-        if __cache_mode == 'File':
-            # 创建缓存文件夹
-            if not os.path.exists('tmp'):
-                os.mkdir('tmp')
+            cols_per_file = None
 
         # 获取输入文夹的大小
-        __in_file_size = os.path.getsize(input_file.name)
+        __in_file_size = os.path.getsize(input_file_name)
 
         # 初始化线程池，包括1个预加载器、n_jobs个数据处理器、主进程负责数据的分发、收集和写入
         chunk_loader = ChunkLoader(input_file_name, chunk_size=self.chunk_size, use_async=True,
-                                   with_line_num=with_column_num)
-        pool = Pool(self.n_jobs)
+                                   decompress_jobs=self.n_jobs, **self.__loader_options())
+        pool = self.__acquire_pool()
 
         #### 参数初始化 ####
         line_breaker = '\n'
@@ -451,112 +2511,153 @@ class ParallelLine:
         prefix = "@run_col:\t"
         print(prefix + "n_jobs={}".format(self.n_jobs))
         print(prefix + "pool_chunksize={}".format(self.__pool_chunk_size))
+        print(prefix + "max_inflight={}".format(self.max_inflight))
         print(prefix + "缓存模式={}".format(__cache_mode))
-        print(prefix + "缓存文件器用={} bytes".format(with_cache_file))
+        print(prefix + "缓存文件列数={}".format(cols_per_file))
+        print(prefix + "合并内存上限={} bytes".format(mem_limit))
         print(prefix + "展示处理进度={}".format(self.__show_process_status))
         print(prefix + "输入文件大小={} bytes".format(__in_file_size))
 
-        ret = []
-        # 处理到最后，ret中最多i几行，最多几列
-        ret_rows = 0
-        ret_cols = 0
-
-        while True:
-            data = chunk_loader.get()
-
-            # 加快获取文件末尾的效率
-            if len(data) == 0:
-                print("处理完毕")
-                break
+        self.progressbar = None
+        if self.__show_process_status:
+            self.progressbar = pb.ProgressBar(maxval=__in_file_size)
+            self.progressbar.start()
+        self.load_file_size = 0
 
-            # 行数据转换为切分过的列数据
-            data1 = chunk2col_func(data)
-            # 为每列添加列编号
-            data2 = []
-            for i, col in data1:
-                data2.append((i + 1, col))
-
-            # 按照col_func方法并行处理列数据。这里有可能是数据写入。需要外部提供方法指定
-            data2 = pool.imap(col_func, data2, chunksize=self.n_jobs)
-
-            # data2转存，同时更新ret_cols和ret_rows
-            data3 = []
-            for col_c in data2:
-                assert len(col_c) == 2, "col_func方法的返回结果长度应该为2,收到错误的返回长度"
-                col_num = col_c[0]
-                col = col_c[1]
-                if ret_rows < len(col):
-                    ret_rows = len(col)
-                data3.append(col)
-
-            if ret_cols < len(data3):
-                ret_cols = len(data3)
-
-            # 进行数据的合并
-            if __cache_mode == 'Mem':
-                # 如果缓冲模式是内存缓冲，那么将数据写给ret。ret保存有每个chunk的数据，经过其他步骤整合得到最终的结果
-                ret.append(data3)
-            else:
-                # 行数据写入到缓存文件中，其中文件名就是行号
-                for (col_num, col_value) in data2:
-                    with open('tmp/{}'.format(col_num), 'a+') as f:
-                        f.write(col_value)
+        spill_dir = None
+        if __cache_mode == 'File':
+            # 创建缓存文件夹
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            spill_dir = tempfile.mkdtemp(prefix='run_col_', dir=cache_dir)
+
+        batch_rows = []  # 每一批的行数，用于补齐缺失的列
+        ret = []  # Mem模式下的列数据
+        spill_files = {}  # 列组编号对应的缓存文件
+        try:
+            tasks = self.__col_tasks(chunk_loader, chunk2col_func, col_func, with_column_num, sep, cols_per_file,
+                                     __in_file_size)
+            for n_rows, data in pipelined_imap(pool, _process_col_chunk, tasks, True, self.max_inflight):
+                if __cache_mode == 'Mem':
+                    # 补齐之前缺少的列
+                    for i in range(len(ret), len(data)):
+                        ret.append([''] * sum(batch_rows))
+                    for i, col in enumerate(ret):
+                        if i < len(data):
+                            col += data[i]
+                        else:
+                            col += [''] * n_rows
+                else:
+                    for g, records in data.items():
+                        if g not in spill_files:
+                            spill_files[g] = open(os.path.join(spill_dir, str(g)), 'wb', buffering=1024 * 1024)
+                        spill_files[g].write(records)
+                batch_rows.append(n_rows)
+            chunk_loader.close()
+        except BaseException:
+            self.__release_pool(pool, error=True)
+            chunk_loader.terminate()
+            for f in spill_files.values():
+                f.close()
+            if spill_dir is not None:
+                shutil.rmtree(spill_dir, ignore_errors=True)
+            raise
+
+        self.__release_pool(pool)
 
-        # 处理完毕，这里清除一下信息
-        chunk_loader.close()
-        pool.close()
-        pool.join()
         if __cache_mode == 'Mem':
-            # 将ret中的数据进行整合，最终符合列关系
-            tmp = []
-            # 构造所有的列
-            for i in range(ret_cols):
-                tmp.append([])
-
-            for chunk in ret:
-                c_chunk_max_row = 0
-
-                # 获取当前chunk的最大行数，用于后续数据的补齐工作
-                for col in chunk:
-                    if c_chunk_max_row < len(col):
-                        c_chunk_max_row = len(col)
-
-                for col_num in range(ret_cols):
-                    # 如果列号超过了数据范围，那么主动补充空值
-                    if col_num > len(chunk):
-                        for i in range(c_chunk_max_row):
-                            tmp[col_num].append('')
-                        continue
-
-                    for row_num in range(c_chunk_max_row):
-                        if row_num > len(chunk[col_num]):
-                            tmp[col_num].append('')
-                        tmp[col_num].append(chunk[col_num][row_num])
-
-            return tmp
-        else:
-            # 对应处理__cache_mode == 'file'
-            for i in range(1, ret_cols + 1):
-                with open('tmp/{}'.format(i), 'r'):
-                    output_file.write('\n')
-
-        input_file.close()
-        if output_file != None:
-            output_file.close()
+            print("处理完毕")
+            if self.progressbar is not None:
+                self.progressbar.finish()
+            return ret
 
-    def __run_block(self, input_file_name, output_file_name, block_size=(0, 0), split_func=chunk2col,
-                    block_func=col_proc, use_CRLF=False):
+        # 对应处理__cache_mode == 'File'，将列缓存文件合并转置到输出文件中
+        for f in spill_files.values():
+            f.close()
+        try:
+            with open(output_file_name, 'w', newline='') as output_file:
+                for g in sorted(spill_files.keys()):
+                    self.__merge_col_spill(os.path.join(spill_dir, str(g)), g * cols_per_file, cols_per_file,
+                                           batch_rows, sep, line_breaker, mem_limit, output_file)
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+        print("处理完毕")
+        if self.progressbar is not None:
+            self.progressbar.finish()
+
+    def __col_tasks(self, chunk_loader, chunk2col_func, col_func, with_column_num, sep, cols_per_file, in_file_size):
+        """
+        从ChunkLoader中按需获取数据，每个chunk均分为多批行，作为列处理的任务
+        :return: 任务的生成器，任务结构参见_process_col_chunk
+        """
+        batch = 0
+        for data in chunk_loader:
+            if self.progressbar is not None:
+                self.load_file_size = min(chunk_loader.file_pos, in_file_size)
+                self.progressbar.update(self.load_file_size)
+
+            for i in range(0, len(data), self.__pool_chunk_size):
+                yield chunk2col_func, col_func, with_column_num, data[i:i + self.__pool_chunk_size], batch, sep, \
+                      cols_per_file
+                batch += 1
+
+    @staticmethod
+    def __merge_col_spill(fname, first_col, cols_per_file, batch_rows, sep, line_breaker, mem_limit, output_file):
+        """
+        将一个列缓存文件中的各列转置为输出文件的行。列组的数据超过mem_limit时，分多次读取，每次只处理一部分列
+        """
+        with open(fname, 'rb') as f:
+            # 一次扫描得到各列记录的位置与大小，缓存文件中的列号是连续的，最大列号即为该列组实际的列数
+            table = _index_col_records(f)
+            last_col = max(table.keys(), default=first_col - 1) + 1
+            begin = first_col
+            while begin < last_col:
+                # 按各列实际的数据量确定一次读取的列，至少读取一列
+                end = begin
+                size = 0
+                while end < last_col:
+                    records = table.get(end, ())
+                    col_size = sum(records[i] for i in range(2, len(records), 3))
+                    if end > begin and size + col_size > mem_limit:
+                        break
+                    size += col_size
+                    end += 1
+                records = _read_col_records(f, table, begin, end)
+                for col in range(begin, end):
+                    frags = records.get(col, {})
+                    pieces = []
+                    for batch, n_rows in enumerate(batch_rows):
+                        frag = frags.get(batch)
+                        if frag is None:
+                            pieces.append(sep.join([''] * n_rows))
+                        else:
+                            pieces.append(frag.decode())
+                    output_file.write(sep.join(pieces) + line_breaker)
+                del records
+                begin = end
+
+    def run_block(self, input_file_name, output_file_name=None, block_size=(0, 0), split_func=chunk2rows,
+                  block_func=block_proc, use_CRLF=False, sep=','):
         """
         这个是新的并行处理思路。内容包括数据的读取，任务分发，结果聚合写入。
         核心思想是突出数据的块化处理 ，将data_loader的chunk块进一步按照列进行切分。得到许多小block，每个小block结构为([row_nums],[col_nums],[data])
 
+        每个chunk按照block_size划分为行带，每个行带再按列划分为多个block。
+        分发时，同一行带中相邻的block会合并为一个任务，任务数量约为max_inflight，这样工作进程每次处理的是一段连续的数据，
+        行数很少但列数很多的文件也能让所有进程保持忙碌。任务只携带行带的原始行与各block的列范围，
+        切分表格与截取block都在工作进程中完成，主进程只负责分发与拼接。处理结果按照block的位置重新拼接为完整的行后输出
+
         :param input_file_name: 待处理的文件名称
-        :param output_file_name: 结果输出的文件名
-        :param block_size: 将表格拆分成的block大小
-        :param split_func: 每一行数据的具体拆分方法
-        :param block_func: 每一个block的处理方法
+        :param output_file_name: 结果输出的文件名。默认为None，代表结果将会以行的List存放在内存中，并最后返回
+        :param block_size: 将表格拆分成的block大小，结构为(行数, 列数)，为0代表不在该方向上拆分
+        :param split_func: chunk数据的拆分方法，输入为行的List，返回二维表格(行的List或numpy二维数组)，每一行输入对应表格的一行。
+                           在工作进程中调用，主进程只用它切分每个chunk的第一行来确定列数
+        :param block_func: 每一个block的处理方法，输入为(row_nums, col_nums, data)，返回处理后的二维数据，行数与block相同。
+                           row_nums为block中各行在文件中的行号，从0开始；col_nums为各列的列号，从1开始
         :param use_CRLF: 写出数据是否采用CRLF方式进行换行
-        :return:
+        :param sep: 输出文件中，同一行的值之间的分隔符
+        :return: 如果output_file_name!=None，处理的结果将会直接写入到文件中; 否则返回行的List
         """
 
         #### 参数初始化 ####
@@ -564,6 +2665,103 @@ class ParallelLine:
         if use_CRLF:
             line_breaker = '\r\n'
 
+        __cache_mode = 'File'
+        output_file = None
+        if output_file_name == None:
+            __cache_mode = 'Mem'
+        else:
+            output_file = open(output_file_name, 'w', newline='')
+
+        __in_file_size = os.path.getsize(input_file_name)
+        chunk_loader = ChunkLoader(input_file_name, chunk_size=self.chunk_size, use_async=True,
+                                   decompress_jobs=self.n_jobs, **self.__loader_options())
+        pool = self.__acquire_pool()
+
+        # 列出运行配置
+        print("ParallelLine使用配置:")
+        prefix = "@run_block:\t"
+        print(prefix + "n_jobs={}".format(self.n_jobs))
+        print(prefix + "block_size={}".format(block_size))
+        print(prefix + "max_inflight={}".format(self.max_inflight))
+        print(prefix + "缓存模式={}".format(__cache_mode))
+        print(prefix + "展示处理进度={}".format(self.__show_process_status))
+        print(prefix + "输入文件大小={} bytes".format(__in_file_size))
+
+        self.progressbar = None
+        if self.__show_process_status:
+            self.progressbar = pb.ProgressBar(maxval=__in_file_size)
+            self.progressbar.start()
+        self.load_file_size = 0
+
+        ret = []
+        band = []  # 当前行带中已经处理完毕的block结果
+        try:
+            tasks = self.__block_tasks(chunk_loader, split_func, block_func, block_size, __in_file_size)
+            for (n_rows, band_end), results in pipelined_imap(pool, _process_blocks, tasks, True,
+                                                              self.max_inflight):
+                band += results
+                if not band_end:
+                    continue
+
+                # 行带中的block全部完成，按列的顺序拼接为完整的行
+                rows = [[] for i in range(n_rows)]
+                for res in band:
+                    for i in range(n_rows):
+                        rows[i] += list(res[i])
+                band = []
+
+                if __cache_mode == 'Mem':
+                    ret += rows
+                else:
+                    output_file.write(''.join([sep.join([str(v) for v in row]) + line_breaker for row in rows]))
+            chunk_loader.close()
+        except BaseException:
+            self.__release_pool(pool, error=True)
+            chunk_loader.terminate()
+            if output_file is not None:
+                output_file.close()
+            raise
+
+        print("处理完毕")
+        if self.progressbar is not None:
+            self.progressbar.finish()
+
+        self.__release_pool(pool)
+        if output_file is not None:
+            output_file.close()
+        if __cache_mode == 'Mem':
+            return ret
+
+    def __block_tasks(self, chunk_loader, split_func, block_func, block_size, in_file_size):
+        """
+        将chunk切分为block，并把同一行带中相邻的block合并为任务
+        :return: 任务的生成器，任务结构参见_process_blocks
+        """
+        row_step, col_step = block_size
+        line_num = 0
+        for data in chunk_loader:
+            if self.progressbar is not None:
+                self.load_file_size = min(chunk_loader.file_pos, in_file_size)
+                self.progressbar.update(self.load_file_size)
+
+            # 只切分第一行来确定列数，表格的切分在工作进程中完成
+            n_rows = len(data)
+            n_cols = len(split_func(data[:1])[0]) if n_rows > 0 else 0
+            r_step = row_step if row_step > 0 else n_rows
+            c_step = col_step if col_step > 0 else max(n_cols, 1)
+            col_ranges = [(c0, min(c0 + c_step, n_cols)) for c0 in range(0, max(n_cols, 1), c_step)]
+
+            # 相邻的block合并为一个任务，每个行带最多划分为max_inflight个任务
+            per_task = -(-len(col_ranges) // self.max_inflight)
+            for r0 in range(0, n_rows, r_step):
+                r1 = min(r0 + r_step, n_rows)
+                lines = data[r0:r1]
+                for i in range(0, len(col_ranges), per_task):
+                    band_end = i + per_task >= len(col_ranges)
+                    yield (r1 - r0, band_end), split_func, block_func, lines, line_num + r0, \
+                          col_ranges[i:i + per_task]
+            line_num += n_rows
+
     # Press the green button in the gutter to run the script.
     if __name__ == '__main__':
         print("hi")
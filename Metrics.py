@@ -0,0 +1,161 @@
+"""
+并行处理过程的运行指标。
+
+ParallelLine的一次运行可以划分为以下几个阶段，Metrics分别累计各阶段花费的时间：
+    load: 主进程等待数据加载器返回数据
+    dispatch: 主进程向进程池提交任务
+    compute: 工作进程执行任务，为各个工作进程的时间之和
+    collect: 主进程等待并取回任务结果
+    write: 主进程写出结果
+同时记录处理的行数、输入文件的读取位置、输出的字节数，在途任务数、加载队列长度等队列深度，
+以及预加载进程与主进程互相等待的次数等计数。
+
+指标的记录都以任务或chunk为单位，不会逐行统计。每隔interval秒，当前的指标快照会交给各个reporter，
+reporter可以是ConsoleReporter、JsonLinesReporter，也可以是任意接收快照dict的callable。
+通过比较各阶段的时间，可以判断慢任务卡在数据加载、计算还是写出上。
+
+"""
+
+import json
+import sys
+import time
+
+STAGES = ('load', 'dispatch', 'compute', 'collect', 'write')
+
+
+class Metrics:
+    """
+    运行指标的记录器
+    """
+
+    def __init__(self, reporters=None, interval=5.0) -> None:
+        """
+        :param reporters: reporter的List，每个reporter是接收指标快照dict的callable
+        :param interval: 两次报告之间的最小时间间隔，单位为秒
+        """
+        self.reporters = list(reporters) if reporters is not None else []
+        self.interval = interval
+
+        self.stage_time = dict.fromkeys(STAGES, 0.0)
+        self.lines = 0  # 已经加载的行数
+        self.tasks = 0  # 已经完成的任务数
+        self.input_pos = 0  # 输入文件的读取位置，以磁盘上的字节数计算
+        self.input_total = 0  # 输入文件在磁盘上的大小
+        self.output_bytes = 0  # 已经写出的字节数
+        self.depth = {}  # 各队列当前的深度
+        self.max_depth = {}  # 各队列的最大深度
+        self.counts = {}  # 其他累计计数，例如加载队列的等待次数
+
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+
+    def start(self, input_total=0):
+        """
+        开始计时
+        :param input_total: 输入文件在磁盘上的大小
+        :return:
+        """
+        self.input_total = input_total
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+
+    def add_time(self, stage, seconds):
+        self.stage_time[stage] += seconds
+
+    def set_depth(self, name, value):
+        self.depth[name] = value
+        if value > self.max_depth.get(name, 0):
+            self.max_depth[name] = value
+
+    def set_count(self, name, value):
+        self.counts[name] = value
+
+    def snapshot(self):
+        """
+        :return: 当前指标的dict
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        return {
+            'elapsed': elapsed,
+            'stage_time': dict(self.stage_time),
+            'tasks': self.tasks,
+            'lines': self.lines,
+            'lines_per_sec': self.lines / elapsed,
+            'input_pos': self.input_pos,
+            'input_total': self.input_total,
+            'input_bytes_per_sec': self.input_pos / elapsed,
+            'output_bytes': self.output_bytes,
+            'output_bytes_per_sec': self.output_bytes / elapsed,
+            'progress': self.input_pos / self.input_total if self.input_total > 0 else 0.0,
+            'depth': dict(self.depth),
+            'max_depth': dict(self.max_depth),
+            'counts': dict(self.counts),
+        }
+
+    def tick(self):
+        """
+        距离上次报告超过interval秒时，报告一次当前指标。在主循环中调用，开销只有一次时间比较
+        :return:
+        """
+        if len(self.reporters) == 0:
+            return
+        now = time.time()
+        if now - self.last_report_time >= self.interval:
+            self.last_report_time = now
+            self.report()
+
+    def report(self, final=False):
+        """
+        将当前指标交给各个reporter
+        :param final: 是否为运行结束时的最终报告
+        :return:
+        """
+        snapshot = self.snapshot()
+        snapshot['final'] = final
+        for reporter in self.reporters:
+            reporter(snapshot)
+
+    def finish(self):
+        """
+        运行结束，输出最终报告
+        :return:
+        """
+        self.report(final=True)
+
+
+class ConsoleReporter:
+    """
+    将指标以单行文本输出到控制台
+    """
+
+    def __init__(self, stream=None) -> None:
+        """
+        :param stream: 输出流，默认为sys.stderr
+        """
+        self.stream = stream
+
+    def __call__(self, snapshot):
+        stream = self.stream if self.stream is not None else sys.stderr
+        stage = ' '.join('{}={:.2f}s'.format(k, v) for k, v in snapshot['stage_time'].items())
+        depth = ' '.join('{}={}/{}'.format(k, v, snapshot['max_depth'].get(k, 0)) for k, v in snapshot['depth'].items())
+        counts = ' '.join('{}={}'.format(k, v) for k, v in snapshot['counts'].items())
+        print('[metrics{}] {:.1f}s {:.1%} lines={} ({:.0f}/s) in={:.2f}MB/s out={:.2f}MB/s {} {} {}'.format(
+            ' final' if snapshot['final'] else '', snapshot['elapsed'], snapshot['progress'], snapshot['lines'],
+            snapshot['lines_per_sec'], snapshot['input_bytes_per_sec'] / 1e6, snapshot['output_bytes_per_sec'] / 1e6,
+            stage, depth, counts).rstrip(), file=stream)
+
+
+class JsonLinesReporter:
+    """
+    将每次报告的指标作为一行JSON追加到文件中
+    """
+
+    def __init__(self, file_name) -> None:
+        """
+        :param file_name: 输出的文件名
+        """
+        self.file_name = file_name
+
+    def __call__(self, snapshot):
+        with open(self.file_name, 'a') as f:
+            f.write(json.dumps(snapshot) + '\n')
@@ -0,0 +1,137 @@
+"""
+预加载进程与主进程之间基于共享内存的环形缓冲区。
+
+ChunkLoader默认通过multiprocessing.Queue传递chunk，每个chunk都要在预加载进程中序列化，经过管道，再在主进程中反序列化。
+ShmRing在创建时分配一段共享内存，平均划分为depth个槽位，每个槽位存放一个chunk：各行以换行符拼接后的字节数据，
+以及行数、读取位置等少量元数据。生产者与消费者通过两个信号量交替占用槽位，数据只需要拷贝进出共享内存，不需要序列化。
+
+chunk超过槽位大小时(例如auto模式下chunk变大)，该chunk退回通过普通队列传递，并在槽位中做标记，因此顺序不变。
+
+只支持一个生产者和一个消费者，并且需要通过fork把对象传给子进程。
+
+"""
+
+from array import array
+from multiprocessing import Queue, Semaphore, Value
+from multiprocessing import shared_memory
+import os
+import queue
+import struct
+
+# 槽位头部：行数, 数据长度, 文件读取位置, 已经读取的行数, 标志
+_HEADER = struct.Struct('<QQQQQ')
+_FLAG_BINARY = 1  # 行为bytes
+_FLAG_LINE_NUMS = 2  # 数据之后附带各行的行号
+_FLAG_OVERFLOW = 4  # 数据通过队列传递
+
+
+class ShmRing:
+    """
+    单生产者、单消费者的共享内存环形缓冲区，接口与multiprocessing.Queue的put/get一致。
+    传递的数据为 (lines, raw_pos, line_nums, read_num)，参见ChunkLoader
+    """
+
+    def __init__(self, depth, slot_size) -> None:
+        """
+        :param depth: 槽位数量，即预加载进程最多可以领先的chunk数
+        :param slot_size: 每个槽位的字节数，包括头部
+        """
+        assert depth >= 1, "depth必须大于0"
+        assert slot_size > _HEADER.size, "slot_size过小:{}".format(slot_size)
+        self.depth = depth
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=depth * slot_size)
+        self.owner_pid = os.getpid()
+
+        self.__free = Semaphore(depth)  # 空闲的槽位数
+        self.__filled = Semaphore(0)  # 已经写入的槽位数
+        self.__overflow = Queue()  # 超过槽位大小的chunk
+        # 写入与读取的槽位计数，分别只由生产者与消费者修改
+        self.__head = Value('Q', 0, lock=False)
+        self.__tail = Value('Q', 0, lock=False)
+        self.overflows = Value('Q', 0, lock=False)  # 通过队列传递的chunk数
+
+    def put(self, item, block=True):
+        """
+        写入一个chunk
+        :param item: (lines, raw_pos, line_nums, read_num)。line_nums可以为None。lines不是List时(例如传递异常)，整体通过队列传递
+        :param block: 为False且没有空闲槽位时，抛出queue.Full
+        :return:
+        """
+        if not self.__free.acquire(block):
+            raise queue.Full
+
+        lines, raw_pos, line_nums, read_num = item
+        data = nums = b''
+        flags = 0
+        if isinstance(lines, list):
+            binary = len(lines) > 0 and isinstance(lines[0], bytes)
+            data = b'\n'.join(lines) if binary else '\n'.join(lines).encode()
+            nums = array('Q', line_nums).tobytes() if line_nums is not None else b''
+            flags = (_FLAG_BINARY if binary else 0) | (_FLAG_LINE_NUMS if line_nums is not None else 0)
+        pos = (self.__head.value % self.depth) * self.slot_size
+        buf = self.shm.buf
+        if not isinstance(lines, list) or _HEADER.size + len(data) + len(nums) > self.slot_size:
+            # 槽位放不下，数据通过队列传递，槽位只作为顺序标记
+            self.__overflow.put(item)
+            self.overflows.value += 1
+            _HEADER.pack_into(buf, pos, 0, 0, 0, 0, _FLAG_OVERFLOW)
+        else:
+            _HEADER.pack_into(buf, pos, len(lines), len(data), raw_pos, read_num, flags)
+            start = pos + _HEADER.size
+            buf[start:start + len(data)] = data
+            buf[start + len(data):start + len(data) + len(nums)] = nums
+        del buf
+
+        self.__head.value += 1
+        self.__filled.release()
+
+    def get(self, block=True, timeout=None):
+        """
+        读取一个chunk
+        :param block: 为False且没有可读的槽位时，抛出queue.Empty
+        :param timeout: block为True时最多等待的秒数，超时后抛出queue.Empty
+        :return: (lines, raw_pos, line_nums, read_num)
+        """
+        if not self.__filled.acquire(block, timeout):
+            raise queue.Empty
+
+        pos = (self.__tail.value % self.depth) * self.slot_size
+        n_lines, n_bytes, raw_pos, read_num, flags = _HEADER.unpack_from(self.shm.buf, pos)
+        if flags & _FLAG_OVERFLOW:
+            item = self.__overflow.get()
+        else:
+            start = pos + _HEADER.size
+            data = bytes(self.shm.buf[start:start + n_bytes])
+            line_nums = None
+            if flags & _FLAG_LINE_NUMS:
+                line_nums = array('Q')
+                line_nums.frombytes(self.shm.buf[start + n_bytes:start + n_bytes + 8 * n_lines])
+                line_nums = line_nums.tolist()
+
+            lines = []
+            if n_lines > 0:
+                lines = data.split(b'\n') if flags & _FLAG_BINARY else data.decode().split('\n')
+            item = (lines, raw_pos, line_nums, read_num)
+
+        self.__tail.value += 1
+        self.__free.release()
+        return item
+
+    def qsize(self):
+        """
+        :return: 已经写入、等待读取的chunk数
+        """
+        return self.__head.value - self.__tail.value
+
+    def close(self):
+        """
+        释放共享内存。只有创建者会删除共享内存
+        :return:
+        """
+        if self.shm is None:
+            return
+        self.shm.close()
+        if self.owner_pid == os.getpid():
+            self.shm.unlink()
+        self.shm = None
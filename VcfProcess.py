@@ -0,0 +1,226 @@
+"""
+VCF文件基因型的向量化解析。
+
+VCF文件的每个数据行包含9个固定列和每个样本一列，样本列以GT(基因型)开头，例如'0/1:12'。逐个样本在Python中切分字符串、
+拼接结果的开销很大，这里把一个chunk的全部行作为一段字节数据，通过numpy一次定位所有样本列的起始位置，
+直接读取GT的两个等位基因字符，得到int8的基因型矩阵：
+    0: 纯合参考(0/0)
+    1: 杂合(0/1、1/0，及其他含一个非参考等位基因的情况)
+    2: 纯合变异(1/1等)
+    -1: 缺失(./.，或任意一个等位基因缺失)
+'|'分隔的相位基因型与'/'相同处理；单倍型的GT(例如'0'、'1')记为0或1。等位基因编号只读取第一位数字，只影响编号不少于10的多等位位点。
+
+文件头(以'#'开头的行)只在主进程中解析一次，之后从第一个数据行开始，以二进制方式交给run_chunk并行处理。结果可以输出为：
+    1. CSV文件，每行为 CHROM,POS,样本1基因型,样本2基因型,...，第一行为标题；
+    2. .npy文件，大小为(数据行数, 样本数)的int8矩阵。文件预先创建，工作进程通过memmap把各自的行直接写入对应的位置，
+       矩阵数据不经过主进程。可以同时输出位点文件，每行为 CHROM\\tPOS\\tID\\tREF\\tALT。
+
+本模块需要numpy，可以通过`pip install -e ".[numpy]"`安装。
+
+"""
+
+import gzip
+import numpy as np
+import LineIndex
+from LinePrcessor import LineBlock
+
+_ZERO = ord('0')
+_MISSING = ord('.')
+
+
+class VcfHeader:
+    """
+    VCF文件头
+    """
+
+    def __init__(self, meta, columns) -> None:
+        """
+        :param meta: '##'开头的元信息行，不包括换行符
+        :param columns: '#CHROM'行的各列名称
+        """
+        self.meta = meta
+        self.columns = columns
+        self.samples = columns[9:]
+        self.n_lines = len(meta) + 1  # 文件头的行数，也是第一个数据行的行号
+
+
+def read_vcf_header(fname):
+    """
+    读取VCF文件头，支持未压缩与gzip/BGZF压缩的文件
+    :param fname: VCF文件名
+    :return: VcfHeader
+    """
+    open_func = gzip.open if fname.endswith('.gz') else open
+    meta = []
+    with open_func(fname, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n').decode()
+            if line.startswith('##'):
+                meta.append(line)
+                continue
+            assert line.startswith('#CHROM'), "文件:{}缺少#CHROM标题行".format(fname)
+            return VcfHeader(meta, line[1:].split('\t'))
+    raise AssertionError("文件:{}缺少#CHROM标题行".format(fname))
+
+
+def decode_genotypes(buf, n_samples):
+    """
+    解析一段VCF数据行的基因型
+    :param buf: 以换行符分隔的多个数据行，bytes或memoryview，最后一行可以没有换行符
+    :param n_samples: 样本数
+    :return: (各行的起始位置, 各行前8个制表符的位置, 基因型矩阵)。制表符位置为(行数, 8)的矩阵，基因型矩阵为(行数, 样本数)的int8矩阵
+    """
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    line_ends = np.flatnonzero(raw == 10)
+    if len(raw) > 0 and raw[-1] != 10:
+        line_ends = np.append(line_ends, len(raw))
+    n = len(line_ends)
+
+    # 每行都应该有8+n_samples个制表符
+    n_tabs = 8 + n_samples
+    tabs = np.flatnonzero(raw == 9)
+    if len(tabs) != n * n_tabs or \
+            not (np.searchsorted(line_ends, tabs).reshape(n, n_tabs) == np.arange(n)[:, None]).all():
+        raise ValueError("VCF数据行的列数与样本数:{}不一致".format(n_samples))
+    tabs = tabs.reshape(n, n_tabs)
+
+    # 样本列的前3个字符为 等位基因1、分隔符、等位基因2。末尾补0，单倍型的GT位于文件末尾时不会越界
+    starts = tabs[:, 8:] + 1
+    raw = np.concatenate((raw, np.zeros(2, dtype=np.uint8)))
+    a1 = raw[starts]
+    sep = raw[starts + 1]
+    a2 = raw[starts + 2]
+    diploid = (sep == ord('/')) | (sep == ord('|'))
+
+    gt = (a1 != _ZERO).astype(np.int8) + (diploid & (a2 != _ZERO))
+    gt[(a1 == _MISSING) | (diploid & (a2 == _MISSING))] = -1
+
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1)).astype(np.int64)
+    return line_starts, tabs[:, :8], gt
+
+
+def _chunk_buffer(data):
+    """
+    将数据块转换为一段字节数据
+    :param data: 包括行号的数据块，[(line_num, line), ...]，行为bytes；或者是LineBlock
+    :return: (字节数据, 第一行的行号)
+    """
+    if isinstance(data, LineBlock):
+        return data.buffer, data.first_line
+    return b'\n'.join([line for _, line in data]), data[0][0]
+
+
+class GenotypeCsv:
+    """
+    run_chunk的块处理方法，将数据块转换为基因型CSV的各行
+    """
+
+    def __init__(self, header, missing='.') -> None:
+        """
+        :param header: VcfHeader
+        :param missing: 缺失基因型的表示，必须是单个字符
+        """
+        assert len(missing) == 1, "missing必须是单个字符，收到:{}".format(missing)
+        self.n_samples = len(header.samples)
+        self.first_line = header.n_lines
+        self.title = ','.join(['CHROM', 'POS'] + header.samples).encode()
+        # 基因型+1作为下标，得到对应的字符
+        self.table = np.frombuffer(missing.encode() + b'012', dtype=np.uint8)
+
+    def __call__(self, data):
+        if len(data) == 0:
+            return []
+        buf, first_line = _chunk_buffer(data)
+        line_starts, tabs, gt = decode_genotypes(buf, self.n_samples)
+        buf = bytes(buf)
+
+        # 每个样本输出为 ',' + 基因型字符，所有行的样本部分一次生成
+        width = 2 * self.n_samples
+        cells = np.empty((len(gt), width), dtype=np.uint8)
+        cells[:, 0::2] = ord(',')
+        cells[:, 1::2] = self.table[gt + 1]
+        cells = cells.tobytes()
+
+        ret = [self.title] if first_line == self.first_line else []
+        for i, (start, tab0, tab1) in enumerate(zip(line_starts.tolist(), tabs[:, 0].tolist(), tabs[:, 1].tolist())):
+            ret.append(buf[start:tab0] + b',' + buf[tab0 + 1:tab1] + cells[i * width:(i + 1) * width])
+        return ret
+
+
+class GenotypeNpy:
+    """
+    run_chunk的块处理方法，将数据块的基因型写入.npy文件中对应的行，返回各行的位点信息
+    """
+
+    def __init__(self, npy_file_name, header, with_sites=True) -> None:
+        """
+        :param npy_file_name: 预先创建的.npy文件，大小为(数据行数, 样本数)
+        :param header: VcfHeader
+        :param with_sites: 是否返回位点信息 CHROM\\tPOS\\tID\\tREF\\tALT
+        """
+        self.npy_file_name = npy_file_name
+        self.n_samples = len(header.samples)
+        self.first_line = header.n_lines
+        self.with_sites = with_sites
+
+    def __call__(self, data):
+        if len(data) == 0:
+            return []
+        buf, first_line = _chunk_buffer(data)
+        line_starts, tabs, gt = decode_genotypes(buf, self.n_samples)
+
+        # 每次重新映射文件，同名文件被重新创建后，常驻的工作进程不会写入旧的文件
+        row = first_line - self.first_line
+        mat = np.load(self.npy_file_name, mmap_mode='r+')
+        mat[row:row + len(gt)] = gt
+        mat.flush()
+        del mat
+
+        if not self.with_sites:
+            return []
+        buf = bytes(buf)
+        return [buf[start:end] for start, end in zip(line_starts.tolist(), tabs[:, 4].tolist())]
+
+
+def vcf_to_csv(line_processor, input_file_name, output_file_name, missing='.', read_mode='loader', use_CRLF=False):
+    """
+    将VCF文件转换为基因型CSV文件
+    :param line_processor: ParallelLine
+    :param input_file_name: VCF文件名，可以是gzip/BGZF压缩的文件
+    :param output_file_name: 输出文件名，以'.gz'结尾时压缩输出
+    :param missing: 缺失基因型的表示
+    :param read_mode: 数据的读取方式，含义同ParallelLine.run_row
+    :param use_CRLF: 是否采用'\\r\\n'换行
+    :return:
+    """
+    header = read_vcf_header(input_file_name)
+    line_processor.run_chunk(input_file_name, output_file_name, GenotypeCsv(header, missing), with_line_num=True,
+                             use_CRLF=use_CRLF, read_mode=read_mode, start_line=header.n_lines, binary=True)
+
+
+def vcf_to_npy(line_processor, input_file_name, npy_file_name, sites_file_name=None, read_mode='loader'):
+    """
+    将VCF文件的基因型转换为int8矩阵，保存为.npy文件
+    :param line_processor: ParallelLine
+    :param input_file_name: VCF文件名，可以是gzip/BGZF压缩的文件
+    :param npy_file_name: 输出的.npy文件名
+    :param sites_file_name: 位点文件名，每行为 CHROM\\tPOS\\tID\\tREF\\tALT，与矩阵的行一一对应。为None时不输出
+    :param read_mode: 数据的读取方式，含义同ParallelLine.run_row
+    :return: 以只读方式映射的基因型矩阵
+    """
+    header = read_vcf_header(input_file_name)
+    # 通过行索引得到数据行数，预先创建矩阵文件
+    n_rows = LineIndex.get_line_index(input_file_name, n_jobs=line_processor.n_jobs).n_lines - header.n_lines
+    shape = (n_rows, len(header.samples))
+    if n_rows == 0 or shape[1] == 0:
+        np.save(npy_file_name, np.zeros(shape, dtype=np.int8))
+        return np.load(npy_file_name, mmap_mode='r')
+    mat = np.lib.format.open_memmap(npy_file_name, mode='w+', dtype=np.int8, shape=shape)
+    del mat
+
+    # 各数据块按行号写入矩阵，只有输出位点文件时才需要顺序处理
+    line_processor.run_chunk(input_file_name, sites_file_name,
+                             GenotypeNpy(npy_file_name, header, sites_file_name is not None), with_line_num=True,
+                             order=sites_file_name is not None, read_mode=read_mode, start_line=header.n_lines,
+                             binary=True)
+    return np.load(npy_file_name, mmap_mode='r')
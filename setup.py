@@ -11,10 +11,15 @@ dev_requires = [
 
 ]
 
+# 可选的依赖，向量化的数据切分与VcfProcess需要numpy，`pip install -e ".[numpy]"`查看
+numpy_requires = [
+    'numpy',
+]
+
 setup(
     name='ParallelLineProcess',
     install_requires=requires,
-    extras_require={'dev': dev_requires},
+    extras_require={'dev': dev_requires, 'numpy': numpy_requires},
     entry_points={
         # 'paste.app_factory': [
         #     'main=covert_vcf2genseries_parallel:main'
@@ -1,9 +1,98 @@
 from unittest import TestCase
 
-from LinePrcessor import ChunkLoader, ParallelLine
+from LinePrcessor import ChunkLoader, ParallelLine, chunk2array, chunk2col
+from Container import PList, PQueue
+import LinePrcessor
+import Bgzf
+import LineIndex
+import Metrics
+import Benchmark
 
+import gzip
+import os
+import re
+import shutil
+import tempfile
 import time
 
+# VcfProcess需要numpy
+try:
+    import VcfProcess
+    import numpy as np
+except ImportError:
+    VcfProcess = None
+
+# 测试数据不在代码库中，不存在时生成可以复现的模拟VCF文件
+if not os.path.exists('sample.vcf'):
+    Benchmark.make_vcf('sample.vcf', n_rows=500, n_samples=20)
+if not os.path.exists('sample.vcf.gz'):
+    with open('sample.vcf', 'rb') as f_in, gzip.open('sample.vcf.gz', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+
+def tag_line(data):
+    return '{}\t{}'.format(data[0], data[1])
+
+
+def tag_line_bytes(data):
+    return b'%d\t%s' % data
+
+
+def tag_line_fail(data):
+    # 在第300行出错，用于模拟中断的任务
+    if data[0] == 300:
+        raise ValueError('第300行出错')
+    return tag_line(data)
+
+
+def prefilter_fail(line):
+    # 预过滤条件出错，用于模拟预加载进程中的异常
+    return {'#': True}[line[0]]
+
+
+def init_pair_table(state):
+    state['pid'] = os.getpid()
+    state['pair'] = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
+
+
+def pair_line(data, state):
+    # 返回工作进程号与第4列碱基的配对碱基
+    if data.startswith('#'):
+        return None
+    return '{}\t{}'.format(state['pid'], state['pair'][data.split('\t')[3]])
+
+
+def pair_line_global(data):
+    # 不接收state，通过worker_state()获取
+    return pair_line(data, LinePrcessor.worker_state())
+
+
+def pair_line_fail(data, state):
+    raise ValueError('处理出错')
+
+
+def upper_col(data):
+    return data[0], [v.upper() for v in data[1]]
+
+
+def tag_block(block):
+    row_nums, col_nums, data = block
+    return [['{}.{}'.format(r, c) + v for (c, v) in zip(col_nums, row)] for (r, row) in zip(row_nums, data)]
+
+
+# 主进程的pid，工作进程由fork产生，继承这个值
+MAIN_PID = os.getpid()
+
+
+def split_in_worker(lines):
+    # 主进程只允许切分单行来确定列数
+    assert len(lines) <= 1 or os.getpid() != MAIN_PID
+    return LinePrcessor.chunk2rows(lines)
+
+
+def tag_chunk(data):
+    return [None if line.startswith('##') else tag_line((num, line)) for (num, line) in data]
+
 
 class Testchunkloader(TestCase):
     loader = ChunkLoader(input_file_name='sample.vcf', chunk_size=71, use_async=True,
@@ -47,10 +136,633 @@ class TestLineProcessor(TestCase):
 
         print("数据处理完毕")
 
+    def test_run_row_shard(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=5, show_process_status=False)
+
+        lineProcessor.run_row(input_file_name='sample.vcf', output_file_name='sample.vcf.test1', row_func=tag_line,
+                              with_line_num=True)
+        with open('sample.vcf.test1', 'r') as f:
+            expect = f.read()
+
+        lineProcessor.run_row(input_file_name='sample.vcf', output_file_name='sample.vcf.test1', row_func=tag_line,
+                              with_line_num=True, read_mode='shard', shard_size=1024)
+        with open('sample.vcf.test1', 'r') as f:
+            self.assertEqual(expect, f.read())
+
+        # 没有行索引时，检查点不会触发对输入文件的额外扫描
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'sample.vcf')
+            shutil.copyfile('sample.vcf', fname)
+            lineProcessor.run_row(input_file_name=fname, output_file_name=fname + '.out', row_func=tag_line,
+                                  with_line_num=True, read_mode='shard', shard_size=1024)
+            with open(fname + '.out', 'r') as f:
+                self.assertEqual(expect, f.read())
+            self.assertFalse(os.path.exists(LineIndex.index_file_name(fname)))
+
+    def test_run_row_mmap(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=5, show_process_status=False)
+
+        lineProcessor.run_row(input_file_name='sample.vcf', output_file_name='sample.vcf.test1', row_func=tag_line,
+                              with_line_num=True)
+        with open('sample.vcf.test1', 'r') as f:
+            expect = f.read()
+
+        lineProcessor.run_row(input_file_name='sample.vcf', output_file_name='sample.vcf.test1', row_func=tag_line,
+                              with_line_num=True, read_mode='mmap')
+        with open('sample.vcf.test1', 'r') as f:
+            self.assertEqual(expect, f.read())
+
+    def test_mmap_loader(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'data.txt')
+            lines = ['x' * (i % 37 + 1) for i in range(1000)]
+            # 最后一行没有换行符
+            with open(fname, 'w') as f:
+                f.write('\n'.join(lines))
+
+            # LineBlock按字节切分，行数接近chunk_size，行号与各行的起始位置与逐行读取一致
+            blocks = list(LinePrcessor.MmapChunkLoader(fname, chunk_size=50, with_line_num=True))
+            self.assertEqual(list(enumerate(lines)), [item for block in blocks for item in block])
+            self.assertTrue(all(25 <= len(block) <= 100 for block in blocks[:-1]))
+            for block in blocks:
+                buf = bytes(block.buffer)
+                self.assertEqual([i for i in range(len(buf)) if i == 0 or buf[i - 1] == 10], block.offsets())
+
+    def test_run_row_index(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=5, show_process_status=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'sample.vcf')
+            with open('sample.vcf', 'r') as f:
+                lines = f.read().splitlines()
+            with open(fname, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+            # 第一次统计建立索引文件，之后直接读取
+            self.assertEqual(len(lines), LinePrcessor.file_line_count(fname))
+            self.assertTrue(os.path.exists(LineIndex.index_file_name(fname)))
+            index = LineIndex.get_line_index(fname, step=7, rebuild=True)
+            self.assertEqual(len(lines), index.n_lines)
+            self.assertEqual(list(index.lines), list(LineIndex.LineIndex.load(fname).lines))
+
+            # 索引点的字节位置与逐行统计的结果一致
+            offsets = [0]
+            for line in lines:
+                offsets.append(offsets[-1] + len(line.encode()) + 1)
+            for step in [1, 7, 50]:
+                index = LineIndex.LineIndex.build(fname, step=step, n_jobs=1, range_size=4096)
+                self.assertEqual(len(lines), index.n_lines)
+                self.assertEqual([offsets[line] for line in index.lines], list(index.offsets))
+
+            # 从第N行开始处理，各读取方式的结果一致
+            expect = [tag_line((i, line)) for i, line in enumerate(lines)][250:]
+            for read_mode in ['loader', 'shard', 'mmap']:
+                ret = lineProcessor.run_row(input_file_name=fname, row_func=tag_line, with_line_num=True,
+                                            read_mode=read_mode, use_index=True, start_line=250, shard_size=5000)
+                self.assertEqual(expect, ret)
+
+    def test_run_row_resume(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            for output_file_name in [os.path.join(tmp, 'out.txt'), os.path.join(tmp, 'out.txt.gz')]:
+                lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name,
+                                      row_func=tag_line, with_line_num=True)
+                with open(output_file_name, 'rb') as f:
+                    expect = f.read()
+                # 正常结束时检查点被删除
+                self.assertFalse(os.path.exists(output_file_name + '.ckpt'))
+
+                with self.assertRaises(ValueError):
+                    lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name,
+                                          row_func=tag_line_fail, with_line_num=True)
+                self.assertTrue(os.path.exists(output_file_name + '.ckpt'))
+
+                # 检查点之后的不完整数据被丢弃，继续处理后与完整运行的结果一致
+                with open(output_file_name, 'ab') as f:
+                    f.write(b'partial')
+                lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name,
+                                      row_func=tag_line, with_line_num=True, resume=True)
+                with open(output_file_name, 'rb') as f:
+                    self.assertEqual(expect, f.read())
+                self.assertFalse(os.path.exists(output_file_name + '.ckpt'))
+
+    def test_metrics(self):
+        snapshots = []
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False, reporters=[snapshots.append],
+                                     report_interval=0)
+        with open('sample.vcf', 'r') as f:
+            n_lines = len(f.read().splitlines())
+        for input_file_name in ['sample.vcf', 'sample.vcf.gz']:
+            lineProcessor.run_row(input_file_name=input_file_name, output_file_name='sample.vcf.test1')
+
+            # 进度以磁盘文件的读取位置计算，压缩文件同样可以读到末尾
+            snapshot = snapshots[-1]
+            self.assertTrue(snapshot['final'])
+            self.assertEqual(os.path.getsize(input_file_name), snapshot['input_pos'])
+            self.assertEqual(1.0, snapshot['progress'])
+            self.assertEqual(n_lines, snapshot['lines'])
+            self.assertEqual(os.path.getsize('sample.vcf.test1'), snapshot['output_bytes'])
+            self.assertEqual(set(Metrics.STAGES), set(snapshot['stage_time']))
+            self.assertGreater(snapshot['stage_time']['compute'], 0)
+            self.assertLessEqual(snapshot['max_depth']['inflight'], lineProcessor.max_inflight)
+
+    def test_auto_chunk_size(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=5, show_process_status=False)
+        expect = lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line, with_line_num=True)
+
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size='auto', show_process_status=False)
+        for read_mode in ['loader', 'mmap']:
+            ret = lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line, with_line_num=True,
+                                        read_mode=read_mode)
+            self.assertEqual(expect, ret)
+            self.assertIsNotNone(lineProcessor.chunk_tuner.line_cost)
+
+        # 计算开销决定任务大小，在途数据受内存上限约束，每次调整不超过step倍
+        tuner = LinePrcessor.ChunkTuner(n_jobs=4, max_inflight=8, target_task_time=0.1, mem_limit=1024 * 1024,
+                                        initial_lines=100, step=4)
+        self.assertEqual(100, tuner.update())
+        tuner.observe_task(100, 0.1)
+        self.assertEqual(100, tuner.update())
+        for i in range(20):
+            tuner.observe_task(100, 0.001)
+        self.assertEqual(400, tuner.update())
+        tuner.observe_payload(['x' * 10000] * 10)
+        self.assertLessEqual(tuner.update() * tuner.line_bytes * 16, 1024 * 1024)
+
+    def test_worker_init(self):
+        with ParallelLine(n_jobs=2, chunk_size=20, show_process_status=False, worker_init=init_pair_table) as lp:
+            first = lp.run_row(input_file_name='sample.vcf', row_func=pair_line, with_state=True)
+            with self.assertRaises(ValueError):
+                lp.run_row(input_file_name='sample.vcf', row_func=pair_line_fail, with_state=True)
+            second = lp.run_row(input_file_name='sample.vcf', row_func=pair_line, with_state=True)
+            third = list(lp.imap('sample.vcf', pair_line, with_state=True))
+            fourth = lp.run_row(input_file_name='sample.vcf', row_func=pair_line_global)
+
+            # 未指定with_state时，处理方法的调用方式不受worker_init影响
+            with open('sample.vcf', 'r') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines, lp.run_row(input_file_name='sample.vcf'))
+            self.assertEqual({'sample.vcf': lines}, lp.run_many(['sample.vcf']))
+            if VcfProcess is not None:
+                with tempfile.TemporaryDirectory() as tmp:
+                    csv_file_name = os.path.join(tmp, 'gt.csv')
+                    VcfProcess.vcf_to_csv(lp, 'sample.vcf', csv_file_name)
+                    with open(csv_file_name, 'r') as f:
+                        self.assertEqual(len(lines) - 2, len(f.read().splitlines()))
+
+        with open('sample.vcf', 'r') as f:
+            pairs = [{'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}[line.split('\t')[3]] for line in f if line[0] != '#']
+        for ret in [first, second, third, fourth]:
+            self.assertEqual(pairs, [line.split('\t')[1] for line in ret])
+        # 同一个进程池的工作进程只初始化一次，出错后进程池被重建
+        self.assertLessEqual(len({line.split('\t')[0] for line in first}), 2)
+        self.assertEqual({line.split('\t')[0] for line in second}, {line.split('\t')[0] for line in third})
+
+    def test_worker_mmap_rewrite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'data.txt')
+            with ParallelLine(n_jobs=2, chunk_size=2, show_process_status=False) as lp:
+                for content in ['old0\nold1\nold2\n', 'new0\nnew1\nnew2\n', 'rewritten0\nrewritten1\n']:
+                    # 常驻的工作进程中，同名文件被替换后读到的是新的内容
+                    with open(fname + '.tmp', 'w') as f:
+                        f.write(content)
+                    os.replace(fname + '.tmp', fname)
+                    self.assertEqual(content.splitlines(), lp.run_row(input_file_name=fname, read_mode='mmap'))
+
+    def test_run_many(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            # 大小悬殊的多个文件
+            input_files = [Benchmark.make_vcf(os.path.join(tmp, 'chr{}.vcf'.format(i)), n_rows=n, n_samples=5, seed=i)
+                           for i, n in enumerate([800, 10, 200, 0])]
+            expect = {fname: lineProcessor.run_row(input_file_name=fname, row_func=tag_line, with_line_num=True)
+                      for fname in input_files}
+
+            ret = lineProcessor.run_many(os.path.join(tmp, '*.vcf'), row_func=tag_line, with_line_num=True,
+                                         max_open=2)
+            self.assertEqual(expect, ret)
+
+            # 输出到文件，每个文件按照各自的扩展名压缩
+            jobs = [(fname, fname + ('.out.gz' if i % 2 else '.out')) for i, fname in enumerate(input_files)]
+            self.assertIsNone(lineProcessor.run_many(jobs, row_func=tag_line, with_line_num=True))
+            for fname, output_file_name in jobs:
+                open_func = gzip.open if output_file_name.endswith('.gz') else open
+                with open_func(output_file_name, 'rt') as f:
+                    self.assertEqual(expect[fname], f.read().splitlines())
+            self.assertEqual(sum(os.path.getsize(fname) for fname in input_files), lineProcessor.metrics.input_pos)
+
+    def test_write_mode(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+        with tempfile.TemporaryDirectory() as tmp:
+            for suffix in ['.txt', '.txt.gz']:
+                # 压缩块的边界取决于任务的划分，因此比较解压后的数据
+                open_func = gzip.open if suffix.endswith('.gz') else open
+                expect_file_name = os.path.join(tmp, 'expect' + suffix)
+                lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=expect_file_name,
+                                      row_func=tag_line, with_line_num=True)
+                with open_func(expect_file_name, 'rb') as f:
+                    expect = f.read()
+
+                # 工作进程写出part文件，主进程按顺序拼接，结果与主进程写出时完全一致
+                for read_mode, order in [('loader', True), ('loader', False), ('shard', True), ('mmap', False)]:
+                    output_file_name = os.path.join(tmp, 'out' + suffix)
+                    lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name,
+                                          row_func=tag_line, with_line_num=True, order=order, read_mode=read_mode,
+                                          shard_size=1024, write_mode='parts')
+                    with open_func(output_file_name, 'rb') as f:
+                        self.assertEqual(expect, f.read())
+                self.assertEqual(['expect' + suffix, 'out' + suffix], sorted(os.listdir(tmp)))
+
+                # part文件保留在目录中，输出文件按顺序列出各part文件
+                manifest_file_name = os.path.join(tmp, 'manifest' + suffix)
+                lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=manifest_file_name,
+                                      row_func=tag_line, with_line_num=True, order=False, write_mode='manifest')
+                with open(manifest_file_name, 'r') as f:
+                    parts = f.read().splitlines()
+                data = b''
+                for name in parts:
+                    with open(os.path.join(tmp, name), 'rb') as f:
+                        data += f.read()
+                self.assertEqual(expect, gzip.decompress(data) if suffix.endswith('.gz') else data)
+                shutil.rmtree(manifest_file_name + '.parts')
+                for name in os.listdir(tmp):
+                    os.remove(os.path.join(tmp, name))
+
+    def test_binary(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+        with open('sample.vcf', 'rb') as f:
+            expect = f.read()
+
+        # 行为bytes，默认的行处理方法原样返回，结果直接拼接写出
+        for input_file_name, read_mode in [('sample.vcf', 'loader'), ('sample.vcf.gz', 'loader'),
+                                           ('sample.vcf', 'shard'), ('sample.vcf', 'mmap')]:
+            lineProcessor.run_row(input_file_name=input_file_name, output_file_name='sample.vcf.test1',
+                                  read_mode=read_mode, shard_size=1024, binary=True)
+            with open('sample.vcf.test1', 'rb') as f:
+                self.assertEqual(expect, f.read())
+
+        ret = lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line_bytes, with_line_num=True,
+                                    binary=True)
+        self.assertEqual([tag_line((i, line)).encode() for i, line in enumerate(expect.decode().splitlines())], ret)
+        self.assertEqual(ret, list(lineProcessor.imap('sample.vcf', tag_line_bytes, with_line_num=True,
+                                                      binary=True)))
+
+    def test_result_mem_limit(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+        expect = lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line, with_line_num=True)
+
+        # 结果以PList返回，超过内存上限的部分写入磁盘，访问方式与List一致
+        for read_mode in ['loader', 'shard']:
+            ret = lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line, with_line_num=True,
+                                        read_mode=read_mode, shard_size=1024, result_mem_limit=4096)
+            self.assertIsInstance(ret, PList)
+            self.assertTrue(ret.use_disk_cache)
+            self.assertEqual(expect, ret)
+            self.assertEqual(expect[-3:], ret[-3:])
+            ret.close()
+
+        ret = lineProcessor.run_row(input_file_name='sample.vcf', with_line_num=False, binary=True,
+                                    result_mem_limit=float('inf'))
+        self.assertFalse(ret.use_disk_cache)
+        self.assertEqual([line.encode() for line in lineProcessor.run_row(input_file_name='sample.vcf')], ret)
+
+    def test_prefilter(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+        with open('sample.vcf', 'r') as f:
+            lines = f.read().splitlines()
+
+        # 被过滤的行不会交给row_func，行号仍然是行在文件中的行号
+        expect = [tag_line((i, line)) for i, line in enumerate(lines) if not line.startswith('##')]
+        self.assertEqual(expect, lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line,
+                                                       with_line_num=True, skip_prefix='##'))
+        self.assertEqual(expect, lineProcessor.run_row(input_file_name='sample.vcf.gz', row_func=tag_line,
+                                                       with_line_num=True, prefilter=lambda line: line[1] != '#'))
+
+        expect = [tag_line((i, line)).encode() for i, line in enumerate(lines) if '\tC\t' in line and i >= 100]
+        self.assertEqual(expect, lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line_bytes,
+                                                       with_line_num=True, binary=True, start_line=100,
+                                                       prefilter=re.compile(rb'\tC\t'), skip_prefix='#'))
+        # 正则表达式的类型与读取方式不一致时自动转换
+        self.assertEqual([line.decode() for line in expect],
+                         lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line, with_line_num=True,
+                                               start_line=100, prefilter=re.compile(rb'\tC\t'), skip_prefix='#'))
+
+        # 预过滤出错时，异常在主进程中重新抛出，不会一直等待
+        for channel in ['queue', 'shm']:
+            lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False, prefetch_channel=channel)
+            with self.assertRaises(KeyError):
+                lineProcessor.run_row(input_file_name='sample.vcf', prefilter=prefilter_fail)
+
+        # 过滤后从检查点继续，结果与完整运行一致
+        with tempfile.TemporaryDirectory() as tmp:
+            output_file_name = os.path.join(tmp, 'out.txt')
+            lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name, row_func=tag_line,
+                                  with_line_num=True, skip_prefix='##')
+            with open(output_file_name, 'rb') as f:
+                expect = f.read()
+            with self.assertRaises(ValueError):
+                lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name,
+                                      row_func=tag_line_fail, with_line_num=True, skip_prefix='##')
+            lineProcessor.run_row(input_file_name='sample.vcf', output_file_name=output_file_name, row_func=tag_line,
+                                  with_line_num=True, skip_prefix='##', resume=True)
+            with open(output_file_name, 'rb') as f:
+                self.assertEqual(expect, f.read())
+
+    def test_prefetch_channel(self):
+        with open('sample.vcf', 'r') as f:
+            lines = f.read().splitlines()
+        expect = [tag_line((i, line)) for i, line in enumerate(lines)]
+
+        # 共享内存环形缓冲区与队列的结果一致。槽位很小时，chunk退回通过队列传递，顺序不变
+        for prefetch, prefetch_mem in [(None, 64 * 1024 * 1024), (4, 1024)]:
+            lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False, prefetch=prefetch,
+                                         prefetch_channel='shm', prefetch_mem=prefetch_mem)
+            self.assertEqual(expect, lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line,
+                                                           with_line_num=True))
+            self.assertIn('loader_consumer_blocks', lineProcessor.metrics.counts)
+            self.assertIn('ring_overflows', lineProcessor.metrics.counts)
+            self.assertEqual([line.encode() for line in expect],
+                             lineProcessor.run_row(input_file_name='sample.vcf.gz', row_func=tag_line_bytes,
+                                                   with_line_num=True, binary=True))
+
+        loader = ChunkLoader('sample.vcf', chunk_size=7, with_line_num=True, channel='shm', prefetch_mem=256,
+                             skip_prefix='##')
+        self.assertEqual([(i, line) for i, line in enumerate(lines) if not line.startswith('##')],
+                         [item for data in loader for item in data])
+        self.assertGreater(loader.ring_overflows, 0)
+
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False, prefetch=3)
+        self.assertEqual(expect, lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line,
+                                                       with_line_num=True))
+
+    def test_run_row_bgzf(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=5, show_process_status=False)
+
+        # 输出为BGZF压缩文件，再以BGZF并行解压的方式读回
+        lineProcessor.run_row(input_file_name='sample.vcf', output_file_name='sample.vcf.test1.gz')
+        self.assertTrue(Bgzf.is_bgzf('sample.vcf.test1.gz'))
+        with open('sample.vcf', 'rb') as f:
+            expect = f.read()
+        with gzip.open('sample.vcf.test1.gz', 'rb') as f:
+            self.assertEqual(expect, f.read())
+
+        lineProcessor.run_row(input_file_name='sample.vcf.test1.gz', output_file_name='sample.vcf.test1')
+        with open('sample.vcf.test1', 'rb') as f:
+            self.assertEqual(expect, f.read())
+
+    def test_imap(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=5, show_process_status=False)
+
+        with open('sample.vcf', 'r') as f:
+            lines = f.read().splitlines()
+        expect = [tag_line((i, line)) for (i, line) in enumerate(lines)]
+
+        # 不指定输出文件时，结果以List返回
+        self.assertEqual(expect, lineProcessor.run_row(input_file_name='sample.vcf', row_func=tag_line,
+                                                       with_line_num=True))
+        self.assertEqual(expect, list(lineProcessor.imap('sample.vcf', tag_line, with_line_num=True)))
+
+    def test_run_col(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=20, show_process_status=False)
+
+        rows = [['r{}c{}'.format(r, c) for c in range(13)] for r in range(101)]
+        expect = [[rows[r][c].upper() for r in range(101)] for c in range(13)]
+        with tempfile.TemporaryDirectory() as tmp:
+            in_file = os.path.join(tmp, 'matrix.csv')
+            with open(in_file, 'w') as f:
+                f.write('\n'.join([','.join(row) for row in rows]) + '\n')
+
+            self.assertEqual(expect, lineProcessor.run_col(in_file, col_func=upper_col))
+
+            # 很小的列组与内存上限，保证缓存文件的分组与多次合并都会发生
+            out_file = os.path.join(tmp, 'matrix.t.csv')
+            lineProcessor.run_col(in_file, out_file, col_func=upper_col, cache_dir=os.path.join(tmp, 'cache'),
+                                  cols_per_file=4, mem_limit=256)
+            with open(out_file, 'r') as f:
+                self.assertEqual([','.join(col) for col in expect], f.read().splitlines())
+
+            # 最后一个列组只有6列，分次读取时按实际的列数与数据量计算
+            rows = [['r{}c{}'.format(r, c) for c in range(1030)] for r in range(7)]
+            with open(in_file, 'w') as f:
+                f.write('\n'.join([','.join(row) for row in rows]) + '\n')
+            lineProcessor.run_col(in_file, out_file, col_func=upper_col, cache_dir=os.path.join(tmp, 'cache'),
+                                  cols_per_file=1024, mem_limit=4096)
+            with open(out_file, 'r') as f:
+                self.assertEqual([','.join(rows[r][c].upper() for r in range(7)) for c in range(1030)],
+                                 f.read().splitlines())
+
+    def test_run_block(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=10, show_process_status=False)
+
+        rows = [['r{}c{}'.format(r, c) for c in range(17)] for r in range(33)]
+        expect = [['{}.{}'.format(r, c + 1) + rows[r][c] for c in range(17)] for r in range(33)]
+        with tempfile.TemporaryDirectory() as tmp:
+            in_file = os.path.join(tmp, 'matrix.csv')
+            with open(in_file, 'w') as f:
+                f.write('\n'.join([','.join(row) for row in rows]) + '\n')
+
+            for block_size in [(0, 0), (3, 4), (1, 1)]:
+                self.assertEqual(expect, lineProcessor.run_block(in_file, block_size=block_size,
+                                                                 block_func=tag_block))
+                self.assertEqual(expect, lineProcessor.run_block(in_file, block_size=block_size,
+                                                                 split_func=split_in_worker, block_func=tag_block))
+
+            out_file = os.path.join(tmp, 'matrix.out.csv')
+            lineProcessor.run_block(in_file, out_file, block_size=(4, 5), block_func=tag_block)
+            with open(out_file, 'r') as f:
+                self.assertEqual([','.join(row) for row in expect], f.read().splitlines())
+
+    def test_run_chunk(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=50, show_process_status=False)
+
+        lineProcessor.run_chunk(input_file_name='sample.vcf', output_file_name='sample.vcf.test1',
+                                chunk_func=tag_chunk, with_line_num=True)
+        with open('sample.vcf.test1', 'r') as f:
+            out = f.read().splitlines()
+        with open('sample.vcf', 'r') as f:
+            lines = f.read().splitlines()
+
+        expect = [tag_line((i, line)) for (i, line) in enumerate(lines) if not line.startswith('##')]
+        self.assertEqual(expect, out)
+
+
+class TestChunk2Array(TestCase):
+    def test_ragged(self):
+        # chunk2col与chunk2array对不等长的行都以空串补齐
+        lines = ['1,2,3', '4;5', '6|7 8:9']
+        self.assertEqual([['1', '4', '6'], ['2', '5', '7'], ['3', '', '8'], ['', '', '9']], chunk2col(lines))
+        if LinePrcessor.np is None:
+            self.skipTest("需要numpy")
+        self.assertEqual(chunk2col(lines), chunk2array(lines).T.tolist())
+        with self.assertRaises(ValueError):
+            chunk2array(lines, pad=None)
+
+    def test_infer_dtype(self):
+        if LinePrcessor.np is None:
+            self.skipTest("需要numpy")
+        cols = chunk2array([b'chr1,-12,0.5', b'chr2,300,1e3'], infer_dtype=True, as_columns=True)
+        self.assertEqual([b'chr1', b'chr2'], cols[0].tolist())
+        self.assertEqual('int64', str(cols[1].dtype))
+        self.assertEqual([-12, 300], cols[1].tolist())
+        self.assertEqual([0.5, 1000.0], cols[2].tolist())
+
 
 class TestPQueue(TestCase):
     def test_put(self):
-        self.fail()
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_dir = os.path.join(tmp, 'parent', 'cache')
+            queue = PQueue(mem_limit=1000, cache_dir=cache_dir)
+            for i in range(1000):
+                queue.put('item{:05d}'.format(i))
+
+            # 超过内存上限的数据写入了磁盘
+            self.assertEqual(1000, len(queue))
+            self.assertLessEqual(queue.mem_used, 1000)
+            self.assertGreater(len(os.listdir(cache_dir)), 0)
+
+            # 只删除缓存目录本身，空的上级目录保留
+            del queue
+            self.assertFalse(os.path.exists(cache_dir))
+            self.assertTrue(os.path.isdir(os.path.join(tmp, 'parent')))
+
+    def test_prefetch_mem(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = PQueue(mem_limit=1000, cache_dir=os.path.join(tmp, 'cache'))
+            for i in range(1000):
+                queue.put('item{:05d}'.format(i))
+            queue.get()
+
+            # 后台线程预加载的分段计入内存使用量
+            thread, result = queue._PQueue__co_worker
+            thread.join()
+            self.assertEqual(queue._PQueue__head_mem_used + queue._PQueue__tail_mem_used + result[0][1],
+                             queue.mem_used)
+
+            # 预加载的分段占用内存时，继续压入的数据仍然不超过内存上限
+            mem_used = []
+            for i in range(1000, 1500):
+                queue.put('item{:05d}'.format(i))
+                mem_used.append(queue.mem_used)
+            self.assertLessEqual(max(mem_used), 1000)
+            queue.put_done()
+            self.assertEqual(['item{:05d}'.format(i) for i in range(1, 1500)], list(queue))
+            self.assertEqual(0, queue.mem_used)
 
     def test_get(self):
-        self.fail()
+        with tempfile.TemporaryDirectory() as tmp:
+            for sync in [True, False]:
+                queue = PQueue(mem_limit=1000, cache_dir=os.path.join(tmp, 'cache'), sync=sync)
+                for i in range(1000):
+                    queue.put('item{:05d}'.format(i))
+
+                # 取出一部分后继续压入，顺序保持不变
+                out = [queue.get() for i in range(300)]
+                for i in range(1000, 1500):
+                    queue.put('item{:05d}'.format(i))
+                queue.put_done()
+                out += list(queue)
+
+                self.assertEqual(['item{:05d}'.format(i) for i in range(1500)], out)
+                self.assertIsNone(queue.get())
+
+
+class TestPList(TestCase):
+    def test_getitem(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_dir = os.path.join(tmp, 'cache')
+            data = ['item{:05d}'.format(i) if i % 3 else (i, b'x' * (i % 7)) for i in range(2000)]
+            plist = PList(mem_limit=1000, cache_dir=cache_dir, cache_size=4096, page_size=256, segment_size=1024)
+            plist.extend(data)
+
+            # 超过内存上限的数据写入了磁盘分段文件
+            self.assertEqual(2000, len(plist))
+            self.assertGreater(len(os.listdir(cache_dir)), 1)
+
+            for i in [0, 1, 999, 1500, 1999, -1]:
+                self.assertEqual(data[i], plist[i])
+            self.assertEqual(data[100:300], plist[100:300])
+            self.assertEqual(data[5::7], plist[5::7])
+            self.assertEqual(data, list(plist))
+            with self.assertRaises(IndexError):
+                plist[2000]
+
+            plist.close()
+            self.assertFalse(os.path.exists(cache_dir))
+
+
+class TestBenchmark(TestCase):
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = Benchmark.make_vcf(os.path.join(tmp, 'bench.vcf.gz'), n_rows=200, n_samples=5, compress='gzip')
+            configs = Benchmark.iter_configs(n_jobs=[2], chunk_size=[50], order=[True])
+            results = Benchmark.run_benchmark(fname, configs)
+
+            # 同步、异步加载各一项，run_row一项
+            self.assertEqual(3, len(results))
+            for result in results:
+                self.assertEqual(203, result['lines'])
+                self.assertGreater(result['lines_per_sec'], 0)
+                self.assertGreater(result['parent_peak_rss_mb'], 0)
+            self.assertIn('lines_per_sec', Benchmark.format_table(results))
+
+            # 出错的配置记录为失败，不会一直等待
+            configs = Benchmark.iter_configs(n_jobs=[2], chunk_size=[50], order=[True], read_mode=['shard'],
+                                             loader_modes=[])
+            results = Benchmark.run_benchmark(fname, configs, timeout=60)
+            self.assertEqual(1, len(results))
+            self.assertIn('AssertionError', results[0]['error'])
+            self.assertIn('失败', Benchmark.format_table(results))
+
+
+def reference_genotype(sample):
+    gt = sample.split(':')[0]
+    alleles = gt.replace('|', '/').split('/')
+    if '.' in alleles:
+        return -1
+    return sum(allele != '0' for allele in alleles)
+
+
+class TestVcfProcess(TestCase):
+    def setUp(self):
+        if VcfProcess is None:
+            self.skipTest("需要numpy")
+
+    def test_vcf_to_npy(self):
+        lineProcessor = ParallelLine(n_jobs=4, chunk_size=50, show_process_status=False)
+        with open('sample.vcf', 'r') as f:
+            lines = [line for line in f.read().splitlines() if not line.startswith('#')]
+        expect = np.array([[reference_genotype(s) for s in line.split('\t')[9:]] for line in lines], dtype=np.int8)
+        sites = ['\t'.join(line.split('\t')[:5]) for line in lines]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            npy_file_name = os.path.join(tmp, 'gt.npy')
+            for input_file_name, read_mode in [('sample.vcf', 'loader'), ('sample.vcf', 'mmap'),
+                                               ('sample.vcf.gz', 'loader')]:
+                mat = VcfProcess.vcf_to_npy(lineProcessor, input_file_name, npy_file_name, read_mode=read_mode)
+                self.assertEqual(np.int8, mat.dtype)
+                self.assertTrue(np.array_equal(expect, mat))
+
+            sites_file_name = os.path.join(tmp, 'sites.txt')
+            VcfProcess.vcf_to_npy(lineProcessor, 'sample.vcf', npy_file_name, sites_file_name, read_mode='shard')
+            self.assertTrue(np.array_equal(expect, np.load(npy_file_name)))
+            with open(sites_file_name, 'r') as f:
+                self.assertEqual(sites, f.read().splitlines())
+
+            # 标题行只输出一次，缺失的基因型以missing表示
+            csv_file_name = os.path.join(tmp, 'gt.csv')
+            VcfProcess.vcf_to_csv(lineProcessor, 'sample.vcf', csv_file_name, missing='-')
+            header = VcfProcess.read_vcf_header('sample.vcf')
+            with open(csv_file_name, 'r') as f:
+                rows = f.read().splitlines()
+            self.assertEqual(','.join(['CHROM', 'POS'] + header.samples), rows[0])
+            self.assertEqual(len(lines) + 1, len(rows))
+            for line, row, gt in zip(lines, rows[1:], expect):
+                fields = line.split('\t')
+                self.assertEqual(','.join(fields[:2] + ['-' if v < 0 else str(v) for v in gt]), row)
+
+    def test_decode_genotypes(self):
+        buf = b'1\t10\t.\tA\tT\t.\t.\t.\tGT\t0|1\t1/1:3\t./.\t0/.\t1\t0\n1\t11\t.\tA\tT\t.\t.\t.\tGT\t2/0\t0/0\t.\t1|2\t0\t1'
+        line_starts, tabs, gt = VcfProcess.decode_genotypes(buf, 6)
+        self.assertEqual([0, buf.index(b'\n') + 1], line_starts.tolist())
+        self.assertEqual([[1, 2, -1, -1, 1, 0], [1, 0, -1, 2, 0, 1]], gt.tolist())
+        with self.assertRaises(ValueError):
+            VcfProcess.decode_genotypes(buf, 5)